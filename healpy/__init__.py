@@ -45,12 +45,17 @@ from pixelfunc import (ma,mask_good,mask_bad,vec2ang,ang2vec,ang2pix,
                        get_all_neighbours,
                        get_interp_val,fit_dipole,fit_monopole,
                        remove_dipole,remove_monopole,
-                       get_nside,maptype,ud_grade,reorder,nside2resol,nside2pixarea)
+                       get_nside,maptype,ud_grade,reorder,nside2resol,nside2pixarea,
+                       ringinfo)
 
 from sphtfunc import (anafast,map2alm,
                       alm2map,Alm,synalm,synfast,
                       smoothing,smoothalm,almxfl,alm2cl,
-                      pixwin,alm2map_der1)
+                      pixwin,alm2map_der1,SHTPlan,AlmLayout,
+                      map2alm_spin,alm2map_spin,rotate_alm,
+                      map2alm_stream,SHTPool,
+                      apodize_mask,coupling_matrix,pseudo_cl,
+                      wigner3j,gaunt,SynfastEngine)
 
 from query_disc_func import *
 
@@ -58,11 +63,12 @@ from zoomtool import mollzoom,set_g_clim
 
 from rotator import Rotator
 
+from hpxfunc import write_hpx,read_hpx,read_hpx_info,ishpxfile
+
 from _healpy_pixel_lib import UNSEEN
 
 try:
-    from pshyt import job
-    from pshyt import *
+    from pshyt import job, pshtError
 except ImportError:
     warnings.warn("Warning: Cannot import pshyt module)",
                   category=ImportWarning)
@@ -79,7 +85,7 @@ except ImportError:
                   category=ImportWarning)
 
 try:
-    from fitsfunc import write_map,read_map,mrdfits,mwrfits,read_alm,write_alm,write_cl,read_cl
+    from fitsfunc import write_map,read_map,read_map_info,read_map_region,read_maps,HealpixFitsWriter,mrdfits,mwrfits,read_alm,write_alm,write_cl,read_cl
 except:
     warnings.warn("Warning: Cannot import fits i/o tools (needs pyfits)",
                   category=ImportWarning)
@@ -0,0 +1,128 @@
+#
+#  This file is part of Healpy.
+#
+#  Healpy is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Healpy is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Healpy; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+#  For more information about Healpy, see http://code.google.com/p/healpy
+#
+"""Pools of worker processes (private to healpy).
+
+The workers are new python processes, not forked ones: a process which
+has used OpenMP cannot be forked safely. Short commands and answers are
+pickled through pipes, large data go through files mapped in memory, in
+the directory of the pool (in /dev/shm when it exists).
+"""
+
+import os
+import sys
+import subprocess
+import tempfile
+import shutil
+import traceback
+import cPickle
+
+class WorkerPool(object):
+    """A pool of nproc worker processes, each one running the function
+    worker (given as 'module.function', the function calling serve).
+
+    Input:
+      - worker: the main function of the workers
+      - nproc: the number of worker processes
+    Parameters:
+      - env: the environment of the workers. Default: the current one
+      - name: the name of the pool, for error messages
+    """
+    def __init__(self,worker,nproc,env=None,name='worker pool'):
+        self.nproc = nproc
+        self.name = name
+        self._procs = []
+        shm = '/dev/shm'
+        self.dir = tempfile.mkdtemp(prefix='healpy_pool',
+                                    dir=os.path.isdir(shm) and shm or None)
+        module,func = worker.rsplit('.',1)
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        cmd = [sys.executable,'-c',
+               'import sys; sys.path.insert(0,%r); '
+               'from %s import %s; %s()'%(path,module,func,func)]
+        for k in xrange(nproc):
+            self._procs.append(subprocess.Popen(cmd,stdin=subprocess.PIPE,
+                                                stdout=subprocess.PIPE,
+                                                env=env))
+
+    def call(self,cmd):
+        """Send a command (or a list of commands, one per worker, possibly
+        fewer than the workers) to the workers and wait for all of them to
+        be done. Raise a RuntimeError with the traceback of the first
+        failure, if any.
+        """
+        if not self._procs:
+            raise ValueError("The %s is closed"%self.name)
+        if not isinstance(cmd,list):
+            cmd = [cmd]*len(self._procs)
+        procs = self._procs[:len(cmd)]
+        for p,c in zip(procs,cmd):
+            cPickle.dump(c,p.stdin,2)
+            p.stdin.flush()
+        errors = []
+        for p in procs:
+            try:
+                res = cPickle.load(p.stdout)
+            except EOFError:
+                res = 'worker process %d died'%p.pid
+            if res is not None:
+                errors.append(res)
+        if errors:
+            raise RuntimeError('%s worker failed:\n'%self.name+errors[0])
+
+    def close(self):
+        """Stop the workers and remove the directory of the pool.
+        """
+        for p in self._procs:
+            try:
+                p.stdin.close()
+            except IOError:
+                pass
+        for p in self._procs:
+            p.wait()
+        self._procs = []
+        if self.dir is not None:
+            shutil.rmtree(self.dir,ignore_errors=True)
+            self.dir = None
+
+    def __del__(self):
+        if getattr(self,'dir',None) is not None:
+            self.close()
+
+def serve(handler):
+    """Main loop of a worker process: each command read from stdin is
+    given to handler, and None (or the traceback of the error) is written
+    to stdout when it is done. Return when stdin is closed.
+    """
+    fin = sys.stdin
+    # stdout is kept for the answers, other outputs go to stderr
+    fout = os.fdopen(os.dup(1),'wb')
+    os.dup2(2,1)
+    while True:
+        try:
+            cmd = cPickle.load(fin)
+        except EOFError:
+            break
+        res = None
+        try:
+            handler(cmd)
+        except Exception:
+            res = traceback.format_exc()
+        cPickle.dump(res,fout,2)
+        fout.flush()
@@ -23,9 +23,18 @@
 import pyfits as pyf
 import numpy as npy
 import pixelfunc
+import hpxfunc
+import _workers
 from sphtfunc import Alm
 import warnings
+import os
+import tempfile
+import atexit
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from _healpy_pixel_lib import UNSEEN
+import _healpy_fitsio_lib as hfitslib
 from exceptions import NotImplementedError
 
 class HealpixFitsWarning(Warning):
@@ -38,8 +47,14 @@ def read_cl(filename,dtype=npy.float32,h=False):
       - filename: the fits file name
 
     Return: 
-      - cl: the cl array, currently TT only
+      - cl: the cl array, currently TT only (all the spectra stored in
+            healpy binary files, see write_cl)
     """
+    if hpxfunc.ishpxfile(filename):
+        return _read_hpx_kind(filename,'cl')
+    cl = _read_columns_native(filename,1,[0])
+    if cl is not None:
+        return cl[0]
     hdulist=pyf.open(filename)
     return hdulist[1].data.field(0)
 
@@ -49,11 +64,19 @@ def write_cl(filename,cl,dtype=npy.float32):
     Input:
       - filename: the fits file name
       - cl: the cl array to write to file, currently TT only
+    If filename ends with .hpx, cl is written in the healpy binary format
+    (see hpxfunc), which also accepts a sequence of spectra.
     """
+    if _is_hpx_name(filename):
+        hpxfunc.write_hpx(filename,cl,kind='cl',dtype=dtype)
+        return
     # check the dtype and convert it
     fitsformat = getformat(dtype)
     if isinstance(cl, list):
         raise NotImplementedError('Currently it supports only temperature-only cls')
+    if _write_columns_native(filename,['TEMPERATURE'],[cl],[fitsformat],[1],
+                             [('CREATOR','healpy','')],dtype=dtype):
+        return
     else: # we write only one TT
         cols = [pyf.Column(name='TEMPERATURE',
                                format='%s'%fitsformat,
@@ -65,7 +88,9 @@ def write_cl(filename,cl,dtype=npy.float32):
     tbhdu.header.update('CREATOR','healpy')
     tbhdu.writeto(filename,clobber=True)
 
-def write_map(filename,m,nest=False,dtype=npy.float32,fits_IDL=True):
+def write_map(filename,m,nest=False,dtype=npy.float32,fits_IDL=True,
+              partial=False,compress=None,quantize_level=0,coord=None,
+              units=None):
     """Writes an healpix map into an healpix file.
 
     Input:
@@ -75,13 +100,82 @@ def write_map(filename,m,nest=False,dtype=npy.float32,fits_IDL=True):
       - nest=False: ordering scheme
       - fits_IDL = true reshapes columns in rows of 1024, otherwise all the data will 
         go in one column
+      - partial=False: if True, write a cut sky file (INDXSCHM EXPLICIT):
+                       only the pixels not UNSEEN in the first map are
+                       written, in a PIXEL column followed by the values
+      - compress=None: if given, the map(s) are stored in a tile compressed
+                       image extension, one tile per row of 1024 pixels.
+                       The compression algorithm is one of 'GZIP_1',
+                       'RICE_1', 'HCOMPRESS_1', 'PLIO_1' (True means 'GZIP_1').
+                       The extension is an image of shape
+                       (nmaps, npix/1024, 1024), not a binary table with
+                       TTYPEn columns: HEALPix F90 and IDL readers cannot
+                       read it, only read_map (or any FITS image reader).
+      - quantize_level=0: with compress, floating point maps are stored
+                          losslessly if 0. Otherwise they are quantized
+                          with a step of (noise rms)/quantize_level
+                          (lossy, much better compression).
+      - coord=None: the coordinate system ('G', 'E' or 'C'), written in
+                    the COORDSYS keyword
+      - units=None: the units of the map(s) (one string, or one per map),
+                    written in the TUNITn keywords (BUNITn, and BUNIT if
+                    they are all the same, for compressed maps)
+    If filename ends with .hpx, the map(s) are written in the healpy
+    binary format instead (see hpxfunc), which also accepts stacks of any
+    number of maps; fits_IDL is then ignored. read_map reads both formats,
+    so that read_map(..., h=True) followed by write_map (with the type,
+    coord and units found in the header) converts one format to the other
+    without any loss.
     """
     if not hasattr(m, '__len__'):
         raise TypeError('The map must be a sequence')
+    if _is_hpx_name(filename):
+        if partial or compress:
+            raise ValueError('partial and compress are not supported in '
+                             'healpy binary files')
+        if units is not None and not isinstance(units,basestring):
+            if len(set(units)) > 1:
+                raise ValueError('healpy binary files hold a single unit')
+            units = units[0]
+        hpxfunc.write_hpx(filename,m,kind='map',nest=nest,coord=coord,
+                          units=units,dtype=dtype)
+        return
     # check the dtype and convert it
     fitsformat = getformat(dtype)
     #print 'format to use: "%s"'%fitsformat
-    if hasattr(m[0], '__len__'):
+    if compress:
+        if partial:
+            raise ValueError('partial and compress cannot be used together')
+        _write_compressed_map(filename,m,nest,dtype,compress,quantize_level,
+                              coord,units)
+        return
+    if not partial and _write_map_native(filename,m,nest,dtype,fits_IDL,
+                                         coord,units):
+        return
+    if partial:
+        if hasattr(m[0], '__len__'):
+            maps = [npy.asarray(mm) for mm in m]
+            colnames=['I_STOKES','Q_STOKES','U_STOKES']
+            if len(maps) != 3 or maps[1].size != maps[0].size or maps[2].size != maps[0].size:
+                raise ValueError("You should give 3 maps of same size "
+                                 "for polarisation...")
+        else:
+            maps = [npy.asarray(m)]
+            colnames=['SIGNAL']
+        nside = pixelfunc.npix2nside(maps[0].size)
+        if nside < 0:
+            raise ValueError('Invalid healpix map : wrong number of pixel')
+        colunits = _map_units(units,len(maps))
+        pix = npy.flatnonzero(pixelfunc.mask_good(maps[0]))
+        if maps[0].size > 2**31-1:
+            cols = [pyf.Column(name='PIXEL',format='K',array=pix)]
+        else:
+            cols = [pyf.Column(name='PIXEL',format='J',
+                               array=pix.astype(npy.int32))]
+        for cn,cu,mm in zip(colnames,colunits,maps):
+            cols.append(pyf.Column(name=cn,format='%s'%fitsformat,
+                                   unit=cu,array=mm[pix]))
+    elif hasattr(m[0], '__len__'):
         # we should have three maps
         if len(m) != 3 or len(m[1]) != len(m[0]) or len(m[2]) != len(m[0]):
             raise ValueError("You should give 3 maps of same size "
@@ -91,51 +185,261 @@ def write_map(filename,m,nest=False,dtype=npy.float32,fits_IDL=True):
             raise ValueError('Invalid healpix map : wrong number of pixel')
         cols=[]
         colnames=['I_STOKES','Q_STOKES','U_STOKES']
-        for cn,mm in zip(colnames,m):
+        colunits = _map_units(units,3)
+        for cn,cu,mm in zip(colnames,colunits,m):
             if len(mm) > 1024 and fits_IDL:
                 # I need an ndarray, for reshape:
                 mm2 = npy.asarray(mm)
                 cols.append(pyf.Column(name=cn,
                                        format='1024%s'%fitsformat,
+                                       unit=cu,
                                        array=mm2.reshape(mm2.size/1024,1024)))
             else:
                 cols.append(pyf.Column(name=cn,
                                        format='%s'%fitsformat,
+                                       unit=cu,
                                        array=mm))
     else: # we write only one map
         nside = pixelfunc.npix2nside(len(m))
         if nside < 0:
             raise ValueError('Invalid healpix map : wrong number of pixel')
+        cu = _map_units(units,1)[0]
         if m.size > 1024 and fits_IDL:
             cols = [pyf.Column(name='I_STOKES',
                                format='1024%s'%fitsformat,
+                               unit=cu,
                                array=m.reshape(m.size/1024,1024))]
         else:
             cols = [pyf.Column(name='I_STOKES',
                                format='%s'%fitsformat,
+                               unit=cu,
                                array=m)]
             
     coldefs=pyf.ColDefs(cols)
     tbhdu = pyf.new_table(coldefs)
     # add needed keywords
-    tbhdu.header.update('PIXTYPE','HEALPIX','HEALPIX pixelisation')
+    _add_healpix_keys(tbhdu.header,nside,nest,partial,coord)
+    tbhdu.writeto(filename,clobber=True)
+
+def _is_hpx_name(filename):
+    """Return True if filename has the extension of healpy binary files.
+    """
+    return (isinstance(filename,basestring) and
+            filename.lower().endswith(hpxfunc.HPX_EXTENSION))
+
+def _map_units(units,nmaps):
+    """Return the units of nmaps maps as a list of strings.
+    """
+    if units is None:
+        return ['']*nmaps
+    if isinstance(units,basestring):
+        return [units]*nmaps
+    if len(units) != nmaps:
+        raise ValueError('You should give one unit per map')
+    return list(units)
+
+def _write_compressed_map(filename,m,nest,dtype,compress,quantize_level,
+                          coord=None,units=None):
+    """Write the map(s) in a tile compressed image extension of shape
+    (nmaps, npix/1024, 1024), or (npix/1024, 1024) for a single map.
+    This is not the binary table layout of HEALPix files (no TTYPEn
+    columns), so that the F90 and IDL readers cannot read it.
+    """
+    if compress is True:
+        compress = 'GZIP_1'
+    if hasattr(m[0], '__len__'):
+        if len(m) != 3 or len(m[1]) != len(m[0]) or len(m[2]) != len(m[0]):
+            raise ValueError("You should give 3 maps of same size "
+                             "for polarisation...")
+    nside = pixelfunc.npix2nside(len(m[0]) if hasattr(m[0], '__len__') else len(m))
+    if nside < 0:
+        raise ValueError('Invalid healpix map : wrong number of pixel')
+    npix = pixelfunc.nside2npix(nside)
+    ncol = min(npix,1024)
+    data = npy.array(m,dtype=dtype)
+    data = data.reshape(data.shape[:-1]+(npix//ncol,ncol))
+    hdus = [pyf.PrimaryHDU()]
+    if quantize_level and data.dtype.kind == 'f':
+        # UNSEEN would ruin the quantization of its tile: store the bad
+        # pixels in a separate (very compressible) mask extension
+        bad = pixelfunc.mask_bad(data)
+        if bad.any():
+            data[bad] = 0
+            badhdu = pyf.CompImageHDU(bad.astype(npy.int16),
+                                      compression_type='GZIP_1',name='BADPIX')
+    else:
+        bad = None
+    tbhdu = pyf.CompImageHDU(data,compression_type=compress,
+                             quantize_level=quantize_level)
+    _add_healpix_keys(tbhdu.header,nside,nest,coord=coord)
+    # one unit per map in BUNITn keywords (TUNITn are reserved for the
+    # table holding the compressed data), and BUNIT if they are all the same
+    nmaps = hasattr(m[0], '__len__') and len(m) or 1
+    mapunits = _map_units(units,nmaps)
+    if units is not None:
+        for i,u in enumerate(mapunits):
+            tbhdu.header.update('BUNIT%d'%(i+1),u,'Physical unit of map %d'%(i+1))
+        if len(set(mapunits)) == 1:
+            tbhdu.header.update('BUNIT',mapunits[0],
+                                'Physical units of the maps')
+    hdus.append(tbhdu)
+    if bad is not None and bad.any():
+        hdus.append(badhdu)
+    pyf.HDUList(hdus).writeto(filename,clobber=True)
+
+def _healpix_keys(nside,nest,partial=False,coord=None):
+    """Return the healpix keywords of a map extension, as a list of
+    (key, value, comment).
+    """
     if nest: ordering = 'NESTED'
     else:    ordering = 'RING'
-    tbhdu.header.update('ORDERING',ordering,
-                        'Pixel ordering scheme, either RING or NESTED')
-    tbhdu.header.update('EXTNAME','xtension',
-                        'name of this binary table extension')
-    tbhdu.header.update('NSIDE',nside,'Resolution parameter of HEALPIX')
-    tbhdu.header.update('FIRSTPIX', 0, 'First pixel # (0 based)')
-    tbhdu.header.update('LASTPIX',pixelfunc.nside2npix(nside)-1,
-                        'Last pixel # (0 based)')
-    tbhdu.header.update('INDXSCHM','IMPLICIT',
-                        'Indexing: IMPLICIT or EXPLICIT')
-    tbhdu.writeto(filename,clobber=True)
+    keys = [('PIXTYPE','HEALPIX','HEALPIX pixelisation'),
+            ('ORDERING',ordering,
+             'Pixel ordering scheme, either RING or NESTED'),
+            ('EXTNAME','xtension','name of this binary table extension'),
+            ('NSIDE',nside,'Resolution parameter of HEALPIX'),
+            ('FIRSTPIX',0,'First pixel # (0 based)'),
+            ('LASTPIX',pixelfunc.nside2npix(nside)-1,'Last pixel # (0 based)')]
+    if partial:
+        keys += [('OBJECT','PARTIAL','Sky coverage, FULLSKY or PARTIAL'),
+                 ('INDXSCHM','EXPLICIT','Indexing: IMPLICIT or EXPLICIT'),
+                 ('GRAIN',1,'Grain of pixel indexing')]
+    else:
+        keys += [('INDXSCHM','IMPLICIT','Indexing: IMPLICIT or EXPLICIT')]
+    if coord:
+        keys += [('COORDSYS',coord,
+                  'Ecliptic, Galactic or Celestial (equatorial)')]
+    return keys
+
+def _add_healpix_keys(header,nside,nest,partial=False,coord=None):
+    """Add the healpix keywords to a binary table header.
+    """
+    for key,value,comment in _healpix_keys(nside,nest,partial,coord):
+        header.update(key,value,comment)
+
+class HealpixFitsWriter(object):
+    """Write an healpix map to a fits file chunk by chunk.
 
+    The header is written when the writer is created, then consecutive
+    pixel chunks are appended with write() (converted to dtype on the fly),
+    so that the map never has to be held in memory at once. The file is
+    complete when all the pixels have been written and close() is called.
 
-def read_map(filename,field=0,dtype=npy.float64,nest=False,hdu=1,h=False,
-             verbose=False):
+    Usage:
+      >>> w = HealpixFitsWriter('map.fits', nside, nmaps=3)
+      >>> for chunk in chunks:  # chunk = (I, Q, U) arrays of same length
+      ...     w.write(chunk)
+      >>> w.close()
+    """
+    def __init__(self,filename,nside,nmaps=1,nest=False,dtype=npy.float32,
+                 colnames=None):
+        """Create the file and write its header.
+
+        Input:
+          - filename: the fits file name (overwritten if it exists)
+          - nside: the resolution of the map
+        Parameters:
+          - nmaps: the number of maps (columns); 1 for I, 3 for I, Q, U
+          - nest=False: ordering scheme of the pixels to be written
+          - dtype: the type of the data in the file
+          - colnames: the column names.
+                      Default: I_STOKES or I_STOKES, Q_STOKES, U_STOKES
+        """
+        if not pixelfunc.isnsideok(nside):
+            raise ValueError('Wrong nside parameter.')
+        if colnames is None:
+            if nmaps == 1:
+                colnames = ['I_STOKES']
+            elif nmaps == 3:
+                colnames = ['I_STOKES','Q_STOKES','U_STOKES']
+            else:
+                raise ValueError('colnames must be given for %d maps'%nmaps)
+        if len(colnames) != nmaps:
+            raise ValueError('Wrong number of column names')
+        fitsformat = getformat(dtype)
+        self.nside = nside
+        self.nmaps = nmaps
+        self.npix = pixelfunc.nside2npix(nside)
+        self.dtype = npy.dtype(dtype).newbyteorder('>')
+        if self.npix > 1024:
+            self._repeat = 1024
+        else:
+            self._repeat = 1
+        self._pending = [npy.zeros(0,dtype=self.dtype)]*nmaps
+        self._written = 0
+
+        header = pyf.Header()
+        header.update('XTENSION','BINTABLE','binary table extension')
+        header.update('BITPIX',8,'8-bit bytes')
+        header.update('NAXIS',2,'2-dimensional binary table')
+        header.update('NAXIS1',nmaps*self._repeat*self.dtype.itemsize,
+                      'width of table in bytes')
+        header.update('NAXIS2',self.npix//self._repeat,'number of rows in table')
+        header.update('PCOUNT',0,'size of special data area')
+        header.update('GCOUNT',1,'one data group (required keyword)')
+        header.update('TFIELDS',nmaps,'number of fields in each row')
+        for i,cn in enumerate(colnames):
+            header.update('TTYPE%d'%(i+1),cn,'label for field %3d'%(i+1))
+            header.update('TFORM%d'%(i+1),
+                          (self._repeat > 1 and '%d%s'%(self._repeat,fitsformat)
+                           or fitsformat),'data format of field')
+        _add_healpix_keys(header,nside,nest)
+        if os.path.exists(filename):
+            os.remove(filename)
+        self._stream = pyf.StreamingHDU(filename,header)
+
+    def write(self,m):
+        """Append pixels to the map(s).
+
+        Input:
+          - m: an array of the next pixel values, or a sequence of nmaps
+               arrays of same length if nmaps > 1
+        """
+        if self.nmaps == 1:
+            m = [m]
+        if len(m) != self.nmaps:
+            raise ValueError('Expected %d maps'%self.nmaps)
+        m = [npy.concatenate((p,npy.asarray(mm,dtype=self.dtype).ravel()))
+             for p,mm in zip(self._pending,m)]
+        n = m[0].size
+        if [mm.size for mm in m] != [n]*self.nmaps:
+            raise ValueError('All maps must have the same number of pixels')
+        if self._written + n > self.npix:
+            raise ValueError('Too many pixels for nside=%d'%self.nside)
+        nrows = n//self._repeat
+        if nrows > 0:
+            rows = npy.empty((nrows,self.nmaps,self._repeat),dtype=self.dtype)
+            for i,mm in enumerate(m):
+                rows[:,i,:] = mm[:nrows*self._repeat].reshape(nrows,self._repeat)
+            self._stream.write(rows.view(npy.uint8).ravel())
+        self._pending = [mm[nrows*self._repeat:] for mm in m]
+        self._written += n - self._pending[0].size
+
+    def close(self):
+        """Close the file. Raise an IOError if the map is not complete.
+        """
+        if self._stream is None:
+            return
+        self._stream.close()
+        self._stream = None
+        if self._written != self.npix:
+            raise IOError('Only %d pixels out of %d were written'%
+                          (self._written,self.npix))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,type,value,traceback):
+        if type is None:
+            self.close()
+        elif self._stream is not None:
+            # do not hide the original exception
+            self._stream.close()
+            self._stream = None
+
+
+def read_map(filename,field=0,dtype=None,nest=False,hdu=1,h=False,
+             verbose=False,memmap=False,pixels=None,nthreads=None):
     """Read an healpix map from a fits file.
 
     Input:
@@ -144,71 +448,858 @@ def read_map(filename,field=0,dtype=npy.float64,nest=False,hdu=1,h=False,
       - field: the column to read Default: 0
                by convention 0 is temperature, 1 is Q, 2 is U
                field can be a tuple to read multiple columns (0,1,2)
-      - dtype: force the conversion to some type. Default: npy.float64
+      - dtype: force the conversion to some type. Default: npy.float64,
+               or the type stored in the file if memmap is True
       - nest=False: if True return the map in NEST ordering, otherwise in RING ordering; 
                     use fits keyword ORDERING to decide whether conversion is needed or not
                     if None, no conversion is performed
       - hdu=1: the header number to look at (start at 0)
       - h=False: if True, return also the header
       - verbose=False: if True, print a number of diagnostic messages
+      - memmap=False: if True, return read-only arrays mapped onto the file
+                      data (big-endian, as stored on disk) instead of
+                      in-memory copies. Bad values are not replaced by UNSEEN,
+                      and a copy is only made if a dtype or an ordering
+                      conversion is requested (use nest=None to avoid it).
+      - pixels=None: if given, an array of pixel indices (in the ordering
+                     selected by nest) : only the values at these pixels are
+                     returned, and only the table rows holding them are read.
+      - nthreads=None: the number of threads decompressing tile compressed
+                       maps, see read_maps. Default: the number of cpus
+    Cut sky files (INDXSCHM EXPLICIT) are expanded to full sky maps, with
+    UNSEEN in the missing pixels; field then counts the columns following
+    the PIXEL column, and memmap has no effect.
+    Tile compressed maps (see write_map) are decompressed transparently,
+    blocks of tiles being decompressed in parallel; field is then the index
+    of the map, and memmap has no effect.
+    Healpy binary files (see write_map) are read too; field is then the
+    index of the map in the stack, hdu is ignored, memmap returns arrays
+    mapped onto the file without any copy, and the header holds NSIDE,
+    ORDERING, COORDSYS and TUNITn.
     Return:
       - an array, a tuple of array, possibly with the header at the end if h
         is True
     """
-    hdulist=pyf.open(filename)
-    #print hdulist[1].header
-    nside = int(hdulist[hdu].header.get('NSIDE'))
-    if nside is None:
-        warnings.warn("No NSIDE in the header file : will use length of array",
-                      HealpixFitsWarning)
-    if verbose: print 'NSIDE = %d'%nside
-
-    if not pixelfunc.isnsideok(nside):
-        raise ValueError('Wrong nside parameter.')
-    ordering = hdulist[hdu].header.get('ORDERING','UNDEF').strip()
-    if ordering == 'UNDEF':
-        ordering = (nest and 'NESTED' or 'RING')
-        warnings.warn("No ORDERING keyword in header file : "
-                      "assume %s"%ordering)
-    if verbose: print 'ORDERING = %s in fits file'%ordering
-
-    sz=pixelfunc.nside2npix(nside)
     if not hasattr(field, '__len__'):
         field = (field,)
-    ret = []
+    if hpxfunc.ishpxfile(filename):
+        return _read_map_hpx(filename,field,dtype,nest,h,verbose,memmap,
+                             pixels)
+    if not (memmap or h or pixels is not None):
+        plan = _native_map_plan(filename,field,hdu)
+        ndtype = _native_dtype(dtype or npy.float64)
+        if plan is not None and ndtype is not None:
+            nside, ordering, kind = plan[:3]
+            shape = (len(field),pixelfunc.nside2npix(nside))
+            nworkers = 1
+            if kind == 'image':
+                nworkers = _nworkers(nthreads,
+                                     npy.prod(shape)*ndtype.itemsize)
+            try:
+                out = _read_native(_plan_segments(filename,hdu,plan,
+                                                  range(len(field)),
+                                                  4*nworkers),
+                                   shape,ndtype,nworkers)
+            except (IOError,ValueError):
+                plan = None
+        if plan is not None and ndtype is not None:
+            if verbose:
+                print 'NSIDE = %d'%nside
+                print 'ORDERING = %s in fits file'%ordering
+            _finish_native(out,filename,plan,nest,verbose)
+            if len(field) == 1:
+                return out[0]
+            else:
+                return tuple(out)
 
-    for ff in field:
-        m=hdulist[hdu].data.field(ff).astype(dtype).ravel()
-        if (not pixelfunc.isnpixok(m.size) or (sz>0 and sz != m.size)) and verbose:
-            print 'nside=%d, sz=%d, m.size=%d'%(nside,sz,m.size)
-            raise ValueError('Wrong nside parameter.')
-        if nest != None: # no conversion with None
-            if nest and ordering == 'RING':
-                idx = pixelfunc.nest2ring(nside,npy.arange(m.size,dtype=npy.int32))
-                m = m[idx]
-                if verbose: print 'Ordering converted to NEST'
-            elif (not nest) and ordering == 'NESTED':
-                idx = pixelfunc.ring2nest(nside,npy.arange(m.size,dtype=npy.int32))
-                m = m[idx]
-                if verbose: print 'Ordering converted to RING'
+    hdulist=pyf.open(filename)
+    try:
+        header = hdulist[hdu].header
+        nside = header.get('NSIDE')
+        if nside is None:
+            warnings.warn("No NSIDE in the header file : will use length of array",
+                          HealpixFitsWarning)
+        else:
+            nside = int(nside)
+            if verbose: print 'NSIDE = %d'%nside
+            if not pixelfunc.isnsideok(nside):
+                raise ValueError('Wrong nside parameter.')
+        ordering = header.get('ORDERING','UNDEF').strip()
+        if ordering == 'UNDEF':
+            ordering = (nest and 'NESTED' or 'RING')
+            warnings.warn("No ORDERING keyword in header file : "
+                          "assume %s"%ordering)
+        if verbose: print 'ORDERING = %s in fits file'%ordering
+
+        ret = []
+
+        explicit = header.get('INDXSCHM','IMPLICIT').strip() == 'EXPLICIT'
+        if explicit:
+            if nside is None:
+                raise ValueError('NSIDE is required to read a cut sky file')
+            cols = hdulist[hdu].columns
+            names = [n.upper() for n in cols.names]
+            ipixcol = names.index('PIXEL') if 'PIXEL' in names else 0
+            valcols = [n for i,n in enumerate(cols.names) if i != ipixcol]
+            explicit_pix = npy.asarray(hdulist[hdu].data.field(ipixcol)).ravel()
+
+        if pixels is not None:
+            filepix = _file_pixels(pixels,nside,ordering,nest)
+
+        compressed = isinstance(hdulist[hdu],pyf.CompImageHDU)
+        if compressed:
+            cdata = hdulist[hdu].data
+            if cdata.ndim == 2:
+                cdata = cdata[npy.newaxis]
+            cbad = None
+            if (len(hdulist) > hdu+1 and
+                hdulist[hdu+1].header.get('EXTNAME','').strip() == 'BADPIX'):
+                cbad = hdulist[hdu+1].data.astype(bool)
+                if cbad.ndim == 2:
+                    cbad = cbad[npy.newaxis]
+
+        for ff in field:
+            if compressed:
+                m = npy.asarray(cdata[ff].ravel(),dtype=dtype or npy.float64)
+                if cbad is not None:
+                    m[cbad[ff].ravel()] = UNSEEN
+                if pixels is not None:
+                    m = m[filepix]
+            elif explicit:
+                if not isinstance(ff,basestring):
+                    ff = valcols[ff]
+                m = npy.empty(pixelfunc.nside2npix(nside),
+                              dtype=dtype or npy.float64)
+                m.fill(UNSEEN)
+                m[explicit_pix] = hdulist[hdu].data.field(ff).ravel()
+                if pixels is not None:
+                    m = m[filepix]
+            elif pixels is not None:
+                m = _read_column_pixels(filename,hdulist,hdu,ff,filepix)
+                if dtype is not None or not memmap:
+                    m = npy.asarray(m,dtype=dtype or npy.float64)
+            elif memmap:
+                m = _map_column(filename,hdulist,hdu,ff)
+                if dtype is not None:
+                    m = npy.asarray(m,dtype=dtype)
+            else:
+                m = npy.asarray(hdulist[hdu].data.field(ff).ravel(),
+                                dtype=dtype or npy.float64)
+            if pixels is None:
+                if nside is None:
+                    nside = pixelfunc.npix2nside(m.size)
+                sz=pixelfunc.nside2npix(nside)
+                if (not pixelfunc.isnpixok(m.size) or (sz>0 and sz != m.size)) and verbose:
+                    print 'nside=%d, sz=%d, m.size=%d'%(nside,sz,m.size)
+                    raise ValueError('Wrong nside parameter.')
+            if pixels is None:
+                m = _convert_ordering(m,nside,ordering,nest,verbose)
+            if not memmap or explicit or compressed:
+                try:
+                    m[pixelfunc.mask_bad(m)] = UNSEEN
+                except OverflowError, e:
+                    pass
+            ret.append(m)
+        if h:
+            ret.append(header.items())
+    finally:
+        hdulist.close()
+
+    if len(ret) == 1:
+        return ret[0]
+    else:
+        return tuple(ret)
+
+def read_maps(filenames,fields=0,dtype=npy.float64,nest=False,hdu=1,
+              nthreads=None,out=None):
+    """Read healpix maps from several fits files concurrently, into a
+    single (nfiles*nfields, npix) array.
+
+    Input:
+      - filenames: a sequence of fits file names. All the maps must have
+                   the same nside.
+    Parameters:
+      - fields: the column(s) to read in each file, see read_map. Default: 0
+      - dtype: the type of the output array. Default: npy.float64
+      - nest=False: if True return the maps in NEST ordering, otherwise in
+                    RING ordering; if None, no conversion is performed
+      - hdu=1: the header number to look at (start at 0)
+      - nthreads: the number of threads (or worker processes, see below)
+                  reading the files. Default: the number of cpus
+      - out: an optional C contiguous array of the right shape and type
+             to read into
+    Return:
+      - the array of maps, with the fields of the first file first
+    The files are read with the native reader, directly into the rows of
+    the output array. Threads only overlap the reads if cfitsio is
+    thread-safe: otherwise a thread pool would read the files one after the
+    other, so nthreads is the number of worker processes instead (new python
+    processes, as in SHTPool, kept for the next reads). They read straight
+    into the returned array, which is then mapped in memory onto a file;
+    with out given, or for reads smaller than 128 MB (which would be slowed
+    down by the workers), the files are read in the calling process.
+    Files which cannot be read natively (cut sky files for example) are
+    read with read_map, one after the other.
+    """
+    if isinstance(filenames,basestring):
+        filenames = [filenames]
+    if not hasattr(fields, '__len__') or isinstance(fields,basestring):
+        fields = (fields,)
+    nf = len(fields)
+    shared = out is None
+    if shared:
+        nside = None
         try:
-            m[pixelfunc.mask_bad(m)] = UNSEEN
-        except OverflowError, e:
+            nside = hfitslib._table_info(filenames[0],hdu,['NSIDE'])[4][0]
+        except IOError:
             pass
+        if nside is None:
+            nside = pyf.getheader(filenames[0],hdu).get('NSIDE')
+        if nside is None:
+            nside = pixelfunc.npix2nside(
+                read_map(filenames[0],field=fields[0],nest=None,hdu=hdu).size)
+        shape = (len(filenames)*nf,pixelfunc.nside2npix(int(nside)))
+        nbytes = npy.prod(shape)*npy.dtype(dtype).itemsize
+    elif out.shape[0] != len(filenames)*nf or not out.flags.c_contiguous:
+        raise ValueError('out must be a C contiguous array with '
+                         'nfiles*nfields rows')
+    else:
+        shape = out.shape
+        nbytes = out.nbytes
+    npix = shape[1]
+
+    nworkers = _nworkers(nthreads,nbytes)
+    plans = []
+    segments = []
+    for i,fn in enumerate(filenames):
+        plan = None
+        if _native_dtype(dtype if shared else out.dtype) is not None:
+            plan = _native_map_plan(fn,fields,hdu)
+        if plan is not None:
+            if pixelfunc.nside2npix(plan[0]) != npix:
+                raise ValueError('%s: wrong number of pixels (%d instead '
+                                 'of %d)'%(fn,pixelfunc.nside2npix(plan[0]),
+                                           npix))
+            # compressed maps are split so that every worker gets some
+            nblocks = -(-nworkers//len(filenames))
+            segments += _plan_segments(fn,hdu,plan,range(i*nf,(i+1)*nf),
+                                       nblocks)
+        plans.append(plan)
+    if shared:
+        out = _read_native(segments,shape,dtype,nworkers)
+    else:
+        _read_segments(segments,out,nworkers)
+
+    for i,(fn,plan) in enumerate(zip(filenames,plans)):
+        block = out[i*nf:(i+1)*nf]
+        if plan is not None:
+            _finish_native(block,fn,plan,nest)
+            continue
+        maps = read_map(fn,field=fields,dtype=out.dtype,nest=nest,hdu=hdu)
+        if nf == 1:
+            maps = (maps,)
+        for row,m in zip(block,maps):
+            if m.size != npix:
+                raise ValueError('%s: wrong number of pixels (%d instead '
+                                 'of %d)'%(fn,m.size,npix))
+            row[:] = m
+    return out
+
+def _read_map_hpx(filename,field,dtype,nest,h,verbose,memmap,pixels):
+    """Read maps from a healpy binary file, as read_map.
+    """
+    data, info = hpxfunc.read_hpx(filename,memmap=True,h=True)
+    if info['kind'] != 'map':
+        raise ValueError('%s does not hold healpix maps'%filename)
+    if data.ndim == 1:
+        data = data[npy.newaxis]
+    nside, ordering = info['nside'], info['ordering']
+    if verbose:
+        print 'NSIDE = %d'%nside
+        print 'ORDERING = %s in file'%ordering
+    if pixels is not None:
+        filepix = _file_pixels(pixels,nside,ordering,nest)
+    ret = []
+    for ff in field:
+        if isinstance(ff,basestring):
+            raise ValueError('The maps of healpy binary files have no names')
+        m = data[ff]
+        if pixels is not None:
+            m = m[filepix]
+            if dtype is not None or not memmap:
+                m = npy.asarray(m,dtype=dtype or npy.float64)
+        elif memmap:
+            if dtype is not None:
+                m = npy.asarray(m,dtype=dtype)
+            m = _convert_ordering(m,nside,ordering,nest,verbose)
+        else:
+            m = npy.array(m,dtype=dtype or npy.float64)
+            m = _convert_ordering(m,nside,ordering,nest,verbose)
+        if not memmap:
+            try:
+                m[pixelfunc.mask_bad(m)] = UNSEEN
+            except OverflowError, e:
+                pass
         ret.append(m)
-    
+    if h:
+        header = [('NSIDE',nside),('ORDERING',ordering)]
+        if info['coord']:
+            header.append(('COORDSYS',info['coord']))
+        if info['units']:
+            header += [('TUNIT%d'%(i+1),info['units'])
+                       for i in range(len(field))]
+        ret.append(header)
     if len(ret) == 1:
-        if h:
-            return ret[0],hdulist[hdu].header.items()
-        else:
-            return ret[0]
+        return ret[0]
     else:
-        if h:
-            ret.append(hdulist[hdu].header.items())
-            return tuple(ret)
+        return tuple(ret)
+
+def _file_pixels(pixels,nside,ordering,nest):
+    """Convert pixel indices in the ordering selected by nest to the
+    ordering of a file.
+    """
+    filepix = npy.asarray(pixels)
+    if nest != None and (bool(nest) != (ordering == 'NESTED')):
+        if nside is None:
+            raise ValueError('NSIDE is required to convert pixels '
+                             'to %s ordering'%ordering)
+        if nest:
+            filepix = pixelfunc.nest2ring(nside,filepix)
         else:
-            return tuple(ret)
+            filepix = pixelfunc.ring2nest(nside,filepix)
+    return filepix
+
+def _convert_ordering(m,nside,ordering,nest,verbose=False):
+    """Return the map m (stored with the given ordering) in NEST ordering
+    if nest is True, RING if False, unchanged if None.
+    """
+    if nest != None: # no conversion with None
+        if nest and ordering == 'RING':
+            idx = pixelfunc.nest2ring(nside,npy.arange(m.size,dtype=npy.int32))
+            m = m[idx]
+            if verbose: print 'Ordering converted to NEST'
+        elif (not nest) and ordering == 'NESTED':
+            idx = pixelfunc.ring2nest(nside,npy.arange(m.size,dtype=npy.int32))
+            m = m[idx]
+            if verbose: print 'Ordering converted to RING'
+    return m
+
+def read_map_info(filename,hdu=1):
+    """Return the description of an healpix map file, from its headers
+    only (no data is read, and pyfits is not used).
+
+    Input:
+      - filename: the fits file name
+    Parameters:
+      - hdu=1: the header number to look at (start at 0)
+    Return:
+      - a dictionary with the keys:
+        nside, ordering, coordsys, indxschm (None when missing from the header),
+        columns (list of (name, dtype, repeat), dtype being the big-endian
+        numpy type stored on disk), column_offsets (offset of each column in
+        a row, in bytes), nrows, rowsize (in bytes), data_offset (offset of
+        the table data in the file, in bytes), compressed (True for tile
+        compressed maps, see write_map) and header (dictionary of all the
+        keywords of the extension)
+    """
+    f = open(filename,'rb')
+    try:
+        for i in range(hdu):
+            header, offset = _read_fits_header(f)
+            f.seek(offset + _fits_data_size(header))
+        header, offset = _read_fits_header(f)
+    finally:
+        f.close()
+    columns = []
+    column_offsets = []
+    rowoffset = 0
+    for i in range(header.get('TFIELDS',0)):
+        fmt = str(header.get('TFORM%d'%(i+1),'')).strip().upper()
+        code = fmt.lstrip('0123456789')[:1]
+        repeat = int(fmt[:len(fmt)-len(fmt.lstrip('0123456789'))] or 1)
+        columns.append((header.get('TTYPE%d'%(i+1),'COLUMN%d'%(i+1)),
+                        _fits_bintable_types.get(code,code),repeat))
+        column_offsets.append(rowoffset)
+        rowoffset += repeat*_fits_format_sizes.get(code,0)
+    nside = header.get('NSIDE')
+    ordering = header.get('ORDERING')
+    return {'nside': nside is not None and int(nside) or None,
+            'ordering': ordering and ordering.strip() or None,
+            'coordsys': header.get('COORDSYS'),
+            'indxschm': header.get('INDXSCHM'),
+            'columns': columns,
+            'column_offsets': column_offsets,
+            'nrows': header.get('NAXIS2'),
+            'rowsize': header.get('NAXIS1'),
+            'data_offset': offset,
+            'compressed': bool(header.get('ZIMAGE',False)),
+            'header': header}
+
+# size in bytes of the FITS binary table formats
+_fits_format_sizes = {'L':1, 'X':1, 'B':1, 'I':2, 'J':4, 'K':8, 'A':1,
+                      'E':4, 'D':8, 'C':8, 'M':16, 'P':8, 'Q':16}
+
+def _read_fits_header(f):
+    """Read a FITS header from the current position of the file f.
 
+    Return a dictionary of the keywords and the offset of the data.
+    """
+    header = {}
+    while True:
+        block = f.read(2880)
+        if len(block) < 2880:
+            raise IOError('Truncated FITS file or missing HDU')
+        for i in range(0,2880,80):
+            card = block[i:i+80]
+            key = card[:8].strip()
+            if key == 'END':
+                return header, f.tell()
+            if card[8:10] != '= ':
+                continue
+            header[key] = _parse_fits_value(card[10:])
+
+def _parse_fits_value(v):
+    """Convert the value field of a FITS card to a python value.
+    """
+    v = v.strip()
+    if v.startswith("'"):
+        # string: quotes are escaped by doubling them
+        res = []
+        i = 1
+        while i < len(v):
+            if v[i] == "'":
+                if v[i+1:i+2] == "'":
+                    res.append("'")
+                    i += 2
+                    continue
+                break
+            res.append(v[i])
+            i += 1
+        return ''.join(res).rstrip()
+    v = v.split('/')[0].strip()
+    if v == 'T':
+        return True
+    if v == 'F':
+        return False
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    try:
+        return float(v.replace('D','E'))
+    except ValueError:
+        return v
+
+def _fits_data_size(header):
+    """Return the size, padded to a whole number of blocks, of the data
+    described by a FITS header.
+    """
+    naxis = header.get('NAXIS',0)
+    if naxis == 0:
+        return 0
+    size = 1
+    for i in range(naxis):
+        size *= header.get('NAXIS%d'%(i+1),0)
+    size = (abs(header.get('BITPIX',8))//8 * header.get('GCOUNT',1)
+            * (header.get('PCOUNT',0) + size))
+    return (size + 2879)//2880*2880
+
+def read_map_region(filename,nside_region,ipix_region,field=0,dtype=None,
+                    hdu=1,verbose=False):
+    """Read the part of an healpix map covered by some pixels of a coarser
+    resolution, i.e. one or several NEST sub-trees.
+
+    Input:
+      - filename: the fits file name
+      - nside_region: the nside of the region pixels
+      - ipix_region: the NEST index (or array of indices) of the region pixels
+    Parameters:
+      - field, dtype, hdu, verbose: see read_map
+    Return:
+      - the NEST pixel indices (at the map nside) of the region, followed by
+        the map values (one array per field)
+    """
+    hdr = pyf.getheader(filename,hdu)
+    nside = int(hdr['NSIDE'])
+    if not pixelfunc.isnsideok(nside_region) or nside_region > nside:
+        raise ValueError('Wrong nside_region parameter.')
+    nsub = (nside//nside_region)**2
+    ipix_region = npy.atleast_1d(npy.asarray(ipix_region,dtype=npy.int64))
+    pixels = (ipix_region[:,npy.newaxis]*nsub
+              + npy.arange(nsub,dtype=npy.int64)).ravel()
+    m = read_map(filename,field=field,dtype=dtype,nest=True,hdu=hdu,
+                 verbose=verbose,pixels=pixels)
+    if isinstance(m,tuple):
+        return (pixels,)+m
+    return pixels,m
+
+## Native (cfitsio) readers and writers. They return None or False when
+## they cannot handle a file, the callers then fall back to pyfits.
+
+# numpy types which can be read or written by the native functions
+_native_types = [npy.dtype(t) for t in (npy.float32,npy.float64,npy.int8,
+                                        npy.uint8,npy.int16,npy.int32,
+                                        npy.int64,npy.bool)]
+
+def _native_dtype(t):
+    """Return the numpy dtype t if it can be used by the native functions,
+    None otherwise.
+    """
+    if t is None or (isinstance(t,basestring) and not t):
+        return None
+    try:
+        t = npy.dtype(t)
+    except TypeError:
+        return None
+    if t.isnative and t in _native_types:
+        return t
+    return None
+
+def _column_number(names,field):
+    """Return the index of field (column number or name) in names.
+    """
+    if isinstance(field,basestring):
+        return [n.upper() for n in names].index(field.upper())
+    if field < 0 or field >= len(names):
+        raise IndexError('No column %d in the table'%field)
+    return field
+
+def _read_columns_native(filename,hdu,fields,dtype=None):
+    """Read whole binary table columns with cfitsio.
+
+    Return a list of arrays (with the type of the columns if dtype is
+    None), or None if the table cannot be read natively.
+    """
+    try:
+        hdutype,names,types,nelems,values = hfitslib._table_info(filename,
+                                                                 hdu,[])
+        if hdutype != 'BINTABLE':
+            return None
+        colnums = [_column_number(names,ff) for ff in fields]
+        dtypes = [_native_dtype(dtype or types[c]) for c in colnums]
+        if None in dtypes:
+            return None
+        out = [npy.empty(nelems[c],dtype=t) for c,t in zip(colnums,dtypes)]
+        hfitslib._read_columns(filename,hdu,colnums,out)
+    except (IOError,ValueError,IndexError):
+        return None
+    return out
+
+def _native_map_plan(filename,field,hdu):
+    """Describe how the map fields can be read natively.
+
+    Return (nside, ordering, kind, args, badhdu), with kind 'columns' for
+    binary tables (args being the column numbers) or 'image' for tile
+    compressed maps (args being the offsets of the maps in the image, and
+    badhdu the BADPIX extension or None), or None if the maps cannot be
+    read natively (cut sky or unusual files).
+    """
+    try:
+        hdutype,names,types,nelems,values = hfitslib._table_info(
+            filename,hdu,['NSIDE','ORDERING','INDXSCHM','ZNAXIS','ZNAXIS1',
+                          'ZNAXIS2','ZNAXIS3'])
+        if None in values[:2]:
+            return None
+        nside = int(values[0])
+        ordering = values[1].strip()
+        if not pixelfunc.isnsideok(nside):
+            return None
+        npix = pixelfunc.nside2npix(nside)
+        if hdutype == 'BINTABLE':
+            if (values[2] or 'IMPLICIT').strip() != 'IMPLICIT':
+                return None
+            colnums = [_column_number(names,ff) for ff in field]
+            if [nelems[c] for c in colnums] != [npix]*len(colnums):
+                return None
+            return nside, ordering, 'columns', colnums, None
+        if hdutype == 'COMPRESSED' and values[3] is not None:
+            dims = [int(v or 1) for v in values[4:4+int(values[3])]]
+            if dims[0]*dims[1] != npix:
+                return None
+            nmaps = int(npy.prod(dims[2:]))
+            if [ff for ff in field if isinstance(ff,basestring)
+                or not 0 <= ff < nmaps]:
+                return None
+            badhdu = None
+            try:
+                extname = hfitslib._table_info(filename,hdu+1,['EXTNAME'])[4][0]
+                if (extname or '').strip() == 'BADPIX':
+                    badhdu = hdu+1
+            except IOError:
+                pass
+            return nside, ordering, 'image', [ff*npix for ff in field], badhdu
+    except (IOError,ValueError,IndexError):
+        pass
+    return None
+
+def _plan_segments(filename,hdu,plan,rows,nblocks=1):
+    """Return the segments reading the maps described by plan (see
+    _native_map_plan) into the given rows of an output array, split in
+    nblocks blocks of whole tiles for compressed maps.
+    """
+    nside,ordering,kind,args,badhdu = plan
+    npix = pixelfunc.nside2npix(nside)
+    if kind == 'columns':
+        return [(list(rows),kind,filename,hdu,args,0,npix)]
+    step = -(-npix//max(1,nblocks))
+    step = -(-step//1024)*1024
+    return [(list(rows),kind,filename,hdu,args,a,min(a+step,npix))
+            for a in xrange(0,npix,step)]
+
+def _finish_native(block,filename,plan,nest,verbose=False):
+    """Restore the bad pixels of maps read natively (in the rows of
+    block) and convert their ordering, in place.
+    """
+    nside,ordering,kind,args,badhdu = plan
+    for row,arg in zip(block,args):
+        if badhdu is not None:
+            bad = npy.empty(row.size,dtype=npy.int16)
+            hfitslib._read_image(filename,badhdu,bad,arg)
+            try:
+                row[bad != 0] = UNSEEN
+            except OverflowError, e:
+                pass
+        row[:] = _convert_ordering(row,nside,ordering,nest,verbose)
+        try:
+            row[pixelfunc.mask_bad(row)] = UNSEEN
+        except OverflowError, e:
+            pass
+
+# Native reads are described by segments (rows, kind, filename, hdu, args,
+# start, stop): the elements start:stop of the table columns args (kind
+# 'columns') or of the maps starting at the offsets args in an image (kind
+# 'image') are read into out[rows,start:stop].
+def _read_segment(out,seg):
+    rows,kind,filename,hdu,args,start,stop = seg
+    bufs = [out[r,start:stop] for r in rows]
+    if kind == 'columns':
+        hfitslib._read_columns(filename,hdu,args,bufs,start)
+    else:
+        for buf,arg in zip(bufs,args):
+            hfitslib._read_image(filename,hdu,buf,arg+start)
+
+# When cfitsio is not thread-safe, reads smaller than this (in bytes) are
+# done in the calling process: starting worker processes would cost more
+# than it saves
+_min_worker_bytes = 128*2**20
+
+def _nworkers(nthreads,nbytes):
+    """Return the number of threads or worker processes to use for a
+    native read of nbytes bytes.
+    """
+    if not hfitslib._is_reentrant() and nbytes < _min_worker_bytes:
+        return 1
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+    return max(1,nthreads)
+
+def _read_segments(segments,out,nworkers=1):
+    """Do the native reads of segments into the C contiguous array out, in
+    the calling process.
+
+    With nworkers > 1, the segments are shared out among a pool of threads
+    if cfitsio is thread-safe (the GIL is then released during the reads).
+    Otherwise threads would read one after the other, so the segments are
+    read serially.
+    """
+    nworkers = max(1,min(nworkers,len(segments)))
+    if nworkers == 1 or not hfitslib._is_reentrant():
+        for seg in segments:
+            _read_segment(out,seg)
+    else:
+        pool = ThreadPool(nworkers)
+        try:
+            pool.map(lambda seg: _read_segment(out,seg),segments)
+        finally:
+            pool.close()
+            pool.join()
+
+# The worker processes of _read_native, started on first use and kept for
+# the next reads
+_read_pool = None
+_read_pool_lock = threading.Lock()
+
+def _close_read_pool():
+    global _read_pool
+    if _read_pool is not None:
+        _read_pool.close()
+        _read_pool = None
+
+atexit.register(_close_read_pool)
+
+def _read_native(segments,shape,dtype,nworkers=1):
+    """Return a new array of the given shape and type, filled by the native
+    reads of segments.
+
+    If cfitsio is not thread-safe and nworkers > 1, the segments are shared
+    out among nworkers worker processes (see _workers), which read straight
+    into the returned array: it is mapped in memory onto a file of the pool
+    directory, removed once the reads are done. Otherwise, see
+    _read_segments.
+    """
+    global _read_pool
+    nworkers = max(1,min(nworkers,len(segments)))
+    if nworkers == 1 or hfitslib._is_reentrant():
+        out = npy.empty(shape,dtype=dtype)
+        _read_segments(segments,out,nworkers)
+        return out
+    _read_pool_lock.acquire()
+    try:
+        if _read_pool is None or _read_pool.nproc < nworkers:
+            _close_read_pool()
+            _read_pool = _workers.WorkerPool('healpy.fitsfunc._read_worker',
+                                             nworkers,name='read')
+        fd,fname = tempfile.mkstemp(prefix='map',dir=_read_pool.dir)
+        os.close(fd)
+        try:
+            out = npy.memmap(fname,dtype=dtype,mode='w+',shape=shape)
+            dtype = out.dtype.str
+            try:
+                _read_pool.call([(fname,shape,dtype,segments[k::nworkers])
+                                 for k in xrange(nworkers)])
+            except RuntimeError, e:
+                raise IOError(str(e))
+        finally:
+            os.remove(fname)
+    finally:
+        _read_pool_lock.release()
+    # the mapping stays valid after the file is removed
+    return out.view(npy.ndarray)
+
+# Main function of the worker processes of _read_native: each command is
+# the output file, its shape and type, and the segments to read into it
+def _read_worker():
+    def handle(cmd):
+        fname,shape,dtype,segments = cmd
+        out = npy.memmap(fname,dtype=dtype,mode='r+',shape=shape)
+        for seg in segments:
+            _read_segment(out,seg)
+        out.flush()
+    _workers.serve(handle)
+
+def _write_columns_native(filename,names,arrays,formats,repeats,keys,
+                          units=None,dtype=None):
+    """Write arrays as binary table columns with cfitsio.
+
+    Return False if the arrays cannot be written natively.
+    """
+    if [f for f in formats if f not in 'BIJKEDL']:
+        return False
+    conv = []
+    for a in arrays:
+        a = npy.asarray(a)
+        if _native_dtype(a.dtype) is None:
+            if dtype is None or _native_dtype(dtype) is None:
+                return False
+            a = a.astype(dtype)
+        conv.append(npy.ascontiguousarray(a).ravel())
+    if units is None:
+        units = ['']*len(names)
+    if os.path.exists(filename):
+        os.remove(filename)
+    try:
+        hfitslib._write_columns(filename,names,conv,formats,repeats,units,
+                                keys,'xtension')
+    except IOError:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return False
+    return True
+
+def _write_map_native(filename,m,nest,dtype,fits_IDL,coord=None,units=None):
+    """Write healpix map(s) with cfitsio. Return False if not possible.
+    """
+    if hasattr(m[0], '__len__'):
+        if len(m) != 3 or len(m[1]) != len(m[0]) or len(m[2]) != len(m[0]):
+            raise ValueError("You should give 3 maps of same size "
+                             "for polarisation...")
+        maps = m
+        colnames=['I_STOKES','Q_STOKES','U_STOKES']
+    else:
+        maps = [m]
+        colnames=['I_STOKES']
+    nside = pixelfunc.npix2nside(len(maps[0]))
+    if nside < 0:
+        raise ValueError('Invalid healpix map : wrong number of pixel')
+    npix = pixelfunc.nside2npix(nside)
+    if npix > 1024 and fits_IDL:
+        repeat = 1024
+    else:
+        repeat = 1
+    fitsformat = getformat(dtype)
+    return _write_columns_native(filename,colnames,maps,
+                                 [fitsformat]*len(maps),[repeat]*len(maps),
+                                 _healpix_keys(nside,nest,coord=coord),
+                                 units=_map_units(units,len(maps)),
+                                 dtype=dtype)
+
+# FITS binary table type codes and their (big-endian) numpy types
+_fits_bintable_types = {'L':'i1', 'B':'u1', 'I':'>i2', 'J':'>i4',
+                        'K':'>i8', 'E':'>f4', 'D':'>f8'}
+
+def _column_layout(hdulist,hdu,field):
+    """Return the on-disk layout of a binary table column as a tuple
+    (dtype, offset in row, repeat, row size, number of rows, data offset),
+    or None if the column must be decoded by pyfits (scaled columns...).
+    """
+    tbhdu = hdulist[hdu]
+    if not isinstance(tbhdu,pyf.BinTableHDU):
+        raise TypeError('Expected a binary table extension')
+    cols = tbhdu.columns
+    names = [n.upper() for n in cols.names]
+    if isinstance(field,basestring):
+        k = names.index(field.upper())
+    else:
+        k = int(field)
+    col = cols[k]
+    fmt = str(col.format).strip().upper()
+    code = fmt.lstrip('0123456789')
+    repeat = int(fmt[:len(fmt)-len(code)] or 1)
+    if (code not in _fits_bintable_types or col.bscale not in (None,1)
+        or col.bzero not in (None,0)):
+        return None
+    dt = npy.dtype(_fits_bintable_types[code])
+    offset = cols.dtype.fields[cols.names[k]][1]
+    return (dt, offset, repeat, tbhdu.header['NAXIS1'], tbhdu.header['NAXIS2'],
+            hdulist.fileinfo(hdu)['datLoc'])
+
+def _map_column(filename,hdulist,hdu,field):
+    """Return a read-only, flat view of a binary table column mapped
+    directly onto the file. The column is only copied if it is interleaved
+    with other columns or needs scaling.
+    """
+    layout = _column_layout(hdulist,hdu,field)
+    if layout is None:
+        # scaled or exotic column: let pyfits decode it
+        return npy.asarray(hdulist[hdu].data.field(field)).ravel()
+    dt, offset, repeat, rowsize, nrows, datloc = layout
+    if rowsize == repeat*dt.itemsize:
+        m = npy.memmap(filename,dtype=dt,mode='r',offset=datloc,
+                       shape=(nrows*repeat,))
+    else:
+        rows = npy.memmap(filename,dtype=npy.uint8,mode='r',offset=datloc,
+                          shape=(nrows,rowsize))
+        m = rows[:,offset:offset+repeat*dt.itemsize].copy().view(dt).ravel()
+        m.flags.writeable = False
+    return m
+
+def _read_column_pixels(filename,hdulist,hdu,field,pixels):
+    """Return the values of a binary table column at the given (flat)
+    indices, reading only the rows which contain them.
+    """
+    pixels = npy.asarray(pixels,dtype=npy.int64)
+    layout = _column_layout(hdulist,hdu,field)
+    if layout is None:
+        return npy.asarray(hdulist[hdu].data.field(field)).ravel()[pixels]
+    dt, offset, repeat, rowsize, nrows, datloc = layout
+    if pixels.size and (pixels.min() < 0 or pixels.max() >= nrows*repeat):
+        raise ValueError('Pixel index out of range')
+    irow, ipos = divmod(pixels,repeat)
+    urows, inv = npy.unique(irow,return_inverse=True)
+    rows = npy.memmap(filename,dtype=npy.uint8,mode='r',offset=datloc,
+                      shape=(nrows,rowsize))
+    data = rows[urows,offset:offset+repeat*dt.itemsize].view(dt)
+    return data[inv,ipos]
 
 def write_alm(filename,alms,out_dtype=None,lmax=-1,mmax=-1,mmax_in=-1):
     """
@@ -227,6 +1318,8 @@ def write_alm(filename,alms,out_dtype=None,lmax=-1,mmax=-1,mmax_in=-1):
      - mmax: maximum m in the output file
      - out_dtype: data type in the output file (must be a numpy dtype)
      - mmax_in: maximum m in the input array
+    If filename ends with .hpx, the alms are written in the healpy binary
+    format instead (see hpxfunc), in the healpy layout.
     """
 
     l2max = Alm.getlmax(len(alms),mmax=mmax_in)
@@ -242,35 +1335,41 @@ def write_alm(filename,alms,out_dtype=None,lmax=-1,mmax=-1,mmax_in=-1):
         mmax = lmax
     if mmax > mmax_in:
 	mmax = mmax_in
+    if mmax > lmax:
+        mmax = lmax
 
     if (out_dtype == None):
         out_dtype = alms.real.dtype
 
-    l,m = Alm.getlm(lmax)
-    idx = npy.where((l <= lmax)*(m <= mmax))
-    l = l[idx]
-    m = m[idx]
-
-    idx_in_original = Alm.getidx(l2max, l=l, m=m)
-    
-    index = l**2 + l + m + 1
-
-    out_data = npy.empty(len(index),\
-                             dtype=[('index','i'),\
-                                        ('real',out_dtype),('imag',out_dtype)])
-    out_data['index'] = index
-    out_data['real'] = alms.real[idx_in_original]
-    out_data['imag'] = alms.imag[idx_in_original]
+    fitsidx,idx_in = hfitslib._alm2fits_index(lmax,mmax,l2max,mmax_in)
+    if _is_hpx_name(filename):
+        if lmax != l2max or mmax != mmax_in:
+            alms = alms[idx_in]
+        hpxfunc.write_hpx(filename,alms,kind='alm',lmax=lmax,mmax=mmax,
+                          dtype=npy.result_type(out_dtype,npy.complex64))
+        return
+    almr = alms.real[idx_in].astype(out_dtype)
+    almi = alms.imag[idx_in].astype(out_dtype)
+    keys = [('MAX-LPOL',lmax,'Maximum L multipole order'),
+            ('MAX-MPOL',mmax,'Maximum M multipole degree')]
 
-    cindex = pyf.Column(name="index", format=getformat(npy.int32), unit="l*l+l+m+1", array=out_data['index'])
-    creal = pyf.Column(name="real", format=getformat(out_dtype), unit="unknown", array=out_data['real'])
-    cimag = pyf.Column(name="imag", format=getformat(out_dtype), unit="unknown", array=out_data['imag'])
+    if _write_columns_native(filename,['index','real','imag'],
+                             [fitsidx,almr,almi],
+                             [getformat(npy.int32),getformat(out_dtype),
+                              getformat(out_dtype)],[1,1,1],keys,
+                             units=['l*l+l+m+1','unknown','unknown']):
+        return
+    cindex = pyf.Column(name="index", format=getformat(npy.int32), unit="l*l+l+m+1", array=fitsidx)
+    creal = pyf.Column(name="real", format=getformat(out_dtype), unit="unknown", array=almr)
+    cimag = pyf.Column(name="imag", format=getformat(out_dtype), unit="unknown", array=almi)
 
     coldefs=pyf.ColDefs([cindex,creal,cimag])
     tbhdu = pyf.new_table(coldefs)
+    for k,v,c in keys:
+        tbhdu.header.update(k,v,c)
     tbhdu.writeto(filename,clobber=True)       
     
-def read_alm(filename,hdu=1,return_mmax=False):
+def read_alm(filename,hdu=1,return_mmax=False,lmax=None,mmax=None):
     """Read alm from a fits file. In the fits file, the alm are written
     with explicit index scheme, index = l**2+l+m+1, while healpix cxx
     uses index = m*(2*lmax+1-m)/2+l. The conversion is done in this 
@@ -282,27 +1381,149 @@ def read_alm(filename,hdu=1,return_mmax=False):
     Parameters:
       - hdu: the header to read. Start at 0. Default: hdu=1
       - return_mmax: If true, both the alms and mmax is returned in a tuple. Default: return_mmax=False
+      - lmax: if given, only the alms with l <= lmax are read. Default: all
+      - mmax: if given, only the alms with m <= mmax are read. Default: all
 
     Return:
       - alms: if return_mmax=False
       - alms,mmax: if return_mmax=True
+    Healpy binary files (see write_alm) are read too (hdu is then ignored).
     """
-    idx, almr, almi = mrdfits(filename,hdu=hdu)
-    l = npy.floor(npy.sqrt(idx-1)).astype(long)
-    m = idx - l**2 - l - 1
-    if (m<0).any():
-        raise ValueError('Negative m value encountered !')
-    lmax = l.max()
-    mmax = m.max()
-    alm = almr*(0+0j)
-    i = Alm.getidx(lmax,l,m)
-    alm.real[i] = almr
-    alm.imag[i] = almi
+    if hpxfunc.ishpxfile(filename):
+        res = _read_alm_hpx(filename,lmax,mmax)
+    else:
+        res = _read_alm_native(filename,hdu,lmax,mmax)
+    if res is None:
+        idx, almr, almi = mrdfits(filename,hdu=hdu)
+        res = _alm_from_columns(idx,almr,almi,lmax,mmax)
+    alm, mmax = res
     if return_mmax:
         return alm, mmax
     else:
         return alm
 
+def _read_hpx_kind(filename,kind):
+    """Read the data of a healpy binary file, checking its kind.
+    """
+    data, info = hpxfunc.read_hpx(filename,h=True)
+    if info['kind'] != kind:
+        raise ValueError('%s does not hold %s'%(filename,kind))
+    return data
+
+def _read_alm_hpx(filename,lmax,mmax):
+    """Read alms with l <= lmax and m <= mmax from a healpy binary file.
+
+    Return (alm, mmax).
+    """
+    data, info = hpxfunc.read_hpx(filename,memmap=True,h=True)
+    if info['kind'] != 'alm':
+        raise ValueError('%s does not hold alm'%filename)
+    if data.ndim != 1:
+        raise ValueError('%s holds several alm sets'%filename)
+    flmax, fmmax = info['lmax'], info['mmax']
+    if lmax is None:
+        lmax = flmax
+    if mmax is None:
+        mmax = fmmax
+    mmax = min(mmax,lmax)
+    if lmax == flmax and mmax == fmmax:
+        return npy.array(data), mmax
+    if lmax <= flmax and mmax <= fmmax:
+        sub = hfitslib._alm2fits_index(lmax,mmax,flmax,fmmax)[1]
+        return npy.asarray(data[sub]), mmax
+    # larger than the file: pad with zeros
+    alm = npy.zeros(Alm.getsize(lmax,mmax),dtype=data.dtype)
+    sub = hfitslib._alm2fits_index(min(lmax,flmax),min(mmax,fmmax),
+                                   flmax,fmmax)[1]
+    alm[hfitslib._alm2fits_index(min(lmax,flmax),min(mmax,fmmax),
+                                 lmax,mmax)[1]] = data[sub]
+    return alm, mmax
+
+def _alm_from_columns(index,almr,almi,lmax=None,mmax=None):
+    """Put the alms of FITS columns (index, real, imag) in a healpy alm
+    array, keeping only l <= lmax and m <= mmax if given.
+
+    Return (alm, mmax).
+    """
+    if lmax is None: lmax = -1
+    if mmax is None: mmax = -1
+    idx,lmax,mmax = hfitslib._fits2alm_index(index,lmax,mmax)
+    sel = idx >= 0
+    if not sel.all():
+        idx, almr, almi = idx[sel], almr[sel], almi[sel]
+    if almr.dtype == npy.float32:
+        alm = npy.zeros(Alm.getsize(lmax,mmax),dtype=npy.complex64)
+    else:
+        alm = npy.zeros(Alm.getsize(lmax,mmax),dtype=npy.complex128)
+    alm.real[idx] = almr
+    alm.imag[idx] = almi
+    return alm, mmax
+
+def _read_alm_native(filename,hdu,lmax,mmax):
+    """Read alms with cfitsio, reading only the rows needed for lmax and
+    mmax when the layout of the file is known (from the MAX-LPOL and
+    MAX-MPOL keys, or from the number of rows).
+
+    Return (alm, mmax), or None if the file cannot be read natively.
+    """
+    try:
+        hdutype,names,types,nelems,values = hfitslib._table_info(
+            filename,hdu,['MAX-LPOL','MAX-MPOL'])
+        if hdutype != 'BINTABLE' or len(names) < 3:
+            return None
+        dtype = _native_dtype(types[1])
+        if dtype is None or dtype.kind != 'f' or _native_dtype(types[0]) is None:
+            return None
+        nrows = nelems[0]
+        if nelems[1] != nrows or nelems[2] != nrows:
+            return None
+        if None not in values:
+            flmax, fmmax = int(values[0]), int(values[1])
+        else:
+            flmax = fmmax = Alm.getlmax(nrows)
+        if flmax >= 0 and nrows == Alm.getsize(flmax,fmmax):
+            rlmax = flmax if lmax is None else lmax
+            rmmax = min(fmmax if mmax is None else mmax, rlmax)
+            if 0 <= rmmax <= fmmax and rlmax <= flmax:
+                res = _read_alm_rows(filename,hdu,dtype,flmax,fmmax,
+                                     rlmax,rmmax)
+                if res is not None:
+                    return res
+        cols = [npy.empty(nrows,dtype=t) for t in (npy.int64,dtype,dtype)]
+        hfitslib._read_columns(filename,hdu,[0,1,2],cols)
+    except (IOError,ValueError,IndexError):
+        return None
+    return _alm_from_columns(cols[0],cols[1],cols[2],lmax,mmax)
+
+def _read_alm_rows(filename,hdu,dtype,flmax,fmmax,lmax,mmax):
+    """Read the alms with l <= lmax and m <= mmax from a complete
+    (flmax, fmmax) table, written either m by m (healpy) or l by l
+    (Healpix F90). Return (alm, mmax), or None if the table is in neither
+    order.
+    """
+    size = Alm.getsize(lmax,mmax)
+    # healpy order: for each m, the rows of l = m..lmax are contiguous
+    m = npy.arange(mmax+1,dtype=npy.int64)
+    ranges = npy.empty((mmax+1,2),dtype=npy.int64)
+    ranges[:,0] = m*(2*flmax+1-m)//2+m
+    ranges[:,1] = lmax-m+1
+    cols = [npy.empty(size,dtype=t) for t in (npy.int64,dtype,dtype)]
+    hfitslib._read_columns(filename,hdu,[0,1,2],cols,ranges)
+    if (cols[0] == hfitslib._alm2fits_index(lmax,mmax)[0]).all():
+        alm = npy.empty(size,dtype=npy.complex64 if dtype == npy.float32
+                        else npy.complex128)
+        alm.real = cols[1]
+        alm.imag = cols[2]
+        return alm, mmax
+    # Healpix F90 order: the rows of l <= lmax come first
+    l = npy.arange(lmax+1,dtype=npy.int64)
+    nrows = int(npy.minimum(l,fmmax).sum()) + lmax+1
+    cols = [npy.empty(nrows,dtype=t) for t in (npy.int64,dtype,dtype)]
+    hfitslib._read_columns(filename,hdu,[0,1,2],cols)
+    if (hfitslib._fits2alm_index(cols[0],lmax,mmax)[0] >= 0).sum() != size:
+        return None
+    return _alm_from_columns(cols[0],cols[1],cols[2],lmax,mmax)
+
 ## Generic functions to read and write column of data in fits file
 
 def mrdfits(filename,hdu=1):
@@ -0,0 +1,243 @@
+#
+#  This file is part of Healpy.
+#
+#  Healpy is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Healpy is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Healpy; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+#  For more information about Healpy, see http://code.google.com/p/healpy
+#
+"""Provides a simple binary file format for Healpix maps, stacks of maps,
+alm and cl, meant for intermediate products: no byte swapping, no
+reshaping and no header parsing is needed to read it.
+
+A file (extension .hpx) is made of a header of HPX_HEADER_SIZE bytes,
+described by the little-endian numpy type hpx_header_dtype, followed by
+the data: a C ordered little-endian array of shape (nrows, ncols) (one row
+per map, alm set or spectrum) starting at the offset given in the header
+(a multiple of 64 bytes). The file can thus be read with numpy alone:
+
+  >>> h = numpy.fromfile(filename, dtype=hpx_header_dtype, count=1)[0]
+  >>> data = numpy.memmap(filename, dtype=h['dtype'], mode='r',
+  ...                     offset=h['offset'], shape=(h['nrows'],h['ncols']))
+
+The header fields are:
+  - magic: HPX_MAGIC
+  - kind: 'MAP', 'ALM' or 'CL'
+  - dtype: the numpy type string of the data ('<f4', '<c16', ...)
+  - offset: the offset of the data in the file, in bytes
+  - ndim: 1 for a single map, alm set or spectrum, 2 for a stack
+  - nrows, ncols: the shape of the data
+  - nside, ordering: the resolution and ordering ('RING' or 'NESTED') of
+    maps (-1 and '' otherwise)
+  - lmax, mmax: the maximum l and m of alm, lmax of cl (-1 otherwise)
+  - coord: the coordinate system ('G', 'E', 'C' or '')
+  - units: the physical units of the data (or '')
+"""
+
+import numpy as npy
+import pixelfunc
+from sphtfunc import Alm
+
+HPX_MAGIC = 'HEALPYB1'
+HPX_HEADER_SIZE = 256
+HPX_EXTENSION = '.hpx'
+
+hpx_header_dtype = npy.dtype([('magic','S8'),
+                              ('kind','S8'),
+                              ('dtype','S8'),
+                              ('offset','<i8'),
+                              ('ndim','<i8'),
+                              ('nrows','<i8'),
+                              ('ncols','<i8'),
+                              ('nside','<i8'),
+                              ('ordering','S8'),
+                              ('lmax','<i8'),
+                              ('mmax','<i8'),
+                              ('coord','S8'),
+                              ('units','S64'),
+                              ('reserved','V96')])
+
+_hpx_kinds = {'map':'MAP', 'alm':'ALM', 'cl':'CL'}
+
+def write_hpx(filename,data,kind='map',nest=False,lmax=None,mmax=None,
+              coord=None,units=None,dtype=None):
+    """Write a map, a stack of maps, alms or cls in a healpy binary file.
+
+    Input:
+      - filename: the file name (by convention with extension .hpx)
+      - data: an array, or a sequence of arrays of same size (one map,
+              alm set or spectrum each)
+    Parameters:
+      - kind: 'map', 'alm' or 'cl'. Default: 'map'
+      - nest: for maps, the ordering scheme. Default: False (RING)
+      - lmax, mmax: for alms, default to the values given by the size
+                    with mmax=lmax. For cls, lmax is the size minus one.
+      - coord: the coordinate system ('G', 'E' or 'C'). Default: None
+      - units: the physical units of the data. Default: None
+      - dtype: the type of the data in the file. Default: the type of data
+    """
+    if kind not in _hpx_kinds:
+        raise ValueError("kind must be one of 'map', 'alm' or 'cl'")
+    if len(data) > 0 and hasattr(data[0], '__len__'):
+        rows = [npy.asarray(d) for d in data]
+        ndim = 2
+    else:
+        rows = [npy.asarray(data)]
+        ndim = 1
+    ncols = rows[0].size
+    if [r for r in rows if r.size != ncols]:
+        raise ValueError('All the arrays must have the same size')
+    if dtype is None:
+        dtype = rows[0].dtype
+    dtype = npy.dtype(dtype).newbyteorder('<')
+    if dtype.kind not in 'biufc':
+        raise TypeError('Unsupported data type %s'%dtype)
+
+    header = npy.zeros(1,dtype=hpx_header_dtype)
+    header['magic'] = HPX_MAGIC
+    header['kind'] = _hpx_kinds[kind]
+    header['dtype'] = dtype.str
+    header['offset'] = HPX_HEADER_SIZE
+    header['ndim'] = ndim
+    header['nrows'] = len(rows)
+    header['ncols'] = ncols
+    header['nside'] = -1
+    header['lmax'] = -1
+    header['mmax'] = -1
+    if kind == 'map':
+        nside = pixelfunc.npix2nside(ncols)
+        if nside < 0:
+            raise ValueError('Invalid healpix map : wrong number of pixel')
+        header['nside'] = nside
+        header['ordering'] = nest and 'NESTED' or 'RING'
+    elif kind == 'alm':
+        if dtype.kind != 'c':
+            raise TypeError('alm must be stored with a complex type')
+        if mmax is None:
+            mmax = -1
+        if lmax is None:
+            lmax = Alm.getlmax(ncols,mmax)
+        if mmax < 0:
+            mmax = lmax
+        if lmax < 0 or Alm.getsize(lmax,mmax) != ncols:
+            raise ValueError('Wrong alm size for lmax, mmax')
+        header['lmax'] = lmax
+        header['mmax'] = mmax
+    else:
+        if lmax is None:
+            lmax = ncols-1
+        if lmax != ncols-1:
+            raise ValueError('Wrong cl size for lmax')
+        header['lmax'] = lmax
+    if coord:
+        header['coord'] = coord
+    if units:
+        if len(units) > hpx_header_dtype['units'].itemsize:
+            raise ValueError('units must have at most %d characters'%
+                             hpx_header_dtype['units'].itemsize)
+        header['units'] = units
+
+    f = open(filename,'wb')
+    try:
+        header.tofile(f)
+        for r in rows:
+            npy.ascontiguousarray(r,dtype=dtype).tofile(f)
+    finally:
+        f.close()
+
+def read_hpx_info(filename):
+    """Return the header of a healpy binary file.
+
+    Input:
+      - filename: the file name
+    Return:
+      - a dictionary with the keys:
+        kind ('map', 'alm' or 'cl'), dtype (numpy type of the data, as
+        stored in the file), offset (of the data, in bytes), shape,
+        nside, ordering, lmax, mmax, coord and units (None when not set)
+    """
+    f = open(filename,'rb')
+    try:
+        header = npy.fromfile(f,dtype=hpx_header_dtype,count=1)
+    finally:
+        f.close()
+    if len(header) < 1 or header[0]['magic'] != HPX_MAGIC:
+        raise IOError('%s is not a healpy binary file'%filename)
+    header = header[0]
+    kinds = dict((v,k) for k,v in _hpx_kinds.items())
+    if header['ndim'] == 1:
+        shape = (int(header['ncols']),)
+    else:
+        shape = (int(header['nrows']),int(header['ncols']))
+    def _opt(v):
+        if isinstance(v,basestring):
+            return v or None
+        if v < 0:
+            return None
+        return int(v)
+    return {'kind': kinds.get(header['kind'],header['kind']),
+            'dtype': npy.dtype(header['dtype']),
+            'offset': int(header['offset']),
+            'shape': shape,
+            'nside': _opt(header['nside']),
+            'ordering': _opt(header['ordering']),
+            'lmax': _opt(header['lmax']),
+            'mmax': _opt(header['mmax']),
+            'coord': _opt(header['coord']),
+            'units': _opt(header['units'])}
+
+def read_hpx(filename,memmap=False,h=False):
+    """Read the data of a healpy binary file.
+
+    Input:
+      - filename: the file name
+    Parameters:
+      - memmap: if True, return a read-only array mapped onto the file
+                (no copy at all). Default: False
+      - h: if True, return also the header (see read_hpx_info)
+    Return:
+      - an array of shape (ncols,) or (nrows, ncols) for stacks, possibly
+        with the header dictionary if h is True
+    """
+    info = read_hpx_info(filename)
+    dtype = info['dtype']
+    if memmap:
+        data = npy.memmap(filename,dtype=dtype,mode='r',
+                          offset=info['offset'],shape=info['shape'])
+    else:
+        f = open(filename,'rb')
+        try:
+            f.seek(info['offset'])
+            data = npy.fromfile(f,dtype=dtype,
+                                count=int(npy.prod(info['shape'])))
+        finally:
+            f.close()
+        data = data.reshape(info['shape'])
+        if not dtype.isnative:
+            data = data.astype(dtype.newbyteorder('='))
+    if h:
+        return data, info
+    return data
+
+def ishpxfile(filename):
+    """Return True if filename is a healpy binary file.
+    """
+    try:
+        f = open(filename,'rb')
+    except IOError:
+        return False
+    try:
+        return f.read(len(HPX_MAGIC)) == HPX_MAGIC
+    finally:
+        f.close()
@@ -215,6 +215,41 @@ def isnpixok(npix):
         nside = npy.sqrt(npix/12.)
         return isnsideok(nside)
 
+def ringinfo(nside, ring):
+    """Get information on the given rings of a map in RING scheme.
+
+    Input:
+      - nside: the nside to work with
+      - ring: the ring number (1 to 4*nside-1, can be an array)
+    Return:
+      - startpix: the index of the first pixel of the ring
+      - ringpix: the number of pixels in the ring
+      - theta: the colatitude of the ring, in radians
+      - shifted: True if the first pixel of the ring is at phi=pi/ringpix,
+                 False if it is at phi=0
+    """
+    if not isnsideok(nside):
+        raise ValueError("Given number is not a valid nside parameter "
+                         "(must be a power of 2)")
+    ring = npy.asarray(ring, dtype=npy.int64)
+    if npy.any(ring < 1) or npy.any(ring > 4*nside-1):
+        raise ValueError("Ring number must be in [1, 4*nside-1]")
+    npix = nside2npix(nside)
+    ncap = 2*nside*(nside-1)
+    south = ring > 2*nside
+    northring = npy.where(south, 4*nside-ring, ring)
+    cap = northring < nside
+    ringpix = npy.where(cap, 4*northring, 4*nside)
+    startpix = npy.where(cap, 2*northring*(northring-1),
+                         ncap+(northring-nside)*4*nside)
+    startpix = npy.where(south, npix-ringpix-startpix, startpix)
+    theta = npy.where(cap, 2*npy.arcsin(northring/(npy.sqrt(6.)*nside)),
+                      npy.arccos(npy.minimum((2*nside-northring)*8.*nside/npix,
+                                             1.)))
+    theta = npy.where(south, npy.pi-theta, theta)
+    shifted = cap | (((northring-nside) & 1) == 0)
+    return startpix, ringpix, theta, shifted
+
 def get_map_size(map):
     """Try to figure out the size of the given map :
      - if map is a dict type (explicit pixel) : use nside key if present, or
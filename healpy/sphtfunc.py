@@ -21,13 +21,34 @@ import numpy as npy
 import _healpy_sph_transform_lib as sphtlib
 import _healpy_fitsio_lib as hfitslib
 import os.path
+import tempfile
+import hashlib
+import multiprocessing
+import threading
+import Queue
+import itertools
 import pixelfunc
+import _workers
 
 pi = npy.pi
 DATAPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# Directory where the data files (pixel windows, ring weights) are also
+# stored as .npy files once read, so that later sessions do not read the
+# fits files again. If None, data files are only cached in memory.
+CACHEPATH = None
+# In-memory cache of the data files, keyed by full path
+_data_cache = {}
+# Maximum total size (in bytes) of the Wigner matrices cached by rotate_alm.
+# The matrices take about 5*lmax**3 bytes, larger ones are not cached.
+WIGNER_CACHE_SIZE = 2**28
+# Wigner d matrices used by rotate_alm, keyed by (lmax,theta)
+_wigner_cache = {}
+# AlmLayout instances, keyed by (lmax,mmax)
+_layout_cache = {}
 
 # Spherical harmonics transformation
-def anafast(m,lmax=None,mmax=None,iter=1,alm=False, use_weights=False, regression=True):
+def anafast(m,lmax=None,mmax=None,iter=1,alm=False, use_weights=False, regression=True,
+            tol=None,return_iter=False):
     """Computes the power spectrum of an Healpix map.
 
     Input:
@@ -40,10 +61,15 @@ def anafast(m,lmax=None,mmax=None,iter=1,alm=False, use_weights=False, regressio
       - alm : (boolean) whether to return alm or not (if True, both are
                returned in a tuple)
       - regression : if True, map average is removed before computing alm. Default: True.
+      - tol : if given, stop iterating as soon as the norm of the residual
+              map relative to the norm of the map is below tol (iter is then
+              the maximum number of iterations). Default: None
+      - return_iter : if True, also return the number of iterations done
     Return:
       - if alm==False: return cl or a list of cl's (TT,EE,BB,TE)
       - if alm==True: return a tuple with cl or a list of cl's and alm
                       or a list of alm's
+      - if return_iter==True, the number of iterations is appended
     """
     datapath = DATAPATH #os.path.dirname(__file__)+'/data'
     nside = _get_nside(m)
@@ -51,20 +77,30 @@ def anafast(m,lmax=None,mmax=None,iter=1,alm=False, use_weights=False, regressio
         lmax = 3*nside-1
     if mmax is None or mmax < 0 or mmax > lmax:
         mmax = lmax
-    # Check the presence of weights file
+    # Get the ring weights (raise IOError if file is missing)
+    weights = None
     if use_weights:
-        weightfile = 'weight_ring_n%05d.fits' % (nside)
-        if not os.path.isfile(datapath+'/'+weightfile):
-            raise IOError('File not found : '+datapath+'/'+weightfile)
-    clout,almout = sphtlib._map2alm(m,lmax=lmax,mmax=mmax,iter=iter,cl=True,
-                                    use_weights=use_weights,data_path=datapath,
-                                    regression=regression)
+        weights = _get_ring_weights(nside)
+    res = sphtlib._map2alm(m,lmax=lmax,mmax=mmax,iter=iter,cl=True,
+                           use_weights=use_weights,data_path=datapath,
+                           regression=regression,weights=weights,
+                           tol=tol or 0.,return_iter=return_iter)
+    if return_iter:
+        (clout,almout),niter = res
+    else:
+        clout,almout = res
+    if not return_iter:
+        if alm:
+            return (clout,almout)
+        else:
+            return clout
     if alm:
-        return (clout,almout)
+        return (clout,almout,niter)
     else:
-        return clout
+        return (clout,niter)
 
-def map2alm(m,lmax=None,mmax=None,iter=1,use_weights=False,regression=True):
+def map2alm(m,lmax=None,mmax=None,iter=1,use_weights=False,regression=True,
+            tol=None,return_iter=False):
     """Computes the alm of an Healpix map.
 
     Input:
@@ -75,8 +111,13 @@ def map2alm(m,lmax=None,mmax=None,iter=1,use_weights=False,regression=True):
       - iter : number of iteration (default: 1)
       - use_weights: whether to use ring weights or not. Default: False.
       - regression: if True, subtract map average before computing alm. Default: True.
+      - tol: if given, stop iterating as soon as the norm of the residual
+             map relative to the norm of the map is below tol (iter is then
+             the maximum number of iterations). Default: None
+      - return_iter: if True, also return the number of iterations done
     Return:
       - alm as one ndarray or a tuple of 3 ndarrays
+      - if return_iter==True, a tuple (alm, number of iterations)
     """
     datapath = DATAPATH #os.path.dirname(__file__)+'/data'
     nside = _get_nside(m)
@@ -84,17 +125,102 @@ def map2alm(m,lmax=None,mmax=None,iter=1,use_weights=False,regression=True):
         lmax = 3*nside-1
     if mmax is None or mmax < 0 or mmax > lmax:
         mmax = lmax
-    # Check the presence of weights file
+    # Get the ring weights (raise IOError if file is missing)
+    weights = None
     if use_weights:
-        weightfile = 'weight_ring_n%05d.fits' % (nside)
-        if not os.path.isfile(datapath+'/'+weightfile):
-            raise IOError('File not found : '+datapath+'/'+weightfile)
+        weights = _get_ring_weights(nside)
     alm = sphtlib._map2alm(m,lmax=lmax,mmax=mmax,cl=False,
                            iter=iter,
                            use_weights=use_weights,data_path=datapath,
-                           regression=regression)
+                           regression=regression,weights=weights,
+                           tol=tol or 0.,return_iter=return_iter)
     return alm
 
+def map2alm_stream(m,lmax=None,mmax=None,iter=1,use_weights=False,
+                   regression=True,nrings=None):
+    """Computes the alm of an Healpix map without loading it in memory.
+
+    The map is read by blocks of rings (a block of rings of the northern
+    hemisphere together with the symmetric rings of the southern
+    hemisphere), which are transformed one after the other. Only one
+    block of the map is in memory at a time, each iteration reads the
+    map again.
+
+    Input:
+      - m: a map in RING scheme (not polarized) or a sequence of 3 maps
+           (polarized). Any object which can be sliced into arrays can be
+           given, eg. a numpy.memmap or an HDF5 dataset.
+    Parameters:
+      - lmax : maximum l of the power spectrum. Default: 3*nside-1
+      - mmax : maximum m of the alm. Default: lmax
+      - iter : number of iteration (default: 1)
+      - use_weights: whether to use ring weights or not. Default: False.
+      - regression: if True, subtract map average before computing alm. Default: True.
+      - nrings: number of rings of the northern hemisphere in a block.
+                Default: nside/16
+    Return:
+      - alm as one ndarray or an array of 3 alm (polarized)
+    """
+    from pshyt import job
+    nside = _get_nside(m)
+    pol = hasattr(m[0],'__len__')
+    if lmax is None:
+        lmax = 3*nside-1
+    if mmax is None or mmax < 0 or mmax > lmax:
+        mmax = lmax
+    if nrings is None:
+        nrings = max(1,nside//16)
+    weights = None
+    if use_weights:
+        weights = _get_ring_weights(nside)
+    maps = pol and tuple(m) or (m,)
+    ncomp = len(maps)
+    chunks = _ring_chunks(nside,nrings,weights)
+    jobs = [job(nside,lmax,mmax,geom=geom,mapsize=size)
+            for size,slices,geom in chunks]
+    buf = npy.empty((ncomp,max(size for size,slices,geom in chunks)))
+    back = npy.empty_like(buf)
+    def read(size,slices):
+        # read a block of the maps into buf, with the average removed
+        b = buf[:,:size]
+        for k in xrange(ncomp):
+            i = 0
+            for p0,p1 in slices:
+                b[k,i:i+p1-p0] = maps[k][p0:p1]
+                i += p1-p0
+        b[0] -= avg
+        return b
+    def add_jobs(jb,name,i,o):
+        if ncomp == 1:
+            getattr(jb,name)(i[0],o[0])
+        else:
+            getattr(jb,name)(i,o)
+    avg = 0.
+    if regression:
+        avg = sum(read(size,slices)[0].sum() for size,slices,geom in chunks)
+        avg /= pixelfunc.nside2npix(nside)
+    alms = npy.zeros((ncomp,Alm.getsize(lmax,mmax)),dtype=npy.complex128)
+    delta = npy.empty_like(alms)
+    for jb,(size,slices,geom) in zip(jobs,chunks):
+        add_jobs(jb,'add_map2alm',read(size,slices),alms)
+        jb.execute()
+    for i in xrange(iter):
+        delta[...] = 0
+        for jb,(size,slices,geom) in zip(jobs,chunks):
+            b = read(size,slices)
+            bb = back[:,:size]
+            bb[...] = 0
+            add_jobs(jb,'add_alm2map',alms,bb)
+            jb.execute()
+            npy.subtract(b,bb,bb)
+            add_jobs(jb,'add_map2alm',bb,delta)
+            jb.execute()
+        alms += delta
+    alms[0,0] += avg*npy.sqrt(4*pi)
+    if pol:
+        return alms
+    return alms[0]
+
 
 def alm2map(alm, nside, lmax=-1, mmax=-1,pixwin=False,
             fwhm=0.0,sigma=None,degree=False,arcmin=False):
@@ -115,21 +241,32 @@ def alm2map(alm, nside, lmax=-1, mmax=-1,pixwin=False,
 
     Return: an Healpix map in RING scheme at nside.
     """
-    smoothalm(alm,fwhm=fwhm,sigma=sigma,degree=degree,arcmin=arcmin)
+    if type(alm[0]) is npy.ndarray:
+        if len(alm) != 3:
+            raise TypeError("alm must be a sequence of 3 ndarray "
+                            "or a 1D ndarray")
+        alms = alm
+    else:
+        alms = [alm]
+    # The beam and the pixel window are applied in one pass
+    sigma = _get_sigma(fwhm,sigma,degree,arcmin)
     if pixwin:
         pw=globals()['pixwin'](nside,True)
-        if type(alm[0]) is npy.ndarray:
-            if len(alm) != 3:
-                raise TypeError("alm must be a sequence of 3 ndarray "
-                                "or a 1D ndarray")
-            alm[0] = almxfl(alm[0],pw[0],inplace=True)
-            alm[1] = almxfl(alm[1],pw[1],inplace=True)
-            alm[2] = almxfl(alm[2],pw[1],inplace=True)
-        else:
-            alm = almxfl(alm,pw[0],inplace=True)
+    for i,a in enumerate(alms):
+        if sigma == 0 and not pixwin:
+            break
+        almlmax = Alm.getlmax(a.size,mmax)
+        if almlmax < 0:
+            raise TypeError('Wrong alm size for the given mmax.')
+        fl = []
+        if sigma != 0:
+            fl.append(_gauss_beam(sigma,almlmax))
+        if pixwin:
+            fl.append(pw[min(i,1)])
+        almxfl(a,fl,mmax,inplace=True)
     return sphtlib._alm2map(alm,nside,lmax=lmax,mmax=mmax)
 
-def synalm(cls, lmax=-1, mmax=-1):
+def synalm(cls, lmax=-1, mmax=-1, seed=None, stream=0, dtype=None):
     """Generate a set of alm given cl.
     The cl are given as a float array. Corresponding alm are generated.
     If lmax is not given or negative, it is assumed lmax=cl.size-1
@@ -145,47 +282,40 @@ def synalm(cls, lmax=-1, mmax=-1):
     Parameters:
       - lmax: the lmax (if <0, the largest size-1 of cls)
       - mmax: the mmax (if <0, =lmax)
+      - seed: if given, an integer seeding the random generator of the
+              alm instead of numpy.random. The alm are then drawn in
+              parallel, and are reproducible whatever the number of threads.
+      - stream: the random stream to use with seed (eg. the index of the
+                realization). Each (seed,stream) gives independent alm.
+                Default: 0
+      - dtype: the type of the alm, numpy.complex128 (default) or
+               numpy.complex64
 
     Return: a list of n alms (with n(n+1)/2 the number of input cl,
             or n=3 if there are 4 input cl).
     """
-    if not isinstance(cls[0], npy.ndarray):
-        if lmax < 0: lmax = cls.size-1
-        if mmax < 0: mmax = lmax
-        cls_list = [cls]
-        szalm = Alm.getsize(lmax,mmax)
-        alm = npy.zeros(szalm,'D')
-        alm.real = npy.random.standard_normal(szalm)
-        alm.imag = npy.random.standard_normal(szalm)
-        alms_list=[alm]
-        sphtlib._synalm(cls_list,alms_list,lmax,mmax)
-        return alm
-    # otherwise, cls must be a sequence of arrays
-    try:
-        cls_list = list(cls)
-        maxsize = 0
-        for c in cls_list:
-            if c is not None:
-                if c.size > maxsize: maxsize=c.size
-    except:
-        raise TypeError("First argument must be an array or a sequence of arrays.")
+    cls_list,maxsize = _get_cls_list(cls)
     if lmax < 0: lmax = maxsize-1
-    if mmax < 0: mmax = lmax
-    if sphtlib._getn(len(cls_list)) <= 0:
-        if len(cls_list) == 4:  # if 4 cls are given, assume TT, TE, EE, BB
-            cls_list = [cls[0], cls[1], None, cls[2], None, cls[3]]
-        else:
-            raise TypeError("The sequence of arrays must have either 4 elements "
-                            "(TT,TE,EE,BB)\n"
-                            "or n(n+1)/2 elements (some may be None)")
+    if mmax < 0 or mmax > lmax: mmax = lmax
     szalm = Alm.getsize(lmax,mmax)
-    alms_list = []
-    for i in xrange(sphtlib._getn(len(cls_list))):
-        alm = npy.zeros(szalm,'D')
-        alm.real = npy.random.standard_normal(szalm)
-        alm.imag = npy.random.standard_normal(szalm)
-        alms_list.append(alm)
-    sphtlib._synalm(cls_list, alms_list, lmax, mmax)
+    nalm = sphtlib._getn(len(cls_list))
+    if seed is None:
+        alms_list = []
+        for i in xrange(nalm):
+            alm = npy.zeros(szalm,'D')
+            alm.real = npy.random.standard_normal(szalm)
+            alm.imag = npy.random.standard_normal(szalm)
+            alms_list.append(alm)
+        sphtlib._synalm(cls_list, alms_list, lmax, mmax)
+        if dtype is not None:
+            alms_list = [alm.astype(dtype) for alm in alms_list]
+    else:
+        if not 0 <= seed < 2**64 or not 0 <= stream < 2**32:
+            raise ValueError("seed must be in [0,2**64[ and stream in [0,2**32[")
+        alms = npy.empty((nalm,szalm),dtype or npy.complex128)
+        sphtlib._synalm_rng(_get_cls_matrix(cls_list,lmax),alms,lmax,mmax,
+                            seed,stream)
+        alms_list = list(alms)
     if len(alms_list) > 1:
         return alms_list
     else:
@@ -193,7 +323,7 @@ def synalm(cls, lmax=-1, mmax=-1):
 
 def synfast(cls,nside,lmax=-1,mmax=-1,alm=False,
             pixwin=False,fwhm=0.0,sigma=None,degree=False,
-            arcmin=False):
+            arcmin=False,seed=None,stream=0):
     """Create a map(s) from cl(s).
 
     Input:
@@ -205,6 +335,8 @@ def synfast(cls,nside,lmax=-1,mmax=-1,alm=False,
       - pixwin: convolve the alm by the pixel window function. Default: False.
       - fwhm,sigma,degree,arcmin: see smoothalm. Convolve the map(s)
         by a symmetric Gaussian beam
+      - seed,stream: the random stream of the alm, see synalm.
+        Default: use numpy.random
     Output:
       - if alm==False: return a map or a tuple of maps
       - if alm==True: return a tuple of map(s) and alm(s)
@@ -213,19 +345,173 @@ def synfast(cls,nside,lmax=-1,mmax=-1,alm=False,
         raise ValueError("Wrong nside value (must be a power of two).")
     if lmax < 0:
         lmax = 3*nside-1
-    alms = synalm(cls,lmax,mmax)
+    alms = synalm(cls,lmax,mmax,seed=seed,stream=stream)
     maps = alm2map(alms,nside,lmax,mmax,pixwin=pixwin,
                    fwhm=fwhm,sigma=sigma,degree=degree,
                    arcmin=arcmin)
     if alm: return maps,alms
     else: return maps
     
+class SynfastEngine(object):
+    """Generator of random maps for Monte Carlo simulations, as synfast
+    with fixed cls, nside and beam.
+
+    What does not depend on the realization is done once: the beam and
+    the pixel window are included in the Cholesky factors of the cls, and
+    the alm and map buffers and the transform plan are reused. The alm of
+    realization i are drawn with the random stream i of the seed (see
+    synalm), so that any realization can be reproduced alone, for
+    example by another process.
+
+    Iterating over the engine yields the maps of the realizations first to
+    first+nsims-1. The yielded arrays are overwritten by the next
+    realization: copy them to keep them.
+
+    Input:
+      - cls: an array of cl or a list of cls (either 4 or 6, see synalm)
+      - nside: the nside of the maps
+    Parameters:
+      - lmax, mmax: maximum l and m for alm. Default: 3*nside-1
+      - pixwin: convolve the alm by the pixel window function. Default: False.
+      - fwhm,sigma,degree,arcmin: see smoothalm. Convolve the maps
+        by a symmetric Gaussian beam
+      - nsims: the number of realizations. Default: None (no end)
+      - seed: the seed of the random streams. Default: a random seed,
+              stored in the seed attribute
+      - first: the index of the first realization. Default: 0
+      - alm: if True, yield tuples (maps, alms). Default: False
+      - threaded: if True, the alm of the next realization are drawn by
+                  a background thread during the transform of the current
+                  one. Default: False
+    """
+    def __init__(self,cls,nside,lmax=-1,mmax=-1,pixwin=False,fwhm=0.0,
+                 sigma=None,degree=False,arcmin=False,nsims=None,seed=None,
+                 first=0,alm=False,threaded=False):
+        if not pixelfunc.isnsideok(nside):
+            raise ValueError("Wrong nside value (must be a power of two).")
+        if lmax < 0:
+            lmax = 3*nside-1
+        if mmax < 0 or mmax > lmax:
+            mmax = lmax
+        cls_list,maxsize = _get_cls_list(cls)
+        nalm = sphtlib._getn(len(cls_list))
+        if nalm not in (1,3):
+            raise TypeError("The cls must give either 1 alm (T) or "
+                            "3 alm (T,E,B)")
+        if seed is None:
+            seed = int(npy.random.randint(0,2**31))
+        self.nside = nside
+        self.lmax = lmax
+        self.mmax = mmax
+        self.nsims = nsims
+        self.seed = seed
+        self.first = first
+        self.alm = alm
+        self.threaded = threaded
+        # window function of each alm, included in the cls
+        fl = npy.ones((nalm,lmax+1))
+        sigma = _get_sigma(fwhm,sigma,degree,arcmin)
+        if sigma != 0:
+            fl *= _gauss_beam(sigma,lmax)
+        if pixwin:
+            pw = globals()['pixwin'](nside,True)
+            for k in xrange(nalm):
+                p = pw[min(k,1)][:lmax+1]
+                fl[k,:p.size] *= p
+                fl[k,p.size:] = 0.
+        self._cls = _get_cls_matrix(cls_list,lmax)
+        k = 0
+        for i in xrange(nalm):
+            for j in xrange(i,nalm):
+                self._cls[k] *= fl[i]*fl[j]
+                k += 1
+        self._plan = SHTPlan(nside,lmax,mmax,pol=(nalm == 3))
+        shape = (nalm,self._plan.nalm)
+        self._alms = [npy.empty(shape,npy.complex128)
+                      for i in xrange(threaded and 2 or 1)]
+        self._maps = self._plan._out(None,1,nalm,self._plan.npix,
+                                     npy.float64,False)
+
+    def __len__(self):
+        if self.nsims is None:
+            raise TypeError("The number of realizations is not limited")
+        return self.nsims
+
+    def __iter__(self):
+        if self.nsims is None:
+            indices = itertools.count(self.first)
+        else:
+            indices = xrange(self.first,self.first+self.nsims)
+        if not self.threaded:
+            for i in indices:
+                self._draw(i,self._alms[0])
+                yield self._transform(self._alms[0],self._maps)
+            return
+        # the background thread fills the free alm buffers
+        free = Queue.Queue()
+        ready = Queue.Queue()
+        for a in self._alms:
+            free.put(a)
+        def draw():
+            try:
+                for i in indices:
+                    a = free.get()
+                    if a is None:
+                        return
+                    self._draw(i,a)
+                    ready.put(a)
+                ready.put(None)
+            except Exception, e:
+                ready.put(e)
+        thread = threading.Thread(target=draw)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                a = ready.get()
+                if a is None:
+                    break
+                if isinstance(a,Exception):
+                    raise a
+                yield self._transform(a,self._maps)
+                free.put(a)
+        finally:
+            free.put(None)
+            thread.join()
+
+    def realization(self,i):
+        """Computes one realization, in new arrays.
+
+        Input:
+          - i: the index of the realization
+        Return:
+          - the map(s), or a tuple (maps, alms) if the alm attribute is True
+        """
+        alms = npy.empty_like(self._alms[0])
+        self._draw(i,alms)
+        maps = npy.empty_like(self._maps)
+        return self._transform(alms,maps)
+
+    def _draw(self,i,alms):
+        sphtlib._synalm_rng(self._cls,alms,self.lmax,self.mmax,self.seed,i)
+
+    def _transform(self,alms,maps):
+        if len(alms) == 1:
+            alms = alms[0]
+        self._plan.alm2map(alms,out=maps)
+        if self.alm:
+            return maps,alms
+        return maps
+
 class Alm(object):
     """This class provides some static methods for alm index computation.
     * getlm(lmax,i=None)
     * getidx(lmax,l,m)
     * getsize(lmax,mmax=-1)
     * getlmax(s,mmax=-1)
+    * lm2fits(l,m)
+    * fits2lm(index)
+    * layout(lmax,mmax=-1)
     """
     def __init__(self,lmax):
         pass
@@ -237,13 +523,12 @@ class Alm(object):
         Parameters:
         - lmax
         - i: the index. If not given, the function return l and m
-             for i=0..Alm.getsize(lmax)
+             for i=0..Alm.getsize(lmax), as read-only arrays
         """
+        l,m = Alm.layout(lmax).intlm()
         if i is None:
-            i=npy.arange(Alm.getsize(lmax))
-        m=(npy.ceil(((2*lmax+1)-npy.sqrt((2*lmax+1)**2-8*(i-lmax)))/2)).astype(int)
-        l = i-m*(2*lmax+1-m)/2
-        return (l,m)
+            return (l,m)
+        return (l[i],m[i])
 
     @staticmethod
     def getidx(lmax,l,m):
@@ -264,96 +549,214 @@ class Alm(object):
 
     @staticmethod
     def getlmax(s,mmax=-1):
+        s = int(s)
         if mmax >= 0:
-            x=(2*s+mmax**2-mmax-2)/(2*mmax+2)
-        else:
-            x=(-3+npy.sqrt(1+8*s))/2
-        if x != npy.floor(x):
+            num = 2*s+mmax**2-mmax-2
+            den = 2*mmax+2
+            if num % den != 0 or num // den < mmax:
+                return -1
+            return num // den
+        # s = (lmax+1)*(lmax+2)/2, so 8*s+1 must be an odd square
+        n = 8*s+1
+        x = int(npy.sqrt(n))
+        while x*x > n:
+            x -= 1
+        while (x+1)*(x+1) <= n:
+            x += 1
+        if x*x != n:
             return -1
-        else:
-            return int(x)
+        return (x-3)//2
+
+    @staticmethod
+    def lm2fits(l,m):
+        """Get the index l**2+l+m+1 used in FITS files from l and m.
+        """
+        l = npy.asarray(l,dtype=npy.int64)
+        return l*l+l+m+1
+
+    @staticmethod
+    def fits2lm(index):
+        """Get l and m from the index l**2+l+m+1 used in FITS files.
+        """
+        index = npy.asarray(index,dtype=npy.int64)-1
+        l = npy.sqrt(index).astype(npy.int64)
+        # fix the rounding errors of sqrt
+        l -= (l*l > index)
+        l += ((l+1)*(l+1) <= index)
+        return l,index-l*l-l
+
+    @staticmethod
+    def layout(lmax,mmax=-1):
+        """Get the AlmLayout of the alm with lmax and mmax.
+        The layouts are cached, so they are built only once.
+        """
+        if mmax<0 or mmax > lmax:
+            mmax=lmax
+        key = (lmax,mmax)
+        if key not in _layout_cache:
+            if len(_layout_cache) >= 8:
+                _layout_cache.clear()
+            _layout_cache[key] = AlmLayout(lmax,mmax)
+        return _layout_cache[key]
+
+class AlmLayout(object):
+    """The index layout of an alm array with given lmax and mmax:
+    a_lm is at index mstart[m]+l, with mstart[m] = m*(2*lmax+1-m)/2.
+    Use Alm.layout(lmax,mmax) to get a cached instance.
+
+    Attributes:
+      - lmax, mmax, size
+      - mstart: the offset of each m (array of mmax+1 int)
+      - l, m: the l and m of each index (read-only int32 arrays, built
+              when first used)
+    """
+    def __init__(self,lmax,mmax=-1):
+        if mmax<0 or mmax > lmax:
+            mmax=lmax
+        self.lmax = int(lmax)
+        self.mmax = int(mmax)
+        self.size = Alm.getsize(lmax,mmax)
+        mm = npy.arange(mmax+1)
+        self.mstart = mm*(2*lmax+1-mm)/2
+        self._l = None
+        self._m = None
+        self._intlm = None
+
+    def _build(self):
+        lmax,mmax = self.lmax,self.mmax
+        l = npy.empty(self.size,dtype=npy.int32)
+        m = npy.empty(self.size,dtype=npy.int32)
+        ell = npy.arange(lmax+1,dtype=npy.int32)
+        for mi in xrange(mmax+1):
+            i = self.mstart[mi]
+            l[i+mi:i+lmax+1] = ell[mi:]
+            m[i+mi:i+lmax+1] = mi
+        l.flags.writeable = False
+        m.flags.writeable = False
+        self._l,self._m = l,m
+
+    def get_l(self):
+        if self._l is None:
+            self._build()
+        return self._l
+    l = property(get_l,doc='The l of each index')
 
+    def get_m(self):
+        if self._m is None:
+            self._build()
+        return self._m
+    m = property(get_m,doc='The m of each index')
 
+    def intlm(self):
+        """Return l and m as read-only arrays of python int type (built
+        once, see Alm.getlm)."""
+        if self._intlm is None:
+            l = self.l.astype(int)
+            m = self.m.astype(int)
+            l.flags.writeable = False
+            m.flags.writeable = False
+            self._intlm = (l,m)
+        return self._intlm
 
-def alm2cl(alm,mmax=-1,nspec=4):
+    def getidx(self,l,m):
+        """Get the index of a_lm (l and m may be arrays)."""
+        return self.mstart[m]+l
+
+    def fits_index(self):
+        """Get the index l**2+l+m+1 used in FITS files of each alm."""
+        return Alm.lm2fits(self.l,self.m)
+
+    def fits2idx(self,index):
+        """Convert FITS indices l**2+l+m+1 to indices in this layout.
+        Raise ValueError if an index is not in this layout.
+        """
+        l,m = Alm.fits2lm(index)
+        if (m<0).any() or (l>self.lmax).any() or (m>self.mmax).any():
+            raise ValueError('Index out of the alm layout')
+        return self.mstart[m]+l
+
+def alm2cl(alm,mmax=-1,nspec=4,alm2=None):
     """Compute the auto- and cross- spectra of the given alm's
-    (either 1 alm or 3 alm).
+    (either 1 alm or 3 alm), or the cross-spectra between two sets of alm.
+
+    All the spectra are computed in one pass over the alm.
 
     Input:
-      - alm: one array or a sequence of 3 arrays of identical size
+      - alm: one array or a sequence of 3 arrays of identical size, or
+             an array of alm of any shape (the last axis runs over the alm)
     Parameters:
       - mmax: maximum m for alm(s)
       - nspec: number of spectra to return if 3 alms were given:
-        nspec==[0-6], in order TT,EE,BB,TE,TB,EB. 
+        nspec==[0-6], in order TT,EE,BB,TE,TB,EB.
+      - alm2: if given, one array or an array of alm of any shape; the
+        cross-spectra between each alm of alm and each alm of alm2 are
+        returned. Default: None
+    Return:
+      - if alm2 is None: the spectrum of alm if it is one array, the nspec
+        spectra TT,EE,BB,TE,TB,EB if it is a sequence of 3 arrays, otherwise
+        the array of the auto- and cross-spectra of shape
+        alm.shape[:-1]+alm.shape[:-1]+(lmax+1,)
+      - otherwise: the array of the cross-spectra between alm and alm2,
+        of shape alm.shape[:-1]+alm2.shape[:-1]+(lmax+1,)
     """
+    alm1 = npy.asarray(alm,dtype=npy.complex128)
     # this is the expected lmax, given mmax
-    if isinstance(alm,npy.ndarray) and alm.ndim == 1:
-        lmax = Alm.getlmax(alm.size,mmax)
-        if lmax < 0:
-            raise TypeError('Wrong alm size for the given mmax.')
-        if mmax<0:
-            mmax=lmax
-        cl_est = npy.zeros(lmax+1)
-        for l in range(lmax+1):
-            i=Alm.getidx(lmax,l,npy.arange(min(mmax,l)+1))
-            cl_est[l] = (npy.abs(alm[i[0]])**2
-                         +2.*npy.sum(npy.abs(alm[i[1:]])**2))/(2*l+1)
-        return cl_est
-    else:
-        almT,almE,almB=tuple(alm)
-        lmax = Alm.getlmax(almT.size,mmax)
-        if lmax < 0:
-            raise TypeError('Wrong alm size for the given mmax.')
-        if mmax<0:
-            mmax=lmax
-        ctt_est = npy.zeros(lmax+1)
-        cee_est = npy.zeros(lmax+1)
-        cbb_est = npy.zeros(lmax+1)
-        cte_est = npy.zeros(lmax+1)
-        ctb_est = npy.zeros(lmax+1)
-        ceb_est = npy.zeros(lmax+1)
-        for l in range(lmax+1):
-            i=Alm.getidx(lmax,l,npy.arange(min(mmax,l)+1))
-            ctt_est[l] = (npy.abs(almT[i[0]])**2
-                          +2.*npy.sum(npy.abs(almT[i[1:]])**2))/(2*l+1)
-            cee_est[l] = (npy.abs(almE[i[0]])**2
-                          +2.*npy.sum(npy.abs(almE[i[1:]])**2))/(2*l+1)
-            cbb_est[l] = (npy.abs(almB[i[0]])**2
-                          +2.*npy.sum(npy.abs(almB[i[1:]])**2))/(2*l+1)
-            cte_est[l] = (almT[i[0]]*almE[i[0]].conj()
-                          +2.*npy.sum(almT[i[1:]]*almE[i[1:]].conj()))/(2*l+1)
-            ctb_est[l] = (almT[i[0]]*almB[i[0]].conj()
-                          +2.*npy.sum(almT[i[1:]]*almB[i[1:]].conj()))/(2*l+1)
-            ceb_est[l] = (almE[i[0]]*almB[i[0]].conj()
-                          +2.*npy.sum(almE[i[1:]]*almB[i[1:]].conj()))/(2*l+1)
-        return (ctt_est,cee_est,cbb_est,cte_est,ctb_est,ceb_est)[:nspec]
-        
-    
+    lmax = Alm.getlmax(alm1.shape[-1],mmax)
+    if lmax < 0:
+        raise TypeError('Wrong alm size for the given mmax.')
+    if mmax<0:
+        mmax=lmax
+    if alm2 is not None:
+        alm2 = npy.asarray(alm2,dtype=npy.complex128)
+        if alm2.shape[-1] != alm1.shape[-1]:
+            raise ValueError('alm and alm2 must have the same size')
+        cl = sphtlib._alm2cl(alm1.reshape(-1,alm1.shape[-1]),
+                             alm2.reshape(-1,alm2.shape[-1]),lmax,mmax=mmax)
+        return cl.reshape(alm1.shape[:-1]+alm2.shape[:-1]+(lmax+1,))
+    a = alm1.reshape(-1,alm1.shape[-1])
+    cl = sphtlib._alm2cl(a,a,lmax,mmax=mmax)
+    if alm1.ndim == 1:
+        return cl[0,0]
+    elif alm1.shape[0] == 3 and alm1.ndim == 2:
+        return (cl[0,0],cl[1,1],cl[2,2],cl[0,1],cl[0,2],cl[1,2])[:nspec]
+    return cl.reshape(alm1.shape[:-1]+alm1.shape[:-1]+(lmax+1,))
+
 def almxfl(alm,fl,mmax=-1,inplace=False):
     """Multiply alm by a function of l. The function is assumed
     to be zero where not defined.
     If inplace is True, the operation is done in place. Always return
     the alm array (either a new array or the modified input array).
+
+    Input:
+      - alm: an alm array, or an array of alm of any shape (the last axis
+             runs over the alm)
+      - fl: the function of l, or a sequence of functions of l
+            (e.g. beam, pixel window, transfer function) which are all
+            applied in one pass
+    Parameters:
+      - mmax: maximum m for alm(s)
+      - inplace: if True, the alm are modified in place. Default: False
     """
+    if not inplace:
+        alm = npy.array(alm)
     # this is the expected lmax, given mmax
-    lmax = Alm.getlmax(alm.size,mmax)
+    lmax = Alm.getlmax(alm.shape[-1],mmax)
     if lmax < 0:
         raise TypeError('Wrong alm size for the given mmax.')
     if mmax<0:
         mmax=lmax
-    fl = npy.array(fl)
-    if inplace:
-        almout = alm
+    if len(fl) > 0 and hasattr(fl[0],'__len__'):
+        fls = [npy.asarray(fli) for fli in fl]
     else:
-        almout = alm.copy()
-    for l in range(lmax+1):
-        if l < fl.size:
-            a=fl[l]
-        else:
-            a=0
-        i=Alm.getidx(lmax,l,npy.arange(min(mmax,l)+1))
-        almout[i] *= a
-    return almout
+        fls = [npy.asarray(fl)]
+    # complex functions of l are allowed
+    f = npy.ones(lmax+1,dtype=npy.result_type(npy.float64,*fls))
+    for fli in fls:
+        fli = fli[:lmax+1]
+        f[:fli.size] *= fli
+        f[fli.size:] = 0.
+    alm *= f.take(Alm.layout(lmax,mmax).l)
+    return alm
 
 def smoothalm(alm,fwhm=0.0,sigma=None,degree=False,
               arcmin=False,mmax=-1,verbose=False):
@@ -373,41 +776,56 @@ def smoothalm(alm,fwhm=0.0,sigma=None,degree=False,
     Return:
       None
     """
-    if sigma is None:
-        sigma = fwhm / (2.*npy.sqrt(2.*npy.log(2.)))
-    if degree:
-        sigma *= (pi/180.)
-    elif arcmin:
-        sigma *= (pi/180./60.)
+    sigma = _get_sigma(fwhm,sigma,degree,arcmin)
     if verbose:
         print "Sigma is %f arcmin (%f rad) " %  (sigma*60*180/pi,sigma)
         print "-> fwhm is %f arcmin" % (sigma*60*180/pi*(2.*npy.sqrt(2.*npy.log(2.))))
     if type(alm[0]) == npy.ndarray:
         if len(alm) != 3:
             raise ValueError("alm must be en array or a sequence of 3 arrays")
-        retval = []
-        for a in alm:
-            lmax = Alm.getlmax(a.size,mmax)
-            if lmax < 0:
-                raise TypeError('Wrong alm size for the given '
-                                'mmax (alms[%d]).'%(a.size))
-            if mmax<0:
-                mmax=lmax
-            ell = npy.arange(lmax+1)
-            fact = npy.exp(-0.5*ell*(ell+1)*sigma**2)
-            almxfl(a,fact,mmax,inplace=True)
-        return None
+        alms = alm
     else:
-        lmax = Alm.getlmax(alm.size,mmax)
+        alms = [alm]
+    for a in alms:
+        lmax = Alm.getlmax(a.size,mmax)
         if lmax < 0:
             raise TypeError('Wrong alm size for the given '
                             'mmax (alms[%d]).'%(a.size))
-        if mmax<0:
-            mmax=lmax
-        ell = npy.arange(lmax+1)
-        fact = npy.exp(-0.5*ell*(ell+1)*sigma**2)
-        almxfl(alm,fact,mmax,inplace=True)
-        return None
+        almxfl(a,_gauss_beam(sigma,lmax),mmax,inplace=True)
+    return None
+
+def rotate_alm(alm,rot,inplace=False):
+    """Rotate alm by the rotation of a Rotator (e.g. to change their
+    coordinate system).
+
+    The Wigner d matrices of the rotation are cached (see
+    WIGNER_CACHE_SIZE), so that rotating again alm with the same lmax
+    by the same rotation only costs the phase multiplications.
+
+    Input:
+      - alm: one alm array, or a sequence of alm arrays (e.g. T,E,B), or
+             a 2D array of alm, with lmax==mmax. All alm are rotated in
+             one pass.
+      - rot: a rotator.Rotator, or a 3x3 rotation matrix
+    Parameters:
+      - inplace: if True, the rotation is done in place, and the alm must
+                 be C contiguous complex128 arrays. Default: False
+    Return:
+      - the rotated alm: the input if inplace is True, otherwise a new
+        array with the shape of npy.asarray(alm)
+    """
+    psi,theta,phi = _euler_angles(getattr(rot,'mat',rot))
+    if not inplace:
+        alm = npy.array(alm,dtype=npy.complex128)
+    if isinstance(alm,npy.ndarray) and alm.ndim == 1:
+        items = [alm]
+    else:
+        items = list(alm)
+    lmax = Alm.getlmax(items[0].size)
+    if lmax < 0:
+        raise TypeError('Wrong alm size (lmax must be equal to mmax).')
+    sphtlib._rotate_alm(items,psi,theta,phi,d=_get_wigner_d(lmax,theta))
+    return alm
 
 def smoothing(m,fwhm=0.0,sigma=None,degree=False,
               arcmin=False):
@@ -441,6 +859,156 @@ def smoothing(m,fwhm=0.0,sigma=None,degree=False,
     return alm2map(alm,nside,fwhm=fwhm,sigma=sigma,
                    degree=degree,arcmin=arcmin)
 
+def wigner3j(l1,l2,m1=0,m2=0):
+    """Computes the Wigner 3j symbols (l1 l2 l3;m1 m2 -m1-m2) for all l3.
+
+    Input:
+      - l1, l2: two integers, or two arrays of integers to compute the
+                symbols of several (l1,l2) at once
+    Parameters:
+      - m1, m2: integers or arrays of integers (broadcast with l1 and l2).
+                Default: 0
+    Return:
+      - an array w with w[l3] the symbol for l3=0..l1+l2 (zero when l3 is
+        out of the allowed range). For arrays, one such array per element
+        of l1, l2, m1, m2, padded with zeros up to max(l1+l2)
+    """
+    l1,l2,m1,m2 = npy.broadcast_arrays(*[npy.asarray(x,dtype=npy.intc)
+                                         for x in (l1,l2,m1,m2)])
+    w = sphtlib._wigner3j(l1.ravel(),l2.ravel(),m1.ravel(),m2.ravel())
+    return w.reshape(l1.shape+w.shape[-1:])
+
+def gaunt(l1,l2,m1=0,m2=0):
+    """Computes the Gaunt coefficients, ie. the integrals over the sphere
+    of Y_l1m1 Y_l2m2 Y_l3m3 with m3=-m1-m2, for all l3.
+
+    Input:
+      - l1, l2: two integers, or two arrays of integers
+    Parameters:
+      - m1, m2: integers or arrays of integers. Default: 0
+    Return:
+      - an array with the coefficients for l3=0..l1+l2, see wigner3j
+    """
+    l1,l2,m1,m2 = npy.broadcast_arrays(l1,l2,m1,m2)
+    w = wigner3j(l1,l2,m1,m2)*wigner3j(l1,l2)
+    l3 = npy.arange(w.shape[-1])
+    return w*npy.sqrt((2*l1[...,npy.newaxis]+1.)*(2*l2[...,npy.newaxis]+1.)
+                      *(2*l3+1.)/(4*pi))
+
+def apodize_mask(mask,fwhm=0.0,sigma=None,degree=False,arcmin=False):
+    """Apodize a mask with a Gaussian taper.
+
+    The mask is smoothed with a Gaussian beam, and the apodized mask is
+    mask*clip(2*smoothed-1,0,1): it goes continuously from 0 on the border
+    of the mask to 1 at about one fwhm inside the mask.
+
+    Input:
+      - mask: the mask, in RING scheme
+    Parameters:
+      - fwhm: the full width half max parameter of the Gaussian. Default:0.0
+      - sigma: the sigma of the Gaussian. Override fwhm.
+      - degree: if True, parameter given in degree. Override arcmin.
+                Default: False
+      - arcmin: if True, parameter given in arcmin. Default: False
+    Return:
+      - the apodized mask
+    """
+    mask = npy.asarray(mask,dtype=npy.float64)
+    if _get_sigma(fwhm,sigma,degree,arcmin) == 0.:
+        return mask.copy()
+    smoothed = smoothing(mask,fwhm=fwhm,sigma=sigma,degree=degree,
+                         arcmin=arcmin)
+    return mask*npy.clip(2*smoothed-1,0.,1.)
+
+def coupling_matrix(wl,lmax=None,cachedir=None):
+    """Computes the mode coupling matrix of a mask (Hivon et al. 2002).
+
+    M[l1,l2] = (2*l2+1)/(4*pi) sum_l3 (2*l3+1) wl[l3] (l1 l2 l3;0 0 0)**2,
+    so that the expected power spectrum of a masked map is dot(M,cl).
+
+    Input:
+      - wl: the power spectrum of the mask (eg. anafast(mask))
+    Parameters:
+      - lmax: maximum l of the matrix. Default: len(wl)-1
+      - cachedir: directory where the matrices are cached, in files named
+                  after a hash of wl. Default: CACHEPATH (no cache if None)
+    Return:
+      - the (lmax+1,lmax+1) coupling matrix
+    """
+    wl = npy.asarray(wl,dtype=npy.float64)
+    if lmax is None or lmax < 0:
+        lmax = wl.size-1
+    # only l3 <= 2*lmax contributes
+    wl = npy.ascontiguousarray(wl[:2*lmax+1])
+    if cachedir is None:
+        cachedir = CACHEPATH
+    if cachedir is None:
+        return sphtlib._coupling_matrix(wl,lmax=lmax)
+    fname = os.path.join(cachedir,'coupling_%s_%d.npy'
+                         %(hashlib.sha1(wl.tostring()).hexdigest(),lmax))
+    if os.path.isfile(fname):
+        return npy.load(fname)
+    mat = sphtlib._coupling_matrix(wl,lmax=lmax)
+    try:
+        npy.save(fname,mat)
+    except IOError:
+        # cache directory not writable
+        pass
+    return mat
+
+def pseudo_cl(m,mask,lmax=None,bins=None,fl=None,apodization=0.0,
+              degree=False,arcmin=False,cachedir=None):
+    """Estimates the power spectrum of a masked map with the MASTER method
+    (Hivon et al. 2002).
+
+    The mask is apodized (if apodization is given), the power spectrum
+    of the masked map and the coupling matrix of the mask are computed,
+    binned, and the binned coupling matrix is inverted.
+
+    Input:
+      - m: the map, in RING scheme
+      - mask: the mask (or weights) of the map, in RING scheme
+    Parameters:
+      - lmax: maximum l of the power spectrum. Default: 3*nside-1
+      - bins: the first l of each bin (the last bin ends at lmax).
+              Default: one bin per l
+      - fl: the window function (beam and pixel window) of the map.
+            Default: None
+      - apodization: the fwhm of the apodization of the mask (see
+                     apodize_mask). Default: 0.0 (no apodization)
+      - degree: if True, apodization given in degree. Override arcmin.
+                Default: False
+      - arcmin: if True, apodization given in arcmin. Default: False
+      - cachedir: the cache of the coupling matrices (see coupling_matrix).
+                  Default: CACHEPATH
+    Return:
+      - the power spectrum, one value per bin
+    """
+    m = npy.asarray(m,dtype=npy.float64)
+    nside = pixelfunc.npix2nside(m.size)
+    if lmax is None or lmax < 0:
+        lmax = 3*nside-1
+    mask = apodize_mask(mask,fwhm=apodization,degree=degree,arcmin=arcmin)
+    if bins is None:
+        bins = npy.arange(lmax+1)
+    bins = npy.asarray(bins,dtype=int)
+    edges = npy.append(bins,lmax+1)
+    if bins.size == 0 or bins[0] < 0 or npy.any(npy.diff(edges) <= 0):
+        raise ValueError("bins must be increasing, between 0 and lmax")
+    pcl = anafast(m*mask,lmax=lmax,iter=0,regression=False)
+    wl = anafast(mask,lmax=min(2*lmax,3*nside-1),iter=0,regression=False)
+    mat = coupling_matrix(wl,lmax,cachedir)
+    if fl is not None:
+        mat = mat*npy.asarray(fl,dtype=npy.float64)[:lmax+1]**2
+    # binning (average over the bin) and unbinning (constant spectrum
+    # in the bin) operators
+    ell = npy.arange(lmax+1)
+    ib = npy.searchsorted(edges,ell,side='right')-1
+    p = npy.where(ib[npy.newaxis,:] == npy.arange(bins.size)[:,npy.newaxis],
+                  1./npy.diff(edges)[:,npy.newaxis],0.)
+    q = (p > 0).T
+    return npy.linalg.solve(npy.dot(p,npy.dot(mat,q)),npy.dot(p,pcl))
+
 def pixwin(nside,pol=False):
     """Return the pixel window function for the given nside.
 
@@ -455,25 +1023,75 @@ def pixwin(nside,pol=False):
     datapath = DATAPATH
     if not pixelfunc.isnsideok(nside):
         raise ValueError("Wrong nside value (must be a power of two).")
-    fname = os.path.join(datapath, 'pixel_window_n%04d.fits'%nside)
-    if not os.path.isfile(fname):
+    fname = 'pixel_window_n%04d.fits'%nside
+    if not os.path.isfile(os.path.join(datapath, fname)):
         raise ValueError("No pixel window for this nside "
                          "or data files missing")
-    # return hfitslib._pixwin(nside,datapath,pol)  ## BROKEN -> seg fault...
-    try:
-        import pyfits
-    except ImportError:
-        print "*********************************************************"
-        print "**   You need to install pyfits to use this function   **"
-        print "*********************************************************"
-        raise
-    pw = pyfits.getdata(fname)
-    pw_temp, pw_pol = pw.field(0), pw.field(1)
+    pw = _read_data_file(fname,2,
+                         lambda: hfitslib._pixwin(nside,datapath,True))
+    pw_temp, pw_pol = pw[0].copy(), pw[1].copy()
     if pol:
         return pw_temp, pw_pol
     else:
         return pw_temp
 
+def _read_data_file(fname,ncol,reader=None):
+    """Return the first ncol columns of the data file fname (in DATAPATH)
+    as a (ncol,n) float64 array.
+
+    If given, reader is called without argument to read the columns
+    instead of pyfits.
+
+    The result is cached in memory (and in CACHEPATH if set), keyed by the
+    full path of the file, so that the fits file is read only once. The
+    returned array is read-only.
+    """
+    path = os.path.join(DATAPATH, fname)
+    if path in _data_cache:
+        return _data_cache[path]
+    npyname = None
+    if CACHEPATH is not None:
+        npyname = os.path.join(CACHEPATH, '%s_%s.npy'%(
+                os.path.splitext(fname)[0],
+                hashlib.md5(path).hexdigest()[:12]))
+        if os.path.isfile(npyname):
+            data = npy.load(npyname)
+            data.flags.writeable = False
+            _data_cache[path] = data
+            return data
+    if reader is not None:
+        data = npy.array(reader(),dtype=npy.float64)
+    else:
+        try:
+            import pyfits
+        except ImportError:
+            print "*********************************************************"
+            print "**   You need to install pyfits to use this function   **"
+            print "*********************************************************"
+            raise
+        d = pyfits.getdata(path)
+        data = npy.array([d.field(i).ravel() for i in xrange(ncol)],
+                         dtype=npy.float64)
+    if npyname is not None:
+        # written under a temporary name then renamed, so that other
+        # sessions never load a partial file
+        tmpname = None
+        try:
+            fd,tmpname = tempfile.mkstemp(suffix='.npy',dir=CACHEPATH)
+            f = os.fdopen(fd,'wb')
+            try:
+                npy.save(f, data)
+            finally:
+                f.close()
+            os.rename(tmpname, npyname)
+        except (IOError,OSError):
+            # cache directory not writable: keep the in-memory copy only
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+    data.flags.writeable = False
+    _data_cache[path] = data
+    return data
+
 def alm2map_der1(alm, nside, lmax=-1, mmax=-1):
    """Computes an Healpix map and its first derivatives given the alm.
 
@@ -492,6 +1110,683 @@ def alm2map_der1(alm, nside, lmax=-1, mmax=-1):
    """
    return sphtlib._alm2map_der1(alm,nside,lmax=lmax,mmax=mmax)
 
+def map2alm_spin(maps,spin,lmax=None,mmax=None,iter=1,out=None,plan=None,
+                 tol=None):
+    """Computes the spin-weighted alm of a pair of Healpix maps.
+
+    Input:
+      - maps: a sequence of 2 maps (e.g. Q and U for spin 2), or a stack
+              of such pairs
+      - spin: the spin of the maps
+    Parameters:
+      - lmax : maximum l of the alm. Default: 3*nside-1
+      - mmax : maximum m of the alm. Default: lmax
+      - iter : number of iteration (default: 1)
+      - out: the output alm array (see SHTPlan). Default: None
+      - plan: a SHTPlan to use for the transform. Default: None
+      - tol: if given, stop iterating as soon as the norm of the residual
+             maps relative to the norm of the maps is below tol (iter is then
+             the maximum number of iterations). Default: None
+    Return:
+      - the gradient and curl alm, as a (2,nalm) array (or a stack of those)
+    """
+    nside = pixelfunc.npix2nside(_last_size(maps))
+    plan = _get_plan(plan,nside,lmax,mmax)
+    return plan.map2alm_spin(maps,spin,iter=iter,out=out,tol=tol)
+
+def alm2map_spin(alms,nside,spin,lmax=None,mmax=None,out=None,plan=None):
+    """Computes a pair of Healpix maps from spin-weighted alm.
+
+    Input:
+      - alms: a sequence of 2 alm (gradient and curl), or a stack of such pairs
+      - nside: the nside of the output maps
+      - spin: the spin of the maps
+    Parameters:
+      - lmax: explicitly define lmax (needed if mmax!=lmax)
+      - mmax: explicitly define mmax (needed if mmax!=lmax)
+      - out: the output map array (see SHTPlan). Default: None
+      - plan: a SHTPlan to use for the transform. Default: None
+    Return:
+      - the two maps in RING scheme, as a (2,npix) array (or a stack of those)
+    """
+    if lmax is None or lmax < 0:
+        lmax = Alm.getlmax(_last_size(alms),mmax is None and -1 or mmax)
+        if lmax < 0:
+            raise TypeError('Wrong alm size for the given mmax.')
+    plan = _get_plan(plan,nside,lmax,mmax)
+    return plan.alm2map_spin(alms,spin,out=out)
+
+class SHTPlan(object):
+    """A plan for repeated spherical harmonic transforms at fixed nside,
+    lmax and mmax.
+
+    The psht geometry (possibly weighted by the ring weights), the alm
+    layout and the job list are built once and reused by every transform
+    done with the plan. Several transforms given at once (as a stack of
+    maps or alms) are executed in a single pass.
+
+    Input:
+      - nside: the nside of the maps
+    Parameters:
+      - lmax: maximum l of the alm. Default: 3*nside-1
+      - mmax: maximum m of the alm. Default: lmax
+      - pol: if True, map2alm and alm2map work on I,Q,U maps and T,E,B alms.
+             Default: False
+      - weights: if True, use the ring weights of the healpix data files.
+                 Can also be an array of 2*nside ring weights. Default: False
+      - mask: a map in RING scheme. If given, only the rings with at least
+              one non-zero pixel of the mask are transformed (the mask itself
+              is not applied to the maps). Default: None
+      - theta_range: a tuple (theta_min, theta_max), in radians. If given, only
+                     the rings with colatitude in this range are transformed.
+                     Default: None
+
+    With mask or theta_range (cut-sky plan), map2alm ignores the pixels
+    outside the selected rings and alm2map leaves them to zero. The
+    regression is not done by map2alm in this case.
+
+    The number of iterations done by the last map2alm (or map2alm_spin)
+    is stored in the niter attribute.
+
+    Maps and alms are given either as one array (one map or alm), a
+    sequence of 3 arrays (polarised plan), or a stack of those with
+    one more leading dimension. The results have the same layout.
+    Every method accepts an 'out' array (C contiguous, with the layout of
+    the result) which is filled and returned instead of a new array.
+    """
+    def __init__(self,nside,lmax=None,mmax=None,pol=False,weights=False,
+                 mask=None,theta_range=None):
+        from pshyt import job
+        if not pixelfunc.isnsideok(nside):
+            raise ValueError("Wrong nside value (must be a power of two).")
+        if lmax is None or lmax < 0:
+            lmax = 3*nside-1
+        if mmax is None or mmax < 0 or mmax > lmax:
+            mmax = lmax
+        self.nside = nside
+        self.lmax = lmax
+        self.mmax = mmax
+        self.pol = pol
+        self.npix = pixelfunc.nside2npix(nside)
+        self.nalm = Alm.getsize(lmax,mmax)
+        if weights is True:
+            weights = _get_ring_weights(nside)
+        elif weights is False:
+            weights = None
+        self.weights = weights
+        self.rings = None
+        self.niter = None
+        # pixels of the selected rings (None: all the pixels)
+        self._pixsel = None
+        if mask is None and theta_range is None:
+            self._job = job(nside,lmax,mmax,weights=weights)
+        else:
+            self.rings,geom = self._cut_sky_geom(mask,theta_range)
+            self._job = job(nside,lmax,mmax,geom=geom)
+
+    def _cut_sky_geom(self,mask,theta_range):
+        # Return the selected rings and their psht geometry
+        nside = self.nside
+        rings,startpix,ringpix,phi0,theta,weight = _ring_geom(nside,
+                                                              self.weights)
+        sel = npy.ones(rings.size,dtype=bool)
+        if mask is not None:
+            mask = npy.asarray(mask)
+            if mask.size != self.npix:
+                raise ValueError("mask must be a map with nside=%d"%nside)
+            sel &= npy.logical_or.reduceat(mask != 0,startpix)
+        if theta_range is not None:
+            sel &= (theta >= theta_range[0]) & (theta <= theta_range[1])
+        if not sel.any():
+            raise ValueError("No ring selected for the transforms")
+        geom = (ringpix[sel],startpix[sel],phi0[sel],theta[sel],weight[sel])
+        self._pixsel = npy.repeat(sel,ringpix)
+        return rings[sel],geom
+
+    def map2alm(self,m,iter=1,regression=True,out=None,tol=None):
+        """Computes the alm of map(s).
+
+        Input:
+          - m: the map(s), see the class documentation
+        Parameters:
+          - iter: number of iteration (default: 1)
+          - regression: if True, subtract map average before computing alm.
+                        Default: True.
+          - out: the output alm array. Default: None
+          - tol: if given, stop iterating as soon as the norm of the residual
+                 maps relative to the norm of the maps is below tol (iter is
+                 then the maximum number of iterations). Default: None
+        Return:
+          - the alm(s), with the layout of the input
+        """
+        ncomp = self.pol and 3 or 1
+        items,stacked = self._split(m,ncomp)
+        out = self._out(out,len(items),ncomp,self.nalm,npy.complex128,stacked)
+        alms = out.reshape(len(items),ncomp,self.nalm)
+        maps = npy.empty((len(items),ncomp,self.npix))
+        for mm,it in zip(maps,items):
+            for k in xrange(ncomp):
+                mm[k] = it[k]
+        avg = npy.zeros(len(items))
+        if regression and self.rings is None:
+            avg[:] = maps[:,0].mean(axis=1)
+            maps[:,0] -= avg[:,npy.newaxis]
+        self.niter = self._map2alm_iter(maps,alms,iter,tol=tol)
+        if regression and self.rings is None:
+            alms[:,0,0] += avg*npy.sqrt(4*pi)
+        return out
+
+    def alm2map(self,alm,out=None):
+        """Computes map(s) from alm(s).
+
+        Input:
+          - alm: the alm(s), see the class documentation
+        Parameters:
+          - out: the output map array. Default: None
+        Return:
+          - the map(s) in RING scheme, with the layout of the input
+        """
+        ncomp = self.pol and 3 or 1
+        items,stacked = self._split(alm,ncomp)
+        out = self._out(out,len(items),ncomp,self.npix,npy.float64,stacked)
+        self._add_jobs('add_alm2map',items,
+                       out.reshape(len(items),ncomp,self.npix))
+        self._job.execute()
+        return out
+
+    def der1(self,alm,out=None):
+        """Computes a map and its first derivatives from alm(s).
+
+        Input:
+          - alm: one alm or a stack of alms
+        Parameters:
+          - out: the output array. Default: None
+        Return:
+          - an array with the map, its derivative with respect to theta
+            and its derivative with respect to phi / sin(theta), in RING
+            scheme (one more leading dimension for a stack of alms)
+        """
+        items,stacked = self._split(alm,1)
+        out = self._out(out,len(items),3,self.npix,npy.float64,stacked)
+        for a,o in zip(items,out.reshape(len(items),3,self.npix)):
+            self._job.add_alm2map(a[0],o[0])
+            self._job.add_alm2map_der1(a[0],o[1:])
+        self._job.execute()
+        return out
+
+    def map2alm_spin(self,maps,spin,iter=1,out=None,tol=None):
+        """Computes the spin-weighted alm of a pair of maps.
+
+        Input:
+          - maps: a pair of maps or a stack of pairs of maps
+          - spin: the spin of the maps
+        Parameters:
+          - iter: number of iteration (default: 1)
+          - out: the output alm array. Default: None
+          - tol: the tolerance on the residual, see map2alm. Default: None
+        Return:
+          - the gradient and curl alm, with the layout of the input
+        """
+        items,stacked = self._split(maps,2)
+        out = self._out(out,len(items),2,self.nalm,npy.complex128,stacked)
+        self.niter = self._map2alm_iter(items,
+                                        out.reshape(len(items),2,self.nalm),
+                                        iter,spin,tol)
+        return out
+
+    def alm2map_spin(self,alms,spin,out=None):
+        """Computes a pair of maps from spin-weighted alm.
+
+        Input:
+          - alms: the gradient and curl alm, or a stack of such pairs
+          - spin: the spin of the maps
+        Parameters:
+          - out: the output map array. Default: None
+        Return:
+          - the pair of maps in RING scheme, with the layout of the input
+        """
+        items,stacked = self._split(alms,2)
+        out = self._out(out,len(items),2,self.npix,npy.float64,stacked)
+        self._add_jobs('add_alm2map_spin',items,
+                       out.reshape(len(items),2,self.npix),spin)
+        self._job.execute()
+        return out
+
+    def _map2alm_iter(self,maps,alms,iter,spin=None,tol=None):
+        # Accumulate into alms the alm of maps, improved by at most iter
+        # Jacobi iterations on the residual map (which is allocated once).
+        # Stop when the relative norm of the residual is below tol.
+        # Return the number of iterations done.
+        if spin is None:
+            forward,backward = 'add_map2alm','add_alm2map'
+        else:
+            forward,backward = 'add_map2alm_spin','add_alm2map_spin'
+        self._add_jobs(forward,maps,alms,spin)
+        self._job.execute()
+        if iter <= 0:
+            return 0
+        if tol:
+            norm = self._norm2(maps)
+        back = npy.empty(alms.shape[:2]+(self.npix,))
+        for i in xrange(iter):
+            back[...] = 0
+            self._add_jobs(backward,alms,back,spin)
+            self._job.execute()
+            for mm,bb in zip(maps,back):
+                for k in xrange(len(bb)):
+                    npy.subtract(mm[k],bb[k],bb[k])
+            if tol and npy.all(self._norm2(back) <= tol**2*norm):
+                return i
+            self._add_jobs(forward,back,alms,spin)
+            self._job.execute()
+        return iter
+
+    def _norm2(self,maps):
+        # Squared norm of each item of maps, on the pixels of the plan
+        sel = self._pixsel
+        res = npy.zeros(len(maps))
+        for i,mm in enumerate(maps):
+            for x in mm:
+                if sel is not None:
+                    x = x[sel]
+                res[i] += npy.dot(x,x)
+        return res
+
+    def _add_jobs(self,name,inputs,outputs,spin=None):
+        add = getattr(self._job,name)
+        for i,o in zip(inputs,outputs):
+            if spin is not None:
+                add(i,spin,o)
+            elif len(o) == 1:
+                add(i[0],o[0])
+            else:
+                add(i,o)
+
+    @staticmethod
+    def _split(x,ncomp):
+        # Return a list of tuples of ncomp arrays, and whether
+        # x was a stack
+        if isinstance(x,npy.ndarray):
+            ndim = x.ndim
+        else:
+            ndim = npy.ndim(x[0])+1
+        if ndim == 1 and ncomp == 1:
+            return [(x,)],False
+        elif ndim == 2 and ncomp == 1:
+            return [(xx,) for xx in x],True
+        elif ndim == 2:
+            if len(x) != ncomp:
+                raise TypeError("Expected a sequence of %d arrays"%ncomp)
+            return [tuple(x)],False
+        elif ndim == 3 and ncomp > 1:
+            if len(x[0]) != ncomp:
+                raise TypeError("Expected a stack of sequences of %d "
+                                "arrays"%ncomp)
+            return [tuple(xx) for xx in x],True
+        else:
+            raise TypeError("Wrong number of dimensions for input")
+
+    @staticmethod
+    def _out(out,n,ncomp,size,dtype,stacked):
+        # Return a zero-filled output array of the right layout,
+        # reusing out if given
+        shape = (ncomp,size)
+        if ncomp == 1:
+            shape = (size,)
+        if stacked:
+            shape = (n,)+shape
+        if out is None:
+            return npy.zeros(shape,dtype)
+        if (not isinstance(out,npy.ndarray) or out.shape != shape
+            or out.dtype != npy.dtype(dtype)
+            or not out.flags['C_CONTIGUOUS']):
+            raise ValueError("out must be a C contiguous %s array of shape %s"
+                             %(npy.dtype(dtype).name,shape))
+        out[...] = 0
+        return out
+
+class SHTPool(object):
+    """A pool of worker processes doing spherical harmonic transforms
+    at fixed nside, lmax and mmax.
+
+    The rings of the map are dealt out to the workers (each ring of the
+    northern hemisphere together with its symmetric ring), and each worker
+    transforms its own rings: alm2map writes them directly in the result
+    map, map2alm sums the alm computed by the workers. The maps and alms
+    are shared with the workers through files mapped in memory (in
+    /dev/shm when it exists), only short commands go through pipes.
+
+    The workers are new python processes (an OpenMP program cannot be
+    forked safely), each one using OMP_NUM_THREADS threads. By default,
+    OMP_NUM_THREADS is the number of cpus divided by nproc.
+
+    Input:
+      - nside: the nside of the maps
+    Parameters:
+      - lmax: maximum l of the alm. Default: 3*nside-1
+      - mmax: maximum m of the alm. Default: lmax
+      - pol: if True, map2alm and alm2map work on I,Q,U maps and T,E,B alms.
+             Default: False
+      - weights: if True, use the ring weights of the healpix data files.
+                 Can also be an array of 2*nside ring weights. Default: False
+      - nproc: number of worker processes. Default: the number of cpus
+
+    Maps and alms are given as for SHTPlan. The pool must be closed with
+    close() to stop the workers and free the shared memory.
+    """
+    def __init__(self,nside,lmax=None,mmax=None,pol=False,weights=False,
+                 nproc=None):
+        if not pixelfunc.isnsideok(nside):
+            raise ValueError("Wrong nside value (must be a power of two).")
+        if lmax is None or lmax < 0:
+            lmax = 3*nside-1
+        if mmax is None or mmax < 0 or mmax > lmax:
+            mmax = lmax
+        if nproc is None:
+            nproc = multiprocessing.cpu_count()
+        self.nside = nside
+        self.lmax = lmax
+        self.mmax = mmax
+        self.pol = pol
+        self.npix = pixelfunc.nside2npix(nside)
+        self.nalm = Alm.getsize(lmax,mmax)
+        self.nproc = nproc = max(1,min(nproc,2*nside))
+        if weights is True:
+            weights = _get_ring_weights(nside)
+        elif weights is False:
+            weights = None
+        self._bufs = {}
+        env = dict(os.environ)
+        if 'OMP_NUM_THREADS' not in env:
+            env['OMP_NUM_THREADS'] = str(max(1,multiprocessing.cpu_count()
+                                               // nproc))
+        self._pool = _workers.WorkerPool('healpy.sphtfunc._shtpool_worker',
+                                         nproc,env=env,name='SHTPool')
+        self._dir = self._pool.dir
+        ncomp = pol and 3 or 1
+        shapes = {'maps':((ncomp,self.npix),npy.float64),
+                  'back':((ncomp,self.npix),npy.float64),
+                  'alms':((ncomp,self.nalm),npy.complex128),
+                  'part':((nproc,ncomp,self.nalm),npy.complex128)}
+        for name,(shape,dtype) in shapes.items():
+            self._bufs[name] = npy.memmap(os.path.join(self._dir,name),
+                                          dtype=dtype,mode='w+',shape=shape)
+        self._call([(self._dir,shapes,nside,lmax,mmax,ncomp,weights,k,nproc)
+                    for k in xrange(nproc)])
+
+    def map2alm(self,m,iter=1,regression=True,out=None):
+        """Computes the alm of map(s).
+
+        Input:
+          - m: the map(s), see the class documentation
+        Parameters:
+          - iter: number of iteration (default: 1)
+          - regression: if True, subtract map average before computing alm.
+                        Default: True.
+          - out: the output alm array. Default: None
+        Return:
+          - the alm(s), with the layout of the input
+        """
+        ncomp = self.pol and 3 or 1
+        items,stacked = SHTPlan._split(m,ncomp)
+        out = SHTPlan._out(out,len(items),ncomp,self.nalm,npy.complex128,
+                           stacked)
+        maps,part = self._bufs['maps'],self._bufs['part']
+        alms = self._bufs['alms']
+        for it,o in zip(items,out.reshape(len(items),ncomp,self.nalm)):
+            for k in xrange(ncomp):
+                maps[k] = it[k]
+            avg = 0.
+            if regression:
+                avg = maps[0].mean()
+                maps[0] -= avg
+            self._call('map2alm')
+            part.sum(axis=0,out=o)
+            for i in xrange(iter):
+                alms[...] = o
+                self._call('iterate')
+                o += part.sum(axis=0)
+            o[0,0] += avg*npy.sqrt(4*pi)
+        return out
+
+    def alm2map(self,alm,out=None):
+        """Computes map(s) from alm(s).
+
+        Input:
+          - alm: the alm(s), see the class documentation
+        Parameters:
+          - out: the output map array. Default: None
+        Return:
+          - the map(s) in RING scheme, with the layout of the input
+        """
+        ncomp = self.pol and 3 or 1
+        items,stacked = SHTPlan._split(alm,ncomp)
+        out = SHTPlan._out(out,len(items),ncomp,self.npix,npy.float64,
+                           stacked)
+        maps,alms = self._bufs['maps'],self._bufs['alms']
+        for it,o in zip(items,out.reshape(len(items),ncomp,self.npix)):
+            for k in xrange(ncomp):
+                alms[k] = it[k]
+            self._call('alm2map')
+            o[...] = maps
+        return out
+
+    def close(self):
+        """Stops the workers and frees the shared memory.
+        """
+        self._bufs = {}
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+            self._dir = None
+
+    def __del__(self):
+        if getattr(self,'_pool',None) is not None:
+            self.close()
+
+    def _call(self,cmd):
+        # Send a command (or a list of commands, one per worker) to the
+        # workers and wait for all of them to be done
+        if self._pool is None:
+            raise ValueError("The pool is closed")
+        self._pool.call(cmd)
+
+# Main function of the SHTPool worker processes: the first command sets
+# up the worker, the next ones are transforms
+def _shtpool_worker():
+    from pshyt import job
+    state = {}
+    def setup(path,shapes,nside,lmax,mmax,ncomp,weights,k,nproc):
+        bufs = {}
+        for name,(shape,dtype) in shapes.items():
+            bufs[name] = npy.memmap(os.path.join(path,name),dtype=dtype,
+                                    mode='r+',shape=shape).view(npy.ndarray)
+        rings,startpix,ringpix,phi0,theta,weight = _ring_geom(nside,weights)
+        sel = (npy.minimum(rings,4*nside-rings)-1) % nproc == k
+        state['jb'] = job(nside,lmax,mmax,geom=(ringpix[sel],startpix[sel],
+                                                phi0[sel],theta[sel],
+                                                weight[sel]))
+        state['pix'] = npy.repeat(sel,ringpix).nonzero()[0]
+        state['ncomp'] = ncomp
+        state['bufs'] = bufs
+        state['part'] = bufs['part'][k]
+    def run(name,i,o):
+        jb = state['jb']
+        if state['ncomp'] == 1:
+            getattr(jb,name)(i[0],o[0])
+        else:
+            getattr(jb,name)(i,o)
+        jb.execute()
+    def handle(cmd):
+        if not state:
+            setup(*cmd)
+            return
+        bufs,pix,part = state['bufs'],state['pix'],state['part']
+        maps,back,alms = bufs['maps'],bufs['back'],bufs['alms']
+        if cmd == 'alm2map':
+            maps[:,pix] = 0
+            run('add_alm2map',alms,maps)
+        elif cmd == 'map2alm':
+            part[...] = 0
+            run('add_map2alm',maps,part)
+        elif cmd == 'iterate':
+            back[:,pix] = 0
+            run('add_alm2map',alms,back)
+            back[:,pix] = maps[:,pix]-back[:,pix]
+            part[...] = 0
+            run('add_map2alm',back,part)
+        else:
+            raise ValueError("Unknown command %r"%(cmd,))
+    _workers.serve(handle)
+
+def _get_ring_weights(nside):
+    """Return the 2*nside ring weights for nside, as used by map2alm
+    (ie. 1 + the content of the weight_ring file).
+    """
+    datapath = DATAPATH
+    fname = 'weight_ring_n%05d.fits'%nside
+    if not os.path.isfile(os.path.join(datapath, fname)):
+        raise IOError('File not found : '+os.path.join(datapath, fname))
+    return _read_data_file(fname,1)[0][:2*nside]+1.
+
+# Helper function : return the ring numbers of a map and, for each ring, the
+# index of its first pixel, its number of pixels, the azimuth of its first
+# pixel, its colatitude and its quadrature weight (as given to psht)
+def _ring_geom(nside,weights=None):
+    npix = pixelfunc.nside2npix(nside)
+    rings = npy.arange(1,4*nside)
+    startpix,ringpix,theta,shifted = pixelfunc.ringinfo(nside,rings)
+    northring = npy.where(rings > 2*nside,4*nside-rings,rings)
+    weight = npy.ones(rings.size)
+    if weights is not None:
+        weight = npy.asarray(weights,dtype=npy.float64)[northring-1]
+    weight *= 4*pi/npix
+    phi0 = npy.where(shifted,pi/ringpix,0.)
+    return rings,startpix,ringpix,phi0,theta,weight
+
+# Helper function : split the rings of a map in blocks of at most nrings
+# rings of the northern hemisphere and the symmetric rings of the southern
+# hemisphere. Return a list of (size,slices,geom) with the number of pixels
+# of the block, the slices of the map (a list of (first,last+1) pixels) of
+# the block and its psht geometry, with pixel offsets within the block.
+def _ring_chunks(nside,nrings,weights=None):
+    rings,startpix,ringpix,phi0,theta,weight = _ring_geom(nside,weights)
+    startpix = npy.append(startpix,pixelfunc.nside2npix(nside))
+    chunks = []
+    for a in xrange(1,2*nside+1,nrings):
+        b = min(a+nrings,2*nside+1)
+        sel = npy.append(npy.arange(a,b),
+                         npy.arange(max(4*nside-b+1,2*nside+1),4*nside-a+1))-1
+        slices = [(startpix[a-1],startpix[b-1])]
+        if 4*nside-a > 2*nside:
+            slices.append((startpix[max(4*nside-b,2*nside)],
+                           startpix[4*nside-a]))
+        ofs = npy.concatenate([[0],npy.cumsum(ringpix[sel])[:-1]])
+        geom = (ringpix[sel],ofs,phi0[sel],theta[sel],weight[sel])
+        chunks.append((int(ofs[-1]+ringpix[sel][-1]),slices,geom))
+    return chunks
+
+# Helper function : get the list of n(n+1)/2 cls (some of them None) given
+# to synalm, and the largest size of the cls
+def _get_cls_list(cls):
+    if not isinstance(cls[0], npy.ndarray):
+        return [cls],cls.size
+    # otherwise, cls must be a sequence of arrays
+    try:
+        cls_list = list(cls)
+        maxsize = 0
+        for c in cls_list:
+            if c is not None:
+                if c.size > maxsize: maxsize=c.size
+    except:
+        raise TypeError("First argument must be an array or a sequence of arrays.")
+    if sphtlib._getn(len(cls_list)) <= 0:
+        if len(cls_list) == 4:  # if 4 cls are given, assume TT, TE, EE, BB
+            cls_list = [cls[0], cls[1], None, cls[2], None, cls[3]]
+        else:
+            raise TypeError("The sequence of arrays must have either 4 elements "
+                            "(TT,TE,EE,BB)\n"
+                            "or n(n+1)/2 elements (some may be None)")
+    return cls_list,maxsize
+
+# Helper function : get the cls of a list of cls as a (ncl,lmax+1) array
+# (None cls are zero)
+def _get_cls_matrix(cls_list,lmax):
+    clmat = npy.zeros((len(cls_list),lmax+1))
+    for c,row in zip(cls_list,clmat):
+        if c is not None:
+            c = npy.asarray(c)[:lmax+1]
+            row[:c.size] = c
+    return clmat
+
+# Helper function : return plan if compatible with the parameters,
+# or a new plan
+def _get_plan(plan,nside,lmax,mmax,pol=False):
+    if plan is None:
+        return SHTPlan(nside,lmax,mmax,pol=pol)
+    if (plan.nside != nside or (lmax is not None and lmax >= 0
+                                and plan.lmax != lmax)
+        or (mmax is not None and mmax >= 0 and plan.mmax != mmax)):
+        raise ValueError("plan is not compatible with nside, lmax or mmax")
+    return plan
+
+# Helper function : get sigma in radian from the smoothing parameters
+def _get_sigma(fwhm,sigma,degree,arcmin):
+    if sigma is None:
+        sigma = fwhm / (2.*npy.sqrt(2.*npy.log(2.)))
+    if degree:
+        sigma *= (pi/180.)
+    elif arcmin:
+        sigma *= (pi/180./60.)
+    return sigma
+
+# Helper function : get the window function of a Gaussian beam
+def _gauss_beam(sigma,lmax):
+    ell = npy.arange(lmax+1)
+    return npy.exp(-0.5*ell*(ell+1)*sigma**2)
+
+# Helper function : get the Euler angles (psi,theta,phi) to give to
+# _rotate_alm for the rotation matrix mat (as rotmatrix in healpix_cxx)
+def _euler_angles(mat):
+    mat = npy.asarray(mat,dtype=npy.float64)
+    if mat.shape != (3,3):
+        raise ValueError("rot must be a Rotator or a 3x3 rotation matrix")
+    cb = mat[2,2]
+    sb = npy.sqrt(mat[0,2]**2+mat[1,2]**2)
+    beta = npy.arctan2(sb,cb)
+    if abs(sb) <= 1e-6:
+        alpha = 0.
+        if cb > 0:
+            gamma = npy.arctan2(mat[1,0],mat[0,0])
+        else:
+            gamma = npy.arctan2(mat[0,1],-mat[0,0])
+    else:
+        alpha = npy.arctan2(mat[1,2],mat[0,2])
+        gamma = npy.arctan2(mat[2,1],-mat[2,0])
+    return gamma,beta,alpha
+
+# Helper function : get the Wigner matrices for _rotate_alm from the cache,
+# or compute them. Return None (the matrices are computed on the fly by
+# _rotate_alm) if they are too large to be cached.
+def _get_wigner_d(lmax,theta):
+    key = (lmax,float(theta))
+    if key in _wigner_cache:
+        return _wigner_cache[key]
+    size = 8*(lmax+1)*(lmax+2)*(4*lmax+3)/6
+    if size > WIGNER_CACHE_SIZE:
+        return None
+    if size + sum(d.nbytes for d in _wigner_cache.values()) > WIGNER_CACHE_SIZE:
+        _wigner_cache.clear()
+    d = sphtlib._wigner_d_rotation(lmax,theta)
+    _wigner_cache[key] = d
+    return d
+
+# Helper function : get the size of the innermost array of x
+def _last_size(x):
+    while hasattr(x[0],'__len__'):
+        x = x[0]
+    return len(x)
+
 # Helper function : get nside from m, an array or a sequence
 # of arrays
 def _get_nside(m):
@@ -28,11 +28,17 @@
 #include <Python.h>
 
 #include <string>
+#include <cmath>
+#include <algorithm>
 #include <iostream>
 
 #include "numpy/arrayobject.h"
 
+#include <vector>
+
+#include "fitsio.h"
 #include "healpix_data_io.h"
+#include "fitshandle.h"
 #include "arr.h"
 #include "_healpy_utils.h"
 
@@ -59,7 +65,13 @@ static PyObject *healpy_pixwin(PyObject *self, PyObject *args, PyObject *kwds)
     "Wrong nside value (must be a power of 2)");
 
   arr<double> pw_temp, pw_pol;
-  read_pixwin(datapath, nside, pw_temp, pw_pol);
+  try
+    { read_pixwin(datapath, nside, pw_temp, pw_pol); }
+  catch (PlanckError &e)
+    {
+    PyErr_SetString(PyExc_IOError, e.what());
+    return NULL;
+    }
 
   npy_intp szpw;
 
@@ -90,10 +102,706 @@ static PyObject *healpy_pixwin(PyObject *self, PyObject *args, PyObject *kwds)
     return Py_BuildValue("NN",pixwin_temp,pixwin_pol);
 }
 
+/* Planck type matching the numpy type of an array, PLANCK_INVALID if the
+   array cannot be used directly as a cfitsio buffer */
+static PDT healpy_array_type(PyArrayObject *a)
+{
+  if (!PyArray_ISNOTSWAPPED(a)) return PLANCK_INVALID;
+  int size = PyArray_DESCR(a)->elsize;
+  switch (PyArray_DESCR(a)->kind)
+    {
+    case 'f':
+      if (size==4) return PLANCK_FLOAT32;
+      if (size==8) return PLANCK_FLOAT64;
+      break;
+    case 'i':
+      if (size==1) return PLANCK_INT8;
+      if (size==2) return PLANCK_INT16;
+      if (size==4) return PLANCK_INT32;
+      if (size==8) return PLANCK_INT64;
+      break;
+    case 'u':
+      if (size==1) return PLANCK_UINT8;
+      break;
+    case 'b':
+      return PLANCK_BOOL;
+    }
+  return PLANCK_INVALID;
+}
+
+/* Planck type of a FITS binary table format letter */
+static PDT healpy_fits_letter_type(char c)
+{
+  switch (c)
+    {
+    case 'B': return PLANCK_UINT8;
+    case 'I': return PLANCK_INT16;
+    case 'J': return PLANCK_INT32;
+    case 'K': return PLANCK_INT64;
+    case 'E': return PLANCK_FLOAT32;
+    case 'D': return PLANCK_FLOAT64;
+    case 'L': return PLANCK_BOOL;
+    default:  return PLANCK_INVALID;
+    }
+}
+
+/* Get the data pointers of a sequence of 1D, C-contiguous arrays usable
+   as cfitsio buffers. Return 0 with a Python exception set on error. */
+static int healpy_get_buffers(PyObject *arrays, bool writable,
+  std::vector<void *> &data, std::vector<PDT> &types,
+  std::vector<int64> &sizes)
+{
+  PyObject *seq = PySequence_Fast(arrays, "arrays must be a sequence");
+  if (!seq) return 0;
+  Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+  for (Py_ssize_t i=0; i<n; ++i)
+    {
+    PyObject *o = PySequence_Fast_GET_ITEM(seq, i);
+    if (!PyArray_Check(o))
+      {
+      PyErr_SetString(PyExc_TypeError, "arrays must be numpy arrays");
+      Py_DECREF(seq);
+      return 0;
+      }
+    PyArrayObject *a = (PyArrayObject *)o;
+    PDT type = healpy_array_type(a);
+    if (type==PLANCK_INVALID || !PyArray_ISCONTIGUOUS(a)
+        || (writable && !PyArray_ISWRITEABLE(a)))
+      {
+      PyErr_SetString(PyExc_ValueError, "arrays must be contiguous, "
+        "writable if needed, with a native numeric type");
+      Py_DECREF(seq);
+      return 0;
+      }
+    data.push_back(PyArray_DATA(a));
+    types.push_back(type);
+    sizes.push_back(PyArray_SIZE(a));
+    }
+  Py_DECREF(seq);
+  return 1;
+}
+
+/***********************************************************************
+    healpy_table_info
+
+       input: filename, hdu (0 is the primary HDU), keys
+
+       output: (hdutype, column names, column types, number of elements
+                per column, values of the keys (string or None))
+*/
+static PyObject *healpy_table_info(PyObject *self, PyObject *args)
+{
+  char *filename = NULL;
+  int hdu;
+  PyObject *keys;
+
+  if (!PyArg_ParseTuple(args, "siO", &filename, &hdu, &keys))
+    return NULL;
+
+  PyObject *keyseq = PySequence_Fast(keys, "keys must be a sequence");
+  if (!keyseq) return NULL;
+  std::vector<std::string> keynames;
+  for (Py_ssize_t i=0; i<PySequence_Fast_GET_SIZE(keyseq); ++i)
+    {
+    char *k = PyString_AsString(PySequence_Fast_GET_ITEM(keyseq, i));
+    if (!k) { Py_DECREF(keyseq); return NULL; }
+    keynames.push_back(k);
+    }
+  Py_DECREF(keyseq);
+
+  std::string hdutype;
+  std::vector<std::string> names, types, values;
+  std::vector<int64> nelems;
+  std::vector<bool> present;
+  /* use cfitsio directly: this avoids the error messages printed by
+     fitshandle when moving to a compressed image */
+  fitsfile *fptr;
+  int status = 0, type;
+  fits_open_file(&fptr, filename, READONLY, &status);
+  if (status)
+    {
+    char msg[81];
+    fits_get_errstatus(status, msg);
+    fits_clear_errmsg();
+    PyErr_Format(PyExc_IOError, "%s: %s", msg, filename);
+    return NULL;
+    }
+  fits_movabs_hdu(fptr, hdu+1, &type, &status);
+  if (!status)
+    {
+    if (fits_is_compressed_image(fptr, &status))
+      hdutype = "COMPRESSED";
+    else
+      hdutype = (type==BINARY_TBL) ? "BINTABLE" :
+                ((type==ASCII_TBL) ? "TABLE" : "IMAGE");
+    }
+  if ((!status) && (hdutype=="BINTABLE"))
+    {
+    int ncols;
+    LONGLONG nrows;
+    fits_get_num_cols(fptr, &ncols, &status);
+    fits_get_num_rowsll(fptr, &nrows, &status);
+    for (int i=1; (i<=ncols) && (!status); ++i)
+      {
+      char ttype[81], tform[81];
+      LONGLONG repeat;
+      int typecode;
+      fits_get_bcolparmsll(fptr, i, ttype, 0, tform, &repeat, 0, 0, 0, 0,
+                           &status);
+      fits_binary_tform(tform, &typecode, 0, 0, &status);
+      names.push_back(ttype);
+      const char *t = "";
+      switch (typecode)
+        {
+        case TSBYTE:    t = "i1"; break;
+        case TBYTE:     t = "u1"; break;
+        case TSHORT:    t = "i2"; break;
+        case TLONG:     t = "i4"; break;
+        case TLONGLONG: t = "i8"; break;
+        case TFLOAT:    t = "f4"; break;
+        case TDOUBLE:   t = "f8"; break;
+        case TLOGICAL:  t = "b1"; break;
+        }
+      types.push_back(t);
+      nelems.push_back((typecode==TSTRING) ? nrows : nrows*repeat);
+      }
+    }
+  for (size_t i=0; (i<keynames.size()) && (!status); ++i)
+    {
+    char *value = NULL;
+    fits_read_key_longstr(fptr, const_cast<char *>(keynames[i].c_str()),
+                          &value, 0, &status);
+    present.push_back(status!=KEY_NO_EXIST);
+    values.push_back((status==0) ? value : "");
+    if (value) free(value);
+    if (status==KEY_NO_EXIST) status = 0;
+    }
+  if (status)
+    {
+    char msg[81];
+    fits_get_errstatus(status, msg);
+    fits_clear_errmsg();
+    status = 0;
+    fits_close_file(fptr, &status);
+    PyErr_Format(PyExc_IOError, "%s: %s", msg, filename);
+    return NULL;
+    }
+  fits_clear_errmsg();
+  fits_close_file(fptr, &status);
+
+  PyObject *pnames = PyList_New(names.size());
+  PyObject *ptypes = PyList_New(names.size());
+  PyObject *pnelems = PyList_New(names.size());
+  PyObject *pvalues = PyList_New(values.size());
+  for (size_t i=0; i<names.size(); ++i)
+    {
+    PyList_SET_ITEM(pnames, i, PyString_FromString(names[i].c_str()));
+    PyList_SET_ITEM(ptypes, i, PyString_FromString(types[i].c_str()));
+    PyList_SET_ITEM(pnelems, i, PyLong_FromLongLong(nelems[i]));
+    }
+  for (size_t i=0; i<values.size(); ++i)
+    {
+    if (present[i])
+      PyList_SET_ITEM(pvalues, i, PyString_FromString(values[i].c_str()));
+    else
+      {
+      Py_INCREF(Py_None);
+      PyList_SET_ITEM(pvalues, i, Py_None);
+      }
+    }
+  return Py_BuildValue("sNNNN", hdutype.c_str(), pnames, ptypes, pnelems,
+                       pvalues);
+}
+
+/***********************************************************************
+    healpy_read_columns
+
+       input: filename, hdu (0 is the primary HDU), column numbers
+              (starting at 0), output arrays (one per column), offset
+              or row ranges
+
+       Reads out[i].size elements of each column, starting at element
+       offset, directly into the arrays. cfitsio does the type and byte
+       order conversions. The GIL is released if cfitsio is thread-safe.
+
+       Instead of an offset, an (n,2) integer array of (first element,
+       number of elements) ranges can be given: the ranges are then read
+       one after the other, and their total length must match the size of
+       the output arrays.
+*/
+static PyObject *healpy_read_columns(PyObject *self, PyObject *args)
+{
+  char *filename = NULL;
+  int hdu;
+  PyObject *colnums, *arrays, *poffset = NULL;
+
+  if (!PyArg_ParseTuple(args, "siOO|O", &filename, &hdu, &colnums, &arrays,
+                        &poffset))
+    return NULL;
+
+  std::vector<void *> data;
+  std::vector<PDT> types;
+  std::vector<int64> sizes;
+  if (!healpy_get_buffers(arrays, true, data, types, sizes))
+    return NULL;
+
+  /* list of (first element, number of elements) to read */
+  std::vector<int64> ranges;
+  if (poffset==NULL || PyInt_Check(poffset) || PyLong_Check(poffset))
+    {
+    int64 offset = (poffset==NULL) ? 0 : PyLong_AsLongLong(poffset);
+    if (PyErr_Occurred()) return NULL;
+    ranges.push_back(offset);
+    ranges.push_back(-1);
+    }
+  else
+    {
+    PyArrayObject *pranges = (PyArrayObject *)PyArray_ContiguousFromAny(
+      poffset, NPY_INT64, 2, 2);
+    if (!pranges) return NULL;
+    if (PyArray_DIM(pranges,1)!=2)
+      {
+      Py_DECREF(pranges);
+      PyErr_SetString(PyExc_ValueError, "row ranges must have shape (n,2)");
+      return NULL;
+      }
+    const int64 *r = (const int64 *)PyArray_DATA(pranges);
+    int64 total = 0;
+    for (npy_intp i=0; i<PyArray_DIM(pranges,0); ++i)
+      {
+      if (r[2*i]<0 || r[2*i+1]<0) total = -1;
+      if (total<0) break;
+      ranges.push_back(r[2*i]);
+      ranges.push_back(r[2*i+1]);
+      total += r[2*i+1];
+      }
+    Py_DECREF(pranges);
+    for (size_t i=0; i<sizes.size(); ++i)
+      healpyAssertValue(sizes[i]==total,
+        "row ranges do not match the size of the output arrays");
+    }
+  std::vector<int> cols;
+  PyObject *colseq = PySequence_Fast(colnums, "colnums must be a sequence");
+  if (!colseq) return NULL;
+  for (Py_ssize_t i=0; i<PySequence_Fast_GET_SIZE(colseq); ++i)
+    cols.push_back(PyInt_AsLong(PySequence_Fast_GET_ITEM(colseq, i))+1);
+  Py_DECREF(colseq);
+  if (PyErr_Occurred()) return NULL;
+  healpyAssertValue(cols.size()==data.size(),
+    "colnums and arrays must have the same length");
+
+  std::vector<int64> pos(cols.size(),0);
+  std::string fname(filename), err;
+  bool release = fits_is_reentrant();
+  PyThreadState *state = NULL;
+  if (release) state = PyEval_SaveThread();
+  try
+    {
+    fitshandle inp;
+    inp.open(fname);
+    inp.goto_hdu(hdu+1);
+    std::vector<int64> chunk(cols.size());
+    for (size_t i=0; i<cols.size(); ++i)
+      {
+      if ((cols[i]<1) || (cols[i]>inp.ncols()))
+        planck_fail("column number out of range");
+      chunk[i] = inp.efficientChunkSize(cols[i]);
+      }
+    /* read the columns together, a few rows at a time, so that each table
+       row goes through the cfitsio buffers only once */
+    for (size_t r=0; r<ranges.size(); r+=2)
+      {
+      std::vector<int64> start(pos), end(cols.size());
+      for (size_t i=0; i<cols.size(); ++i)
+        end[i] = (ranges[r+1]<0) ? sizes[i] : pos[i]+ranges[r+1];
+      for (bool done=false; !done; )
+        {
+        done = true;
+        for (size_t i=0; i<cols.size(); ++i)
+          {
+          int64 n = std::min(chunk[i], end[i]-pos[i]);
+          if (n<=0) continue;
+          inp.read_column_raw_void(cols[i],
+            (char *)data[i]+pos[i]*type2size(types[i]), types[i], n,
+            ranges[r]+pos[i]-start[i]);
+          pos[i] += n;
+          done = false;
+          }
+        }
+      }
+    }
+  catch (PlanckError &e)
+    { err = e.what(); }
+  if (release) PyEval_RestoreThread(state);
+
+  if (!err.empty())
+    {
+    PyErr_SetString(PyExc_IOError, err.c_str());
+    return NULL;
+    }
+  Py_RETURN_NONE;
+}
+
+/***********************************************************************
+    healpy_read_image
+
+       input: filename, hdu (0 is the primary HDU), output array, offset
+
+       Reads out.size pixels of an image (possibly tile compressed),
+       starting at pixel offset (of the image seen as a 1D array), directly
+       into the array. Only the tiles holding these pixels are
+       decompressed. The GIL is released if cfitsio is thread-safe.
+*/
+static PyObject *healpy_read_image(PyObject *self, PyObject *args)
+{
+  char *filename = NULL;
+  int hdu;
+  PyObject *array;
+  long long offset = 0;
+
+  if (!PyArg_ParseTuple(args, "siO|L", &filename, &hdu, &array, &offset))
+    return NULL;
+
+  healpyAssertType(PyArray_Check(array), "out must be a numpy array");
+  PyArrayObject *a = (PyArrayObject *)array;
+  healpyAssertValue(PyArray_ISCONTIGUOUS(a) && PyArray_ISWRITEABLE(a),
+    "out must be a writeable contiguous array");
+  int datatype = 0;
+  switch (healpy_array_type(a))
+    {
+    case PLANCK_INT8:    datatype = TSBYTE; break;
+    case PLANCK_UINT8:   datatype = TBYTE; break;
+    case PLANCK_INT16:   datatype = TSHORT; break;
+    case PLANCK_INT32:   datatype = TINT; break;
+    case PLANCK_INT64:   datatype = TLONGLONG; break;
+    case PLANCK_FLOAT32: datatype = TFLOAT; break;
+    case PLANCK_FLOAT64: datatype = TDOUBLE; break;
+    default: break;
+    }
+  healpyAssertValue(datatype!=0, "Unsupported array type");
+  LONGLONG nelem = PyArray_SIZE(a);
+  void *data = PyArray_DATA(a);
+
+  int status = 0, type, anynul;
+  bool release = fits_is_reentrant();
+  PyThreadState *state = NULL;
+  if (release) state = PyEval_SaveThread();
+  fitsfile *fptr;
+  fits_open_file(&fptr, filename, READONLY, &status);
+  if (!status)
+    {
+    fits_movabs_hdu(fptr, hdu+1, &type, &status);
+    if (nelem>0)
+      fits_read_img(fptr, datatype, offset+1, nelem, NULL, data, &anynul,
+                    &status);
+    int status2 = 0;
+    fits_close_file(fptr, &status2);
+    }
+  char msg[81];
+  if (status)
+    {
+    fits_get_errstatus(status, msg);
+    fits_clear_errmsg();
+    }
+  if (release) PyEval_RestoreThread(state);
+
+  if (status)
+    {
+    PyErr_Format(PyExc_IOError, "%s: %s", msg, filename);
+    return NULL;
+    }
+  Py_RETURN_NONE;
+}
+
+/***********************************************************************
+    healpy_write_columns
+
+       input: filename, column names, input arrays, column formats
+              (FITS letters), repeat counts, units, keys (sequence of
+              (name, value, comment)), extname
+
+       Creates filename (which must not exist) with an empty primary HDU
+       and one binary table extension.
+*/
+static PyObject *healpy_write_columns(PyObject *self, PyObject *args)
+{
+  char *filename = NULL, *extname = NULL;
+  PyObject *pnames, *arrays, *pformats, *prepeats, *punits, *pkeys;
+
+  if (!PyArg_ParseTuple(args, "sOOOOOOs", &filename, &pnames, &arrays,
+                        &pformats, &prepeats, &punits, &pkeys, &extname))
+    return NULL;
+
+  std::vector<void *> data;
+  std::vector<PDT> types;
+  std::vector<int64> sizes;
+  if (!healpy_get_buffers(arrays, false, data, types, sizes))
+    return NULL;
+  size_t ncols = data.size();
+
+  std::vector<fitscolumn> cols;
+  for (size_t i=0; i<ncols; ++i)
+    {
+    PyObject *n = PySequence_GetItem(pnames, i);
+    PyObject *f = PySequence_GetItem(pformats, i);
+    PyObject *r = PySequence_GetItem(prepeats, i);
+    PyObject *u = PySequence_GetItem(punits, i);
+    if (!n || !f || !r || !u)
+      { Py_XDECREF(n); Py_XDECREF(f); Py_XDECREF(r); Py_XDECREF(u);
+        return NULL; }
+    char *name = PyString_AsString(n);
+    char *fmt = PyString_AsString(f);
+    long long repeat = PyLong_AsLongLong(r);
+    char *unit = PyString_AsString(u);
+    PDT type = fmt ? healpy_fits_letter_type(fmt[0]) : PLANCK_INVALID;
+    if (name && unit && !PyErr_Occurred())
+      cols.push_back(fitscolumn(name, unit, repeat, type));
+    Py_DECREF(n); Py_DECREF(f); Py_DECREF(r); Py_DECREF(u);
+    if (PyErr_Occurred()) return NULL;
+    healpyAssertValue(type!=PLANCK_INVALID, "Unsupported column format");
+    }
+
+  std::vector<std::string> knames, kcomments, kstrings;
+  std::vector<PyObject *> kvalues;
+  PyObject *keyseq = PySequence_Fast(pkeys, "keys must be a sequence");
+  if (!keyseq) return NULL;
+  for (Py_ssize_t i=0; i<PySequence_Fast_GET_SIZE(keyseq); ++i)
+    {
+    char *kname, *kcomment;
+    PyObject *kvalue;
+    if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(keyseq, i), "sOs",
+                          &kname, &kvalue, &kcomment))
+      { Py_DECREF(keyseq); return NULL; }
+    knames.push_back(kname);
+    kcomments.push_back(kcomment);
+    kvalues.push_back(kvalue);
+    }
+
+  std::string err;
+  try
+    {
+    fitshandle out;
+    out.create(filename);
+    out.insert_bintab(cols, extname);
+    for (size_t i=0; i<knames.size(); ++i)
+      {
+      PyObject *v = kvalues[i];
+      if (PyBool_Check(v))
+        out.set_key(knames[i], bool(v==Py_True), kcomments[i]);
+      else if (PyInt_Check(v) || PyLong_Check(v))
+        out.set_key(knames[i], int64(PyLong_AsLongLong(v)), kcomments[i]);
+      else if (PyFloat_Check(v))
+        out.set_key(knames[i], PyFloat_AsDouble(v), kcomments[i]);
+      else if (PyString_Check(v))
+        out.set_key(knames[i], std::string(PyString_AsString(v)),
+                    kcomments[i]);
+      else
+        planck_fail("Unsupported key type for "+knames[i]);
+      }
+    bool release = fits_is_reentrant();
+    PyThreadState *state = NULL;
+    if (release) state = PyEval_SaveThread();
+    try
+      {
+      /* write the rows a few at a time, as in healpy_read_columns */
+      std::vector<int64> pos(ncols,0);
+      int64 nrows = 0;
+      for (size_t i=0; i<ncols; ++i)
+        nrows = std::max(nrows, (sizes[i]+cols[i].repcount()-1)
+                                / cols[i].repcount());
+      int64 rowchunk = std::max(int64(1), out.efficientChunkSize(1)
+                                          / cols[0].repcount());
+      for (int64 row=0; row<nrows; row+=rowchunk)
+        for (size_t i=0; i<ncols; ++i)
+          {
+          int64 n = std::min(rowchunk*cols[i].repcount(), sizes[i]-pos[i]);
+          if (n<=0) continue;
+          out.write_column_raw_void(i+1,
+            (const char *)data[i]+pos[i]*type2size(types[i]), types[i], n,
+            pos[i]);
+          pos[i] += n;
+          }
+      }
+    catch (PlanckError &e)
+      { err = e.what(); }
+    if (release) PyEval_RestoreThread(state);
+    }
+  catch (PlanckError &e)
+    { err = e.what(); }
+  Py_DECREF(keyseq);
+
+  if (!err.empty())
+    {
+    PyErr_SetString(PyExc_IOError, err.c_str());
+    return NULL;
+    }
+  Py_RETURN_NONE;
+}
+
+static PyObject *healpy_is_reentrant(PyObject *self, PyObject *args)
+{
+  return PyBool_FromLong(fits_is_reentrant());
+}
+
+/* l of a FITS alm index (l*l+l+m+1), with an exact integer square root */
+static inline int64 healpy_fits_l(int64 i)
+{
+  int64 l = int64(std::sqrt(double(i-1)));
+  while (l*l>i-1) --l;
+  while ((l+1)*(l+1)<=i-1) ++l;
+  return l;
+}
+
+/***********************************************************************
+    healpy_fits2alm_index
+
+       input: FITS alm indices (l*l+l+m+1), lmax=-1, mmax=-1
+
+       output: (idx, lmax, mmax), with idx the index of each alm in the
+               healpy layout m*(2*lmax+1-m)/2+l, or -1 if l>lmax or m>mmax.
+               lmax and mmax default to the largest l and m found in the
+               input (mmax is at most lmax).
+*/
+static PyObject *healpy_fits2alm_index(PyObject *self, PyObject *args)
+{
+  PyObject *pindex;
+  long lmax = -1, mmax = -1;
+
+  if (!PyArg_ParseTuple(args, "O|ll", &pindex, &lmax, &mmax))
+    return NULL;
+
+  PyArrayObject *index = (PyArrayObject *)PyArray_ContiguousFromAny(pindex,
+    NPY_INT64, 1, 1);
+  if (!index) return NULL;
+  npy_intp n = PyArray_DIM(index,0);
+  const int64 *fi = (const int64 *)PyArray_DATA(index);
+
+  for (npy_intp i=0; i<n; ++i)
+    {
+    if (fi[i]<1)
+      {
+      Py_DECREF(index);
+      PyErr_SetString(PyExc_ValueError,
+                      "Invalid alm index (must be at least 1)");
+      return NULL;
+      }
+    int64 l = healpy_fits_l(fi[i]);
+    if (fi[i]-1-l*l-l<0)
+      {
+      Py_DECREF(index);
+      PyErr_SetString(PyExc_ValueError, "Negative m value encountered !");
+      return NULL;
+      }
+    }
+  if (lmax<0 || mmax<0)
+    {
+    int64 lmx = 0, mmx = 0;
+    for (npy_intp i=0; i<n; ++i)
+      {
+      int64 l = healpy_fits_l(fi[i]);
+      if (lmax>=0 && l>lmax) continue;
+      lmx = std::max(lmx, l);
+      mmx = std::max(mmx, fi[i]-1-l*l-l);
+      }
+    if (lmax<0) lmax = lmx;
+    if (mmax<0) mmax = std::min(mmx, int64(lmax));
+    }
+  if (mmax>lmax) mmax = lmax;
+
+  PyArrayObject *idx = (PyArrayObject *)PyArray_SimpleNew(1, &n, NPY_INT64);
+  if (!idx)
+    {
+    Py_DECREF(index);
+    return NULL;
+    }
+  int64 *out = (int64 *)PyArray_DATA(idx);
+  for (npy_intp i=0; i<n; ++i)
+    {
+    int64 l = healpy_fits_l(fi[i]), m = fi[i]-1-l*l-l;
+    out[i] = (l>lmax || m>mmax) ? -1 : m*(2*int64(lmax)+1-m)/2+l;
+    }
+  Py_DECREF(index);
+  return Py_BuildValue("Nll", idx, lmax, mmax);
+}
+
+/***********************************************************************
+    healpy_alm2fits_index
+
+       input: lmax, mmax, lmax_in=lmax, mmax_in=mmax
+
+       output: (fitsidx, idx_in), the FITS index (l*l+l+m+1, int32) of
+               each alm of the (lmax, mmax) healpy layout, and the position
+               of the same alm in an input array with layout
+               (lmax_in, mmax_in).
+*/
+static PyObject *healpy_alm2fits_index(PyObject *self, PyObject *args)
+{
+  long lmax, mmax, lmax_in = -1, mmax_in = -1;
+
+  if (!PyArg_ParseTuple(args, "ll|ll", &lmax, &mmax, &lmax_in, &mmax_in))
+    return NULL;
+  if (lmax_in<0) lmax_in = lmax;
+  if (mmax_in<0) mmax_in = lmax_in;
+  healpyAssertValue(lmax>=0 && mmax>=0 && mmax<=lmax,
+    "lmax and mmax must satisfy 0 <= mmax <= lmax");
+  healpyAssertValue(lmax<=lmax_in && mmax<=mmax_in,
+    "lmax and mmax must not exceed those of the input");
+  healpyAssertValue(int64(lmax+1)*(lmax+1)<=2147483647LL,
+    "lmax too large for the FITS index column");
+
+  npy_intp n = npy_intp(mmax+1)*(lmax+1) - npy_intp(mmax)*(mmax+1)/2;
+  PyArrayObject *fitsidx = (PyArrayObject *)PyArray_SimpleNew(1, &n,
+    NPY_INT32);
+  PyArrayObject *idx_in = (PyArrayObject *)PyArray_SimpleNew(1, &n,
+    NPY_INT64);
+  if (!fitsidx || !idx_in)
+    {
+    Py_XDECREF(fitsidx);
+    Py_XDECREF(idx_in);
+    return NULL;
+    }
+  int32 *fi = (int32 *)PyArray_DATA(fitsidx);
+  int64 *ii = (int64 *)PyArray_DATA(idx_in);
+  npy_intp k = 0;
+  for (int64 m=0; m<=mmax; ++m)
+    {
+    int64 start = m*(2*int64(lmax_in)+1-m)/2;
+    for (int64 l=m; l<=lmax; ++l, ++k)
+      {
+      fi[k] = int32(l*l+l+m+1);
+      ii[k] = start+l;
+      }
+    }
+  return Py_BuildValue("NN", fitsidx, idx_in);
+}
+
 static PyMethodDef HEALFITSMethods[] = {
   {"_pixwin", (PyCFunction)healpy_pixwin, METH_VARARGS | METH_KEYWORDS,
    "Return the pixel window for some nside\n"
    "_pixwin(nside,data_path,pol=False)"},
+  {"_table_info", healpy_table_info, METH_VARARGS,
+   "Return the type, column names, column types, column sizes and the\n"
+   "values of some keys of a FITS extension\n"
+   "_table_info(filename,hdu,keys)"},
+  {"_read_columns", healpy_read_columns, METH_VARARGS,
+   "Read table columns directly into arrays\n"
+   "_read_columns(filename,hdu,colnums,arrays,offset=0)\n"
+   "_read_columns(filename,hdu,colnums,arrays,ranges)"},
+  {"_read_image", healpy_read_image, METH_VARARGS,
+   "Read pixels of a (possibly compressed) image directly into an array\n"
+   "_read_image(filename,hdu,array,offset=0)"},
+  {"_write_columns", healpy_write_columns, METH_VARARGS,
+   "Write arrays in a new FITS file as a binary table\n"
+   "_write_columns(filename,names,arrays,formats,repeats,units,keys,extname)"},
+  {"_fits2alm_index", healpy_fits2alm_index, METH_VARARGS,
+   "Convert FITS alm indices (l*l+l+m+1) to healpy alm indices\n"
+   "_fits2alm_index(index,lmax=-1,mmax=-1) -> (idx,lmax,mmax)"},
+  {"_alm2fits_index", healpy_alm2fits_index, METH_VARARGS,
+   "Return the FITS indices of the alms of a layout, and their position\n"
+   "in a larger input layout\n"
+   "_alm2fits_index(lmax,mmax,lmax_in=lmax,mmax_in=lmax_in) -> (fitsidx,idx_in)"},
+  {"_is_reentrant", healpy_is_reentrant, METH_NOARGS,
+   "Return True if cfitsio can be used from several threads"},
   {NULL, NULL, 0, NULL} /* Sentinel */
 };
 
@@ -30,6 +30,7 @@
 
 #include <string>
 #include <iostream>
+#include <vector>
 
 #include "arr.h"
 #include "alm.h"
@@ -40,6 +41,9 @@
 #include "powspec.h"
 #include "alm_powspec_tools.h"
 #include "healpix_data_io.h"
+#include "wigner.h"
+#include "openmp_support.h"
+#include "planck_rng.h"
 #include "_healpy_utils.h"
 
 #define IS_DEBUG_ON 0
@@ -133,13 +137,82 @@ static void cholesky(int n, double *data, double *res)
   return;
 }
 
+/* Iterative map2alm, as map2alm_iter and map2alm_pol_iter of healpix_cxx,
+   but the residual maps are allocated once for all the iterations.
+   If tol>0, the iterations stop as soon as the norm of the residual maps
+   relative to the norm of the input maps is below tol, num_iter being the
+   maximum number of iterations. mapQ, mapU, almG and almC are NULL
+   without polarisation.
+   Return the number of iterations done. */
+static int map2alm_iter_tol(const Healpix_Map<double> &mapI,
+                            const Healpix_Map<double> *mapQ,
+                            const Healpix_Map<double> *mapU,
+                            Alm<xcomplex<double> > &almI,
+                            Alm<xcomplex<double> > *almG,
+                            Alm<xcomplex<double> > *almC,
+                            int num_iter, double tol,
+                            const arr<double> &weight)
+{
+  bool pol = (mapQ != NULL);
+  if( pol )
+    map2alm_pol(mapI,*mapQ,*mapU,almI,*almG,*almC,weight);
+  else
+    map2alm(mapI,almI,weight);
+  if( num_iter <= 0 )
+    return 0;
+
+  int npix = mapI.Npix();
+  double norm = 0;
+  for( int m=0; m<npix; m++ )
+    {
+      norm += mapI[m]*mapI[m];
+      if( pol )
+        norm += (*mapQ)[m]*(*mapQ)[m] + (*mapU)[m]*(*mapU)[m];
+    }
+
+  Healpix_Map<double> resI(mapI.Nside(),RING,SET_NSIDE), resQ, resU;
+  if( pol )
+    {
+      resQ.SetNside(mapI.Nside(),RING);
+      resU.SetNside(mapI.Nside(),RING);
+    }
+
+  for( int iter=1; iter<=num_iter; iter++ )
+    {
+      if( pol )
+        alm2map_pol(almI,*almG,*almC,resI,resQ,resU);
+      else
+        alm2map(almI,resI);
+      double res = 0;
+      for( int m=0; m<npix; m++ )
+        {
+          resI[m] = mapI[m]-resI[m];
+          res += resI[m]*resI[m];
+          if( pol )
+            {
+              resQ[m] = (*mapQ)[m]-resQ[m];
+              resU[m] = (*mapU)[m]-resU[m];
+              res += resQ[m]*resQ[m] + resU[m]*resU[m];
+            }
+        }
+      if( tol > 0 && res <= tol*tol*norm )
+        return iter-1;
+      if( pol )
+        map2alm_pol(resI,resQ,resU,almI,*almG,*almC,weight,true);
+      else
+        map2alm(resI,almI,weight,true);
+    }
+  return num_iter;
+}
+
 /***********************************************************************
     map2alm
 
        input: map, lmax=3*nside-1, mmax=lmax, cl=False
-              iter=3, use_weights=False
+              iter=3, use_weights=False, tol=0, return_iter=False
 
-       output: alm (or cl if cl=True)
+       output: alm (or cl if cl=True), and the number of iterations done
+               if return_iter=True
 */
 static PyObject *healpy_map2alm(PyObject *self, PyObject *args,
                                 PyObject *kwds)
@@ -154,22 +227,28 @@ static PyObject *healpy_map2alm(PyObject *self, PyObject *args,
   char * datapath=NULL;
   int polarisation = 0; /* not polarised by default */
   int regression=1;
+  PyObject *weightsin = NULL;
+  double tol = 0.;
+  int return_iter = 0;
 
   static const char* kwlist[] = {"","lmax", "mmax","cl","iter",
-                           "use_weights", "data_path", "regression", NULL};
+                           "use_weights", "data_path", "regression",
+                           "weights", "tol", "return_iter", NULL};
 
-  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!|iiiiisi", (char **)kwlist,
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!|iiiiisiOdi", (char **)kwlist,
                                    &PyArray_Type, &mapIin,
                                    &lmax, &mmax, &docl,
-                                   &num_iter,&use_weights,&datapath,&regression))
+                                   &num_iter,&use_weights,&datapath,&regression,
+                                   &weightsin,&tol,&return_iter))
     {
       PyErr_Clear(); /* I want to try the other calling way */
 
       PyObject *t = NULL;
-      if( !PyArg_ParseTupleAndKeywords(args, kwds, "O|iiiiisi", (char **)kwlist,
+      if( !PyArg_ParseTupleAndKeywords(args, kwds, "O|iiiiisiOdi", (char **)kwlist,
                                    &t,
                                    &lmax, &mmax, &docl,
-                                       &num_iter,&use_weights,&datapath,&regression) )
+                                       &num_iter,&use_weights,&datapath,&regression,
+                                       &weightsin,&tol,&return_iter) )
         return NULL;
       else
         {
@@ -302,7 +381,28 @@ static PyObject *healpy_map2alm(PyObject *self, PyObject *args,
 
   arr<double> weight;
 
-  if( use_weights )
+  if( use_weights && weightsin && weightsin != Py_None )
+    {
+      /* ring weights already read by the caller (including the +1) */
+      PyArrayObject *w = (PyArrayObject*)PyArray_ContiguousFromAny
+        (weightsin, NPY_DOUBLE, 1, 1);
+      if( !w || w->dimensions[0] < 2*nside )
+        {
+          Py_XDECREF(w);
+          Py_DECREF(almIout);
+          Py_XDECREF(almGout);
+          Py_XDECREF(almCout);
+          if( !w ) return NULL;
+          PyErr_SetString(PyExc_ValueError,
+                          "weights must have at least 2*nside elements.");
+          return NULL;
+        }
+      weight.alloc(2*nside);
+      for (tsize m=0; m<weight.size(); ++m)
+        weight[m] = ((double*)w->data)[m];
+      Py_DECREF(w);
+    }
+  else if( use_weights )
     {
       read_weight_ring(datapath, nside, weight);
       for (tsize m=0; m<weight.size(); ++m) weight[m]+=1;
@@ -316,23 +416,26 @@ static PyObject *healpy_map2alm(PyObject *self, PyObject *args,
     mapI.Add(-avg);
   }
 
+  int niter;
   if( !polarisation )
-    map2alm_iter(mapI,almIalm,num_iter,weight);
+    niter = map2alm_iter_tol(mapI, NULL, NULL, almIalm, NULL, NULL,
+                             num_iter, tol, weight);
   else
-    map2alm_pol_iter(mapI, mapQ, mapU, almIalm, almGalm, almCalm, num_iter,
-                     weight);
+    niter = map2alm_iter_tol(mapI, &mapQ, &mapU, almIalm, &almGalm, &almCalm,
+                             num_iter, tol, weight);
 
   if( regression ) {
     almIalm(0,0) += avg*sqrt(fourpi);
     mapI.Add(avg);
   }
 
+  PyObject *res;
   if( !docl )
     {
       if( !polarisation )
-        return Py_BuildValue("N",almIout);
+        res = Py_BuildValue("N",almIout);
       else
-        return Py_BuildValue("NNN", almIout, almGout, almCout);
+        res = Py_BuildValue("NNN", almIout, almGout, almCout);
     }
   else
     {
@@ -351,7 +454,7 @@ static PyObject *healpy_map2alm(PyObject *self, PyObject *args,
 
           for( int l=0; l<szcl; l++ )
             *((double*)PyArray_GETPTR1(ctt,l)) =  powspec.tt(l);
-          return Py_BuildValue("NN",ctt,almIout);
+          res = Py_BuildValue("NN",ctt,almIout);
         }
       else
         {
@@ -380,10 +483,13 @@ static PyObject *healpy_map2alm(PyObject *self, PyObject *args,
               *((double*)PyArray_GETPTR1(cbb,l)) =  powspec.cc(l);
               *((double*)PyArray_GETPTR1(cte,l)) =  powspec.tg(l);
             }
-          return Py_BuildValue("(NNNN)(NNN)",ctt,cee,cbb,cte,
-                               almIout, almGout, almCout);
+          res = Py_BuildValue("(NNNN)(NNN)",ctt,cee,cbb,cte,
+                              almIout, almGout, almCout);
         }
     }
+  if( !return_iter || !res )
+    return res;
+  return Py_BuildValue("Ni",res,niter);
 }
 
 /***********************************************************************
@@ -897,7 +1003,7 @@ static PyObject *healpy_synalm(PyObject *self, PyObject *args,
         {
           if( cls[i] == NULL )
             mat[i] = 0.0;
-          else if( cls[i]->dimensions[0] < l )
+          else if( cls[i]->dimensions[0] <= l )
             mat[i] = 0.0;
           else
             {
@@ -940,7 +1046,7 @@ static PyObject *healpy_synalm(PyObject *self, PyObject *args,
       DBGPRINTF("\n");
 
       /* m > 1 */
-      for( int m=1; m<=l; m++ )
+      for( int m=1; m<=std::min(l,mmax); m++ )
         {
           DBGPRINTF("   m=%d: ", m);
           for( int i=nalm-1; i>=0; i-- )
@@ -985,6 +1091,614 @@ static PyObject *healpy_synalm(PyObject *self, PyObject *args,
   return NULL;
 }
 
+/***********************************************************************
+    synalm_rng
+
+       input: cls (n(n+1)/2 x lmax+1 array, ordered as for synalm), alm (a
+              C contiguous n x nalm complex128 or complex64 array), lmax,
+              mmax, seed, stream
+
+       output: None, Gaussian alm with the spectra cls are drawn in alm,
+               with the random stream (seed, stream)
+*/
+/* Draw the alm of _synalm_rng, for the Cholesky factors chol of the cls
+   (ncl values for each l) into alm (nalm arrays of szalm T complex).
+   Each m has its own random generator, seeded by (seed, stream, m), so
+   the result does not depend on the number of threads. */
+template<typename T> static void synalm_rng(int nalm, int lmax, int mmax,
+  const double *chol, unsigned long long seed, unsigned int stream,
+  T *alm, npy_intp szalm)
+{
+  const int ncl = nalm*(nalm+1)/2;
+  const double sqrt_half = sqrt(0.5);
+#pragma omp parallel
+{
+  std::vector<double> g(2*nalm);
+#pragma omp for schedule(dynamic,1)
+  for( int m=0; m<=mmax; m++ )
+    {
+      planck_rng rng((unsigned int)(seed&0xFFFFFFFFu),
+                     (unsigned int)(seed>>32), stream, m);
+      double f = (m==0) ? 1. : sqrt_half;
+      npy_intp ofs = npy_intp(m)*(2*lmax+1-m)/2;
+      for( int l=m; l<=lmax; l++ )
+        {
+          const double *res = chol+l*ncl;
+          for( int j=0; j<nalm; j++ )
+            {
+              g[2*j] = rng.rand_gauss();
+              g[2*j+1] = (m==0) ? 0. : rng.rand_gauss();
+            }
+          for( int i=0; i<nalm; i++ )
+            {
+              double xr = 0., xi = 0.;
+              for( int j=0; j<=i; j++ )
+                {
+                  xr += res[getidx(nalm,i,j)]*g[2*j];
+                  xi += res[getidx(nalm,i,j)]*g[2*j+1];
+                }
+              alm[2*(i*szalm+ofs+l)] = T(f*xr);
+              alm[2*(i*szalm+ofs+l)+1] = T(f*xi);
+            }
+        }
+    }
+}
+}
+
+static PyObject *healpy_synalm_rng(PyObject *self, PyObject *args)
+{
+  PyObject *cls_ = NULL;
+  PyArrayObject *almout = NULL;
+  int lmax, mmax;
+  unsigned long long seed;
+  unsigned int stream;
+
+  if( !PyArg_ParseTuple(args, "OO!iiKI", &cls_, &PyArray_Type, &almout,
+                        &lmax, &mmax, &seed, &stream) )
+    return NULL;
+
+  PyArrayObject *clarr = (PyArrayObject*)
+    PyArray_ContiguousFromAny(cls_, NPY_DOUBLE, 2, 2);
+  if( !clarr ) return NULL;
+  int ncl = clarr->dimensions[0];
+  int nalm = getn(ncl);
+  npy_intp szalm = Alm<xcomplex<double> >::Num_Alms(lmax,mmax);
+  int type = almout->descr->type_num;
+  if( nalm <= 0 || clarr->dimensions[1] != lmax+1 )
+    {
+      Py_DECREF(clarr);
+      PyErr_SetString(PyExc_ValueError,
+                      "cls must be a (n(n+1)/2,lmax+1) array.");
+      return NULL;
+    }
+  if( almout->nd != 2 || almout->dimensions[0] != nalm
+      || almout->dimensions[1] != szalm || !PyArray_ISCARRAY(almout)
+      || (type != NPY_CDOUBLE && type != NPY_CFLOAT) )
+    {
+      Py_DECREF(clarr);
+      PyErr_SetString(PyExc_ValueError,
+                      "alm must be a C contiguous complex (n,nalm) array.");
+      return NULL;
+    }
+
+  /* Cholesky decomposition of the correlation matrix of each l */
+  std::vector<double> chol((lmax+1)*ncl);
+  const double *cl = (const double*)clarr->data;
+  std::vector<double> mat(ncl);
+  for( int l=0; l<=lmax; l++ )
+    {
+      for( int i=0; i<ncl; i++ )
+        mat[i] = cl[i*(lmax+1)+l];
+      cholesky(nalm, &mat[0], &chol[l*ncl]);
+    }
+  Py_DECREF(clarr);
+
+  /* the GIL is released, so that alm can be drawn in a thread while
+     another one does a transform */
+  Py_BEGIN_ALLOW_THREADS
+  if( type == NPY_CDOUBLE )
+    synalm_rng(nalm, lmax, mmax, &chol[0], seed, stream,
+               (double*)almout->data, szalm);
+  else
+    synalm_rng(nalm, lmax, mmax, &chol[0], seed, stream,
+               (float*)almout->data, szalm);
+  Py_END_ALLOW_THREADS
+
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
+/***********************************************************************
+    wigner_d_rotation
+
+       input: lmax, theta
+
+       output: the elements d^l_{m',m}(theta) needed by rotate_alm, for
+               0<=l<=lmax, packed as (l+1)x(2l+1) matrices, one after
+               the other (row i, column j of matrix l is d^l_{i-l,j-l})
+*/
+static PyObject *healpy_wigner_d_rotation(PyObject *self, PyObject *args)
+{
+  int lmax;
+  double theta;
+
+  if( !PyArg_ParseTuple(args, "id", &lmax, &theta) )
+    return NULL;
+  healpyAssertValue(lmax>=0, "lmax must be positive.");
+
+  npy_intp sz = 0;
+  for( int l=0; l<=lmax; l++ )
+    sz += npy_intp(l+1)*(2*l+1);
+
+  PyArrayObject *dout = (PyArrayObject*)PyArray_SimpleNew
+    (1, (npy_intp*)&sz, PyArray_DOUBLE);
+  if( !dout ) return NULL;
+
+  double *dd = (double*)dout->data;
+  wigner_d_risbo_openmp rec(lmax,theta);
+  for( int l=0; l<=lmax; l++ )
+    {
+      const arr2<double> &d(rec.recurse());
+      for( int i=0; i<=l; i++ )
+        for( int j=0; j<=2*l; j++ )
+          *dd++ = d[i][j];
+    }
+
+  return Py_BuildValue("N",dout);
+}
+
+/* Rotate the multipole l of the nalm alm arrays (lmax==mmax) in alms,
+   given the elements d^l_{i-l,j-l} of the Wigner matrix as d[i*dstride+j].
+   Same algorithm as rotate_alm in alm_powspec_tools.cc, sharing the
+   Wigner matrix between all the alm. */
+static void rotate_alm_l(int l, int lmax, int nalm, xcomplex<double> **alms,
+                         const double *d, long dstride,
+                         const arr<xcomplex<double> > &exppsi,
+                         const arr<xcomplex<double> > &expphi,
+                         arr2<xcomplex<double> > &almtmp)
+{
+  /* index of a_l0 is l, index of a_lm is l + m*(2*lmax+1-m)/2 */
+  for( int k=0; k<nalm; k++ )
+    for( int m=0; m<=l; m++ )
+      almtmp[k][m] = alms[k][l]*d[l*dstride+l+m];
+
+#pragma omp parallel
+{
+  int64 lo,hi;
+  openmp_calc_share(0,l+1,lo,hi);
+
+  for( int k=0; k<nalm; k++ )
+    {
+      bool flip = true;
+      for( int mm=1; mm<=l; mm++ )
+        {
+          xcomplex<double> t1 = alms[k][l+mm*(2*lmax+1-mm)/2]*exppsi[mm];
+          const double *drow = d+(l-mm)*dstride;
+          bool flip2 = ((mm+lo)&1) ? true : false;
+          for( int m=lo; m<hi; m++ )
+            {
+              double d1 = flip2 ? -drow[l-m] : drow[l-m];
+              double d2 = flip  ? -drow[l+m] : drow[l+m];
+              double f1 = d1+d2, f2 = d1-d2;
+              almtmp[k][m].re += t1.re*f1; almtmp[k][m].im += t1.im*f2;
+              flip2 = !flip2;
+            }
+          flip = !flip;
+        }
+    }
+}
+
+  for( int k=0; k<nalm; k++ )
+    for( int m=0; m<=l; m++ )
+      alms[k][l+m*(2*lmax+1-m)/2] = almtmp[k][m]*expphi[m];
+}
+
+/***********************************************************************
+    rotate_alm
+
+       input: a sequence of alm (lmax==mmax), psi, theta, phi,
+              d=None (the output of _wigner_d_rotation(lmax,theta))
+
+       output: None, the alm are rotated in place
+*/
+static PyObject *healpy_rotate_alm(PyObject *self, PyObject *args,
+                                   PyObject *kwds)
+{
+  PyObject *t = NULL, *dobj = NULL;
+  double psi, theta, phi;
+
+  static const char* kwlist[] = {"","","","","d", NULL};
+
+  if( !PyArg_ParseTupleAndKeywords(args, kwds, "Oddd|O", (char **)kwlist,
+                                   &t, &psi, &theta, &phi, &dobj) )
+    return NULL;
+
+  healpyAssertType(PySequence_Check(t),
+                   "First argument must be a sequence of alm arrays.");
+  int nalm = PySequence_Size(t);
+  healpyAssertValue(nalm>0, "No alm to rotate.");
+
+  std::vector<xcomplex<double>*> alms(nalm);
+  long szalm = -1;
+  for( int k=0; k<nalm; k++ )
+    {
+      PyObject *o = PySequence_GetItem(t, k);
+      /* borrow the reference the time of this function */
+      Py_XDECREF(o);
+      healpyAssertType(o && PyArray_Check(o),
+                       "First argument must be a sequence of alm arrays.");
+      PyArrayObject *a = (PyArrayObject*)o;
+      healpyAssertType((a->nd==1)&&(a->descr->type=='D'),
+                       "Type of alms must be complex128 and arrays must be 1D.");
+      healpyAssertValue(a->flags&NPY_C_CONTIGUOUS,
+                        "Array must be C contiguous for this operation.");
+      healpyAssertValue(a->flags&NPY_WRITEABLE,
+                        "Array must be writeable for this operation.");
+      healpyAssertValue((szalm<0)||(a->dimensions[0]==szalm),
+                        "All alms arrays must have same size.");
+      szalm = a->dimensions[0];
+      alms[k] = (xcomplex<double>*)a->data;
+    }
+
+  double ell = (-3.+sqrt(9.+8.*(szalm-1)))/2.;
+  healpyAssertValue(ell==floor(ell), "Wrong alm size (lmax must be mmax).");
+  int lmax = (int)floor(ell);
+
+  PyArrayObject *darr = NULL;
+  if( dobj && dobj != Py_None )
+    {
+      darr = (PyArrayObject*)PyArray_ContiguousFromAny(dobj, NPY_DOUBLE, 1, 1);
+      if( !darr ) return NULL;
+      npy_intp sz = 0;
+      for( int l=0; l<=lmax; l++ )
+        sz += npy_intp(l+1)*(2*l+1);
+      if( darr->dimensions[0] != sz )
+        {
+          Py_DECREF(darr);
+          PyErr_SetString(PyExc_ValueError,
+                          "Wigner matrices do not match lmax.");
+          return NULL;
+        }
+    }
+
+  arr<xcomplex<double> > exppsi(lmax+1), expphi(lmax+1);
+  for( int m=0; m<=lmax; m++ )
+    {
+      exppsi[m].Set(cos(psi*m),-sin(psi*m));
+      expphi[m].Set(cos(phi*m),-sin(phi*m));
+    }
+  arr2<xcomplex<double> > almtmp(nalm,lmax+1);
+
+  if( darr )
+    {
+      const double *d = (const double*)darr->data;
+      for( int l=0; l<=lmax; l++ )
+        {
+          rotate_alm_l(l, lmax, nalm, &alms[0], d, 2*l+1, exppsi, expphi,
+                       almtmp);
+          d += npy_intp(l+1)*(2*l+1);
+        }
+      Py_DECREF(darr);
+    }
+  else
+    {
+      wigner_d_risbo_openmp rec(lmax,theta);
+      for( int l=0; l<=lmax; l++ )
+        {
+          const arr2<double> &d(rec.recurse());
+          rotate_alm_l(l, lmax, nalm, &alms[0], d[0], d.size2(), exppsi,
+                       expphi, almtmp);
+        }
+    }
+
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
+/***********************************************************************
+    alm2cl
+
+       input: alm1, alm2 (2D arrays of n1 and n2 alm), lmax, mmax
+
+       output: the (n1,n2,lmax+1) array of the cross-spectra between
+               each alm of alm1 and each alm of alm2. If alm2 is alm1,
+               only half of the spectra are computed.
+*/
+static PyObject *healpy_alm2cl(PyObject *self, PyObject *args,
+                               PyObject *kwds)
+{
+  PyObject *o1 = NULL, *o2 = NULL;
+  int lmax = -1, mmax = -1;
+
+  static const char* kwlist[] = {"","","lmax", "mmax", NULL};
+
+  if( !PyArg_ParseTupleAndKeywords(args, kwds, "OOi|i", (char **)kwlist,
+                                   &o1, &o2, &lmax, &mmax) )
+    return NULL;
+  if( mmax < 0 || mmax > lmax )
+    mmax = lmax;
+  healpyAssertValue(lmax>=0, "lmax must be positive.");
+
+  PyArrayObject *a1 = (PyArrayObject*)
+    PyArray_ContiguousFromAny(o1, NPY_CDOUBLE, 2, 2);
+  if( !a1 ) return NULL;
+  bool sym = (o2 == o1);
+  PyArrayObject *a2 = a1;
+  if( sym )
+    Py_INCREF(a2);
+  else
+    {
+      a2 = (PyArrayObject*)PyArray_ContiguousFromAny(o2, NPY_CDOUBLE, 2, 2);
+      if( !a2 ) { Py_DECREF(a1); return NULL; }
+    }
+
+  npy_intp nalm = Alm<xcomplex<double> >::Num_Alms(lmax,mmax);
+  if( a1->dimensions[1] != nalm || a2->dimensions[1] != nalm )
+    {
+      Py_DECREF(a1); Py_DECREF(a2);
+      PyErr_SetString(PyExc_ValueError,
+                      "Wrong alm size for the given lmax and mmax.");
+      return NULL;
+    }
+
+  npy_intp n1 = a1->dimensions[0], n2 = a2->dimensions[0];
+  npy_intp dims[3] = {n1, n2, lmax+1};
+  PyArrayObject *clout = (PyArrayObject*)PyArray_ZEROS(3, dims, NPY_DOUBLE, 0);
+  if( !clout ) { Py_DECREF(a1); Py_DECREF(a2); return NULL; }
+
+  const xcomplex<double> *p1 = (const xcomplex<double>*)a1->data;
+  const xcomplex<double> *p2 = (const xcomplex<double>*)a2->data;
+  double *cl = (double*)clout->data;
+
+  /* Each thread takes a range of l, and goes through it for every m:
+     the alm are read in memory order, each one only once. */
+#pragma omp parallel
+{
+  int64 lo,hi;
+  openmp_calc_share(0,lmax+1,lo,hi);
+
+  for( int m=0; m<=mmax; m++ )
+    {
+      double f = (m==0) ? 1. : 2.;
+      npy_intp ofs = npy_intp(m)*(2*lmax+1-m)/2;
+      for( int l=std::max<int>(m,lo); l<hi; l++ )
+        for( npy_intp i=0; i<n1; i++ )
+          {
+            xcomplex<double> a = p1[i*nalm+ofs+l];
+            for( npy_intp j=(sym ? i : 0); j<n2; j++ )
+              {
+                xcomplex<double> b = p2[j*nalm+ofs+l];
+                cl[(i*n2+j)*(lmax+1)+l] += f*(a.re*b.re+a.im*b.im);
+              }
+          }
+    }
+
+  for( int l=lo; l<hi; l++ )
+    for( npy_intp i=0; i<n1; i++ )
+      for( npy_intp j=(sym ? i : 0); j<n2; j++ )
+        {
+          double c = cl[(i*n2+j)*(lmax+1)+l] / (2*l+1);
+          cl[(i*n2+j)*(lmax+1)+l] = c;
+          if( sym )
+            cl[(j*n2+i)*(lmax+1)+l] = c;
+        }
+}
+
+  Py_DECREF(a1);
+  Py_DECREF(a2);
+  return Py_BuildValue("N",clout);
+}
+
+/* Fill w[l3] with the squares of the Wigner 3j symbols (l1 l2 l3;0 0 0)
+   for l3=|l1-l2|..l1+l2 (zero when l1+l2+l3 is odd). The first value is
+   computed from the log factorials lf, the others by the recursion on
+   l3 -> l3+2. */
+static void wigner3j_000_sq(int l1, int l2, const std::vector<double> &lf,
+                            double *w)
+{
+  int l3 = std::abs(l1-l2);
+  int J = l1+l2+l3, g = J/2;
+  double x = std::exp(lf[J-2*l1]+lf[J-2*l2]+lf[J-2*l3]-lf[J+1]
+                      +2*(lf[g]-lf[g-l1]-lf[g-l2]-lf[g-l3]));
+  for( ; l3<=l1+l2; l3+=2, J+=2, g++ )
+    {
+      w[l3] = x;
+      if( l3+1 <= l1+l2 )
+        w[l3+1] = 0.;
+      if( l3+2 <= l1+l2 )
+        x *= (J-2.*l1+1)*(J-2.*l2+1)*(g+1.)*(J-2.*l3)
+          / (2.*(J-2.*l3-1)*(J+3.)*(g-l1+1.)*(g-l2+1.));
+    }
+}
+
+/* Fill w[0..l1+l2] with the Wigner 3j symbols (l1 l2 l3;m1 m2 -m1-m2)
+   (zero for l3 outside the allowed range), using the three-term
+   recursion in l3 of Schulten & Gordon (1975). The recursion goes
+   forward from the lowest l3 as long as the symbols grow, and backward
+   from l3=l1+l2 down to there; both parts are matched on three l3 and
+   normalised with sum_l3 (2*l3+1)*w[l3]**2 = 1. v is a work array
+   of the same size as w. */
+static void wigner3j(int l1, int l2, int m1, int m2, double *w, double *v)
+{
+  const double big = 1e100;
+  int m3 = -m1-m2;
+  int lhi = l1+l2, llo = std::max(std::abs(l1-l2), std::abs(m3));
+  for( int l=0; l<=lhi; l++ )
+    w[l] = 0.;
+  if( std::abs(m1) > l1 || std::abs(m2) > l2 || llo > lhi )
+    return;
+  /* sign of the symbol for l3=l1+l2 */
+  double sign = (std::abs(l1-l2-m3)&1) ? -1. : 1.;
+  if( llo == lhi )
+    {
+      w[lhi] = sign/std::sqrt(2.*lhi+1);
+      return;
+    }
+  double a1 = double(l1-l2)*(l1-l2), a2 = double(l1+l2+1)*(l1+l2+1);
+  double b1 = (double(l1)*(l1+1)-double(l2)*(l2+1))*m3;
+#define W3J_A(l) std::sqrt((double(l)*(l)-a1)*(a2-double(l)*(l)) \
+                           *(double(l)*(l)-double(m3)*m3))
+#define W3J_B(l) (-(2.*(l)+1)*(b1-double(l)*((l)+1)*(m2-m1)))
+
+  /* forward recursion */
+  w[llo] = 1.;
+  if( llo == 0 )
+    /* l1==l2, m3==0: the recursion is singular at l3=0 */
+    w[1] = m1/std::sqrt(double(l1)*(l1+1));
+  else
+    w[llo+1] = -W3J_B(llo)/(llo*W3J_A(llo+1));
+  int lmid = lhi;
+  for( int l=llo+1; l<lhi; l++ )
+    {
+      if( l >= llo+2 && std::abs(w[l]) <= std::abs(w[l-2]) )
+        { lmid = l; break; }
+      w[l+1] = -(W3J_B(l)*w[l]+(l+1)*W3J_A(l)*w[l-1])/(l*W3J_A(l+1));
+      if( std::abs(w[l+1]) > big )
+        for( int k=llo; k<=l+1; k++ )
+          w[k] /= big;
+    }
+
+  /* backward recursion, matched to the forward one on lmid-2..lmid */
+  if( lmid < lhi )
+    {
+      v[lhi] = 1.;
+      v[lhi-1] = -W3J_B(lhi)/((lhi+1)*W3J_A(lhi));
+      for( int l=lhi-1; l>=lmid-1; l-- )
+        {
+          v[l-1] = -(W3J_B(l)*v[l]+l*W3J_A(l+1)*v[l+1])/((l+1)*W3J_A(l));
+          if( std::abs(v[l-1]) > big )
+            for( int k=l-1; k<=lhi; k++ )
+              v[k] /= big;
+        }
+      double num = 0., den = 0.;
+      for( int l=lmid-2; l<=lmid; l++ )
+        {
+          num += w[l]*v[l];
+          den += v[l]*v[l];
+        }
+      for( int l=lmid+1; l<=lhi; l++ )
+        w[l] = v[l]*num/den;
+    }
+#undef W3J_A
+#undef W3J_B
+
+  double norm = 0.;
+  for( int l=llo; l<=lhi; l++ )
+    norm += (2*l+1)*w[l]*w[l];
+  norm = ((w[lhi]*sign >= 0) ? 1. : -1.)/std::sqrt(norm);
+  for( int l=llo; l<=lhi; l++ )
+    w[l] *= norm;
+}
+
+static PyObject *healpy_wigner3j(PyObject *self, PyObject *args)
+{
+  PyObject *o[4];
+
+  if( !PyArg_ParseTuple(args, "OOOO", &o[0], &o[1], &o[2], &o[3]) )
+    return NULL;
+
+  PyArrayObject *arr[4] = {NULL, NULL, NULL, NULL};
+  for( int i=0; i<4; i++ )
+    {
+      arr[i] = (PyArrayObject*)PyArray_ContiguousFromAny(o[i], NPY_INT, 1, 1);
+      if( !arr[i] || arr[i]->dimensions[0] != arr[0]->dimensions[0] )
+        {
+          for( int j=0; j<=i; j++ )
+            Py_XDECREF(arr[j]);
+          if( !PyErr_Occurred() )
+            PyErr_SetString(PyExc_ValueError,
+                            "l1, l2, m1 and m2 must have the same size.");
+          return NULL;
+        }
+    }
+  const int *l1 = (const int*)arr[0]->data, *l2 = (const int*)arr[1]->data;
+  const int *m1 = (const int*)arr[2]->data, *m2 = (const int*)arr[3]->data;
+  npy_intp n = arr[0]->dimensions[0];
+  int lmax = 0;
+  for( npy_intp i=0; i<n; i++ )
+    {
+      if( l1[i] < 0 || l2[i] < 0 )
+        {
+          for( int j=0; j<4; j++ )
+            Py_DECREF(arr[j]);
+          PyErr_SetString(PyExc_ValueError, "l1 and l2 must be positive.");
+          return NULL;
+        }
+      lmax = std::max(lmax, l1[i]+l2[i]);
+    }
+
+  npy_intp dims[2] = {n, lmax+1};
+  PyArrayObject *wout = (PyArrayObject*)PyArray_ZEROS(2, dims, NPY_DOUBLE, 0);
+  if( wout )
+    {
+      double *w = (double*)wout->data;
+#pragma omp parallel
+{
+      std::vector<double> v(lmax+1);
+#pragma omp for schedule(dynamic,1)
+      for( npy_intp i=0; i<n; i++ )
+        wigner3j(l1[i], l2[i], m1[i], m2[i], &w[i*(lmax+1)], &v[0]);
+}
+    }
+
+  for( int j=0; j<4; j++ )
+    Py_DECREF(arr[j]);
+  if( !wout ) return NULL;
+  return Py_BuildValue("N",wout);
+}
+
+static PyObject *healpy_coupling_matrix(PyObject *self, PyObject *args,
+                                        PyObject *kwds)
+{
+  PyObject *wl_ = NULL;
+  int lmax = -1;
+
+  static const char* kwlist[] = {"","lmax", NULL};
+
+  if( !PyArg_ParseTupleAndKeywords(args, kwds, "O|i", (char **)kwlist,
+                                   &wl_, &lmax) )
+    return NULL;
+
+  PyArrayObject *wlarr = (PyArrayObject*)
+    PyArray_ContiguousFromAny(wl_, NPY_DOUBLE, 1, 1);
+  if( !wlarr ) return NULL;
+  int lmaxw = wlarr->dimensions[0]-1;
+  if( lmax < 0 )
+    lmax = lmaxw;
+
+  npy_intp dims[2] = {lmax+1, lmax+1};
+  PyArrayObject *matout = (PyArrayObject*)PyArray_SimpleNew(2, dims, NPY_DOUBLE);
+  if( !matout ) { Py_DECREF(wlarr); return NULL; }
+
+  const double *wl = (const double*)wlarr->data;
+  double *mat = (double*)matout->data;
+  std::vector<double> lf(4*lmax+2);
+  lf[0] = 0.;
+  for( size_t i=1; i<lf.size(); i++ )
+    lf[i] = lf[i-1]+std::log(double(i));
+
+  /* M[l1,l2]/(2*l2+1) is symmetric: only l2>=l1 is computed */
+#pragma omp parallel
+{
+  std::vector<double> w(2*lmax+1);
+#pragma omp for schedule(dynamic,1)
+  for( int l1=0; l1<=lmax; l1++ )
+    for( int l2=l1; l2<=lmax; l2++ )
+      {
+        wigner3j_000_sq(l1, l2, lf, &w[0]);
+        double sum = 0.;
+        for( int l3=l2-l1; l3<=std::min(l1+l2,lmaxw); l3+=2 )
+          sum += (2*l3+1)*wl[l3]*w[l3];
+        sum /= 4*pi;
+        mat[l1*(lmax+1)+l2] = (2*l2+1)*sum;
+        mat[l2*(lmax+1)+l1] = (2*l1+1)*sum;
+      }
+}
+
+  Py_DECREF(wlarr);
+  return Py_BuildValue("N",matout);
+}
+
 PyObject *healpy_getn(PyObject *self, PyObject *args)
 {
   long s;
@@ -999,7 +1713,8 @@ static PyMethodDef SphtMethods[] = {
    "Compute alm or cl from an input map.\n"
    "The input map is assumed to be ordered in RING.\n"
    "anafast(map,lmax=3*nside-1,mmax=lmax,cl=False,\n"
-   "        iter=3,use_weights=False,data_path=None,regression=True)"},
+   "        iter=3,use_weights=False,data_path=None,regression=True,\n"
+   "        weights=None)"},
   {"_alm2map", (PyCFunction)healpy_alm2map, METH_VARARGS | METH_KEYWORDS,
    "Compute a map from alm.\n"
    "The output map is ordered in RING scheme.\n"
@@ -1010,6 +1725,32 @@ static PyMethodDef SphtMethods[] = {
    "alm2map_der1(alm,nside=64,lmax=-1,mmax=-1)"},
   {"_synalm", (PyCFunction)healpy_synalm, METH_VARARGS | METH_KEYWORDS,
    "Compute alm's given cl's and unit variance random arrays.\n"},
+  {"_synalm_rng", healpy_synalm_rng, METH_VARARGS,
+   "Draw into alm (a complex128 or complex64 (n,nalm) array) Gaussian\n"
+   "alm's with the n(n+1)/2 spectra cls (a (n(n+1)/2,lmax+1) array),\n"
+   "with the random stream given by seed and stream.\n"
+   "_synalm_rng(cls,alm,lmax,mmax,seed,stream)"},
+  {"_wigner_d_rotation", healpy_wigner_d_rotation, METH_VARARGS,
+   "Compute the Wigner d matrices at angle theta needed by _rotate_alm.\n"
+   "_wigner_d_rotation(lmax,theta)"},
+  {"_rotate_alm", (PyCFunction)healpy_rotate_alm, METH_VARARGS | METH_KEYWORDS,
+   "Rotate in place a sequence of alm (lmax==mmax) by the Euler angles\n"
+   "psi, theta, phi, using the matrices of _wigner_d_rotation if given.\n"
+   "_rotate_alm(alms,psi,theta,phi,d=None)"},
+  {"_alm2cl", (PyCFunction)healpy_alm2cl, METH_VARARGS | METH_KEYWORDS,
+   "Compute the cross-spectra between each alm of alm1 and each alm of\n"
+   "alm2 (2D arrays), as a (n1,n2,lmax+1) array.\n"
+   "_alm2cl(alm1,alm2,lmax,mmax=-1)"},
+  {"_coupling_matrix", (PyCFunction)healpy_coupling_matrix,
+   METH_VARARGS | METH_KEYWORDS,
+   "Compute the mode coupling matrix of a mask, given the power spectrum\n"
+   "wl of the mask, as a (lmax+1,lmax+1) array.\n"
+   "_coupling_matrix(wl,lmax=len(wl)-1)"},
+  {"_wigner3j", healpy_wigner3j, METH_VARARGS,
+   "Compute the Wigner 3j symbols (l1 l2 l3;m1 m2 -m1-m2) for all l3,\n"
+   "for each element of the 1D arrays l1, l2, m1, m2, as a\n"
+   "(n,max(l1+l2)+1) array.\n"
+   "_wigner3j(l1,l2,m1,m2)"},
   {"_getn", healpy_getn, METH_VARARGS,
    "Compute number n such that n(n+1)/2 is equal to the argument.\n"},
   {NULL, NULL, 0, NULL} /* Sentinel */
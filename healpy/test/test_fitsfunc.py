@@ -6,6 +6,7 @@ import numpy as np
 import healpy
 from healpy.fitsfunc import *
 from healpy.sphtfunc import *
+from healpy.pixelfunc import UNSEEN
 
 class TestFitsFunc(unittest.TestCase):
     
@@ -30,6 +31,370 @@ class TestFitsFunc(unittest.TestCase):
     def tearDown(self):
         os.remove(self.filename)
 
+class TestReadMapMemmap(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 16
+        self.m = np.arange(healpy.nside2npix(self.nside), dtype=np.float32)
+        self.m[3] = UNSEEN
+        self.filename = 'testmap_memmap.fits'
+
+    def test_single_column(self):
+        write_map(self.filename, self.m)
+        mm = read_map(self.filename, memmap=True)
+        self.assertTrue(isinstance(mm, np.memmap))
+        self.assertEqual(mm.dtype, np.dtype('>f4'))
+        self.assertFalse(mm.flags.writeable)
+        self.assertTrue(np.all(mm == self.m))
+        self.assertTrue(np.all(mm == read_map(self.filename, dtype=np.float32)))
+
+    def test_multi_column(self):
+        write_map(self.filename, [self.m, 2*self.m, 3*self.m], nest=True)
+        maps = read_map(self.filename, field=(0,1,2), memmap=True, nest=None)
+        for i, mm in enumerate(maps):
+            self.assertFalse(mm.flags.writeable)
+            self.assertTrue(np.all(mm == (i+1)*self.m))
+        mm = read_map(self.filename, field=2, memmap=True, dtype=np.float64)
+        self.assertEqual(mm.dtype, np.float64)
+        self.assertTrue(np.all(mm == read_map(self.filename, field=2)))
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+class TestReadMapPixels(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 32
+        self.m = np.arange(healpy.nside2npix(self.nside), dtype=np.float64)
+        self.filename = 'testmap_pixels.fits'
+
+    def test_pixels(self):
+        write_map(self.filename, [self.m, -self.m, 2*self.m], dtype=np.float64)
+        pix = np.array([5, 12287, 1030, 4, 2048])
+        m0, m1 = read_map(self.filename, field=(0,1), pixels=pix)
+        np.testing.assert_array_equal(m0, self.m[pix])
+        np.testing.assert_array_equal(m1, -self.m[pix])
+        m = read_map(self.filename, pixels=pix, nest=True)
+        np.testing.assert_array_equal(m, healpy.reorder(self.m, r2n=True)[pix])
+
+    def test_region(self):
+        write_map(self.filename, self.m, nest=True)
+        pix, m = read_map_region(self.filename, 4, [7, 100])
+        self.assertEqual(pix.size, 2*(self.nside//4)**2)
+        np.testing.assert_array_equal(pix[:64], 7*64 + np.arange(64))
+        np.testing.assert_array_equal(m, self.m[pix])
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+class TestPartialMap(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 64
+        npix = healpy.nside2npix(self.nside)
+        self.m = np.empty(npix)
+        self.m.fill(UNSEEN)
+        self.pix = np.arange(1000, 1500)
+        self.m[self.pix] = np.arange(500.)
+        self.filename = 'testmap_partial.fits'
+
+    def test_write_read(self):
+        write_map(self.filename, self.m, partial=True)
+        hdr = pyfits.getheader(self.filename, 1)
+        self.assertEqual(hdr['INDXSCHM'], 'EXPLICIT')
+        self.assertEqual(hdr['NAXIS2'], self.pix.size)
+        np.testing.assert_array_equal(read_map(self.filename), self.m)
+        m = read_map(self.filename, nest=True)
+        np.testing.assert_array_equal(m, healpy.reorder(self.m, r2n=True))
+        np.testing.assert_array_equal(read_map(self.filename, pixels=[999, 1200]),
+                                      [UNSEEN, 200.])
+
+    def test_pol(self):
+        write_map(self.filename, [self.m, 2*self.m, 3*self.m], partial=True)
+        m = read_map(self.filename, field=(0,1,2))
+        np.testing.assert_array_equal(m[2][self.pix], 3*self.m[self.pix])
+        self.assertTrue(np.all(m[1][:1000] == UNSEEN))
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+class TestCompressedMap(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 32
+        np.random.seed(12)
+        self.m = np.random.standard_normal(healpy.nside2npix(self.nside))
+        self.m[10] = UNSEEN
+        self.filename = 'testmap_compressed.fits'
+
+    def test_lossless(self):
+        write_map(self.filename, [self.m, 2*self.m, 3*self.m], compress=True)
+        self.assertTrue(isinstance(pyfits.open(self.filename)[1], pyfits.CompImageHDU))
+        m = read_map(self.filename, field=(0,2), dtype=np.float32)
+        np.testing.assert_array_equal(m[0], self.m.astype(np.float32))
+        np.testing.assert_array_equal(m[1], (3*self.m).astype(np.float32))
+        self.assertEqual(read_map(self.filename)[10], UNSEEN)
+        np.testing.assert_array_equal(read_map(self.filename, pixels=[3, 5000], field=1),
+                                      (2*self.m[[3, 5000]]).astype(np.float32))
+
+    def test_quantized(self):
+        write_map('testmap_ref.fits', self.m)
+        write_map(self.filename, self.m, compress='RICE_1', quantize_level=4)
+        try:
+            self.assertTrue(os.path.getsize(self.filename) <
+                            os.path.getsize('testmap_ref.fits') / 2)
+        finally:
+            os.remove('testmap_ref.fits')
+        m = read_map(self.filename, nest=True)
+        good = self.m != UNSEEN
+        ref = healpy.reorder(self.m, r2n=True)
+        self.assertTrue(np.abs(m - ref)[healpy.reorder(good, r2n=True)].max() < 0.2)
+        self.assertEqual(read_map(self.filename)[10], UNSEEN)
+        m2 = read_map(self.filename, nest=True, nthreads=2)
+        np.testing.assert_array_equal(m2, m)
+
+    def test_units(self):
+        maps = [self.m, 2*self.m, 3*self.m]
+        write_map(self.filename, maps, compress=True, units=['K','K','K'])
+        hdr = pyfits.getheader(self.filename, 1)
+        self.assertEqual((hdr['BUNIT'], hdr['BUNIT3']), ('K', 'K'))
+        write_map(self.filename, maps, compress=True, units=['K','uK','uK'])
+        hdr = pyfits.getheader(self.filename, 1)
+        self.assertEqual((hdr['BUNIT1'], hdr['BUNIT2']), ('K', 'uK'))
+        self.assertFalse('BUNIT' in hdr)
+        self.assertRaises(ValueError, write_map, self.filename, maps,
+                          compress=True, units=['K','K'])
+
+    def test_parallel(self):
+        write_map(self.filename, [self.m, 2*self.m, 3*self.m], compress=True)
+        plan = healpy.fitsfunc._native_map_plan(self.filename, (2, 0), 1)
+        self.assertEqual(plan[2], 'image')
+        self.assertEqual(len(healpy.fitsfunc._plan_segments(
+            self.filename, 1, plan, (0, 1), 3)), 3)
+        ref = read_map(self.filename, field=(0,1,2), nthreads=1)
+        # use the worker processes even for this small map
+        min_bytes = healpy.fitsfunc._min_worker_bytes
+        healpy.fitsfunc._min_worker_bytes = 0
+        try:
+            m = read_map(self.filename, field=(0,1,2), nthreads=3)
+        finally:
+            healpy.fitsfunc._min_worker_bytes = min_bytes
+        for i in range(3):
+            np.testing.assert_array_equal(m[i], ref[i])
+            np.testing.assert_array_equal(m[i][self.m != UNSEEN],
+                ((i+1)*self.m).astype(np.float32)[self.m != UNSEEN])
+        self.assertEqual(m[0][10], UNSEEN)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+class TestHealpixFitsWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 32
+        self.m = np.arange(healpy.nside2npix(self.nside), dtype=np.float64)
+        self.filename = 'testmap_writer.fits'
+
+    def test_chunks(self):
+        w = HealpixFitsWriter(self.filename, self.nside, nmaps=3, nest=True)
+        for start in range(0, self.m.size, 1000):
+            chunk = self.m[start:start+1000]
+            w.write((chunk, 2*chunk, 3*chunk))
+        w.close()
+        write_map('testmap_ref.fits', [self.m, 2*self.m, 3*self.m], nest=True)
+        try:
+            hdr = pyfits.getheader(self.filename, 1)
+            ref = pyfits.getheader('testmap_ref.fits', 1)
+            for key in ('NAXIS1', 'NAXIS2', 'TFORM1', 'TTYPE3', 'NSIDE', 'ORDERING'):
+                self.assertEqual(hdr[key], ref[key])
+            np.testing.assert_array_equal(pyfits.getdata(self.filename, 1).field(1),
+                                          pyfits.getdata('testmap_ref.fits', 1).field(1))
+        finally:
+            os.remove('testmap_ref.fits')
+        m = read_map(self.filename, field=(0,1,2), nest=True)
+        np.testing.assert_array_equal(m[2], 3*self.m)
+
+    def test_incomplete(self):
+        w = HealpixFitsWriter(self.filename, self.nside)
+        w.write(self.m[:5000])
+        self.assertRaises(ValueError, w.write, self.m)
+        self.assertRaises(IOError, w.close)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+class TestReadMapInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 32
+        self.m = np.arange(healpy.nside2npix(self.nside), dtype=np.float64)
+        self.filename = 'testmap_info.fits'
+
+    def test_info(self):
+        write_map(self.filename, [self.m, self.m, self.m], nest=True,
+                  dtype=np.float64)
+        info = read_map_info(self.filename)
+        self.assertEqual(info['nside'], self.nside)
+        self.assertEqual(info['ordering'], 'NESTED')
+        self.assertEqual(info['indxschm'], 'IMPLICIT')
+        self.assertEqual(info['columns'][1], ('Q_STOKES', '>f8', 1024))
+        self.assertEqual(info['column_offsets'], [0, 8192, 16384])
+        self.assertEqual((info['nrows'], info['rowsize']), (12, 3*8192))
+        self.assertFalse(info['compressed'])
+        hdulist = pyfits.open(self.filename)
+        self.assertEqual(info['data_offset'], hdulist.fileinfo(1)['datLoc'])
+        hdulist.close()
+        # the data offset gives direct access to the table
+        f = open(self.filename, 'rb')
+        f.seek(info['data_offset'] + info['column_offsets'][2])
+        self.assertEqual(np.fromstring(f.read(16), '>f8').tolist(), [0., 1.])
+        f.close()
+
+    def test_compressed(self):
+        write_map(self.filename, self.m, compress=True)
+        info = read_map_info(self.filename)
+        self.assertTrue(info['compressed'])
+        self.assertEqual(info['nside'], self.nside)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+class TestReadMaps(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 16
+        self.m = np.arange(healpy.nside2npix(self.nside), dtype=np.float64)
+        self.filenames = ['testmaps_%d.fits' % i for i in range(3)]
+        write_map(self.filenames[0], [self.m, 2*self.m, 3*self.m])
+        write_map(self.filenames[1], [-self.m, self.m, self.m], nest=True)
+        write_map(self.filenames[2], [self.m, 2*self.m, 3*self.m], partial=True)
+
+    def test_read_maps(self):
+        maps = read_maps(self.filenames, fields=(0,2), nthreads=2)
+        self.assertEqual(maps.shape, (6, self.m.size))
+        for i in range(3):
+            ref = read_map(self.filenames[i], field=(0,2))
+            np.testing.assert_array_equal(maps[2*i], ref[0])
+            np.testing.assert_array_equal(maps[2*i+1], ref[1])
+        out = np.zeros((3, self.m.size), dtype=np.float32)
+        self.assertTrue(read_maps(self.filenames, nest=True, out=out) is out)
+        np.testing.assert_array_equal(out[0], healpy.reorder(self.m, r2n=True))
+        np.testing.assert_array_equal(out[1], -self.m)
+
+    def test_compressed(self):
+        write_map(self.filenames[2], [self.m, 2*self.m, 3*self.m],
+                  compress=True)
+        ref = read_maps(self.filenames, fields=(1,2), nthreads=1)
+        min_bytes = healpy.fitsfunc._min_worker_bytes
+        healpy.fitsfunc._min_worker_bytes = 0
+        try:
+            maps = read_maps(self.filenames, fields=(1,2), nthreads=3)
+            # the worker processes are kept for the next reads
+            np.testing.assert_array_equal(
+                read_maps(self.filenames, fields=(1,2), nthreads=3), ref)
+        finally:
+            healpy.fitsfunc._min_worker_bytes = min_bytes
+        np.testing.assert_array_equal(maps, ref)
+        np.testing.assert_array_equal(maps[4], 2*self.m)
+
+    def tearDown(self):
+        for f in self.filenames:
+            os.remove(f)
+
+class TestNativeFitsIO(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 32
+        self.m = np.arange(healpy.nside2npix(self.nside), dtype=np.float64)
+        self.filename = 'testmap_native.fits'
+
+    def test_map(self):
+        write_map(self.filename, [self.m, 2*self.m, 3*self.m], nest=True,
+                  dtype=np.float64)
+        hdr = pyfits.getheader(self.filename, 1)
+        self.assertEqual(hdr['TFORM2'], '1024D')
+        self.assertEqual(hdr['ORDERING'], 'NESTED')
+        np.testing.assert_array_equal(
+            pyfits.getdata(self.filename, 1).field(1).ravel(), 2*self.m)
+        plan = healpy.fitsfunc._native_map_plan(
+            self.filename, (2, 'I_STOKES'), 1)
+        self.assertEqual(plan[:3], (self.nside, 'NESTED', 'columns'))
+        out = np.empty((2, self.m.size), dtype=np.float32)
+        healpy.fitsfunc._read_segments(healpy.fitsfunc._plan_segments(
+            self.filename, 1, plan, (0, 1)), out)
+        np.testing.assert_array_equal(out[0], 3*self.m)
+        np.testing.assert_array_equal(out[1], self.m)
+        np.testing.assert_array_equal(read_map(self.filename, field=1, nest=True),
+                                      2*self.m)
+
+    def test_fallback(self):
+        write_map(self.filename, self.m, partial=True)
+        self.assertTrue(healpy.fitsfunc._native_map_plan(
+            self.filename, (0,), 1) is None)
+
+    def test_cl(self):
+        write_cl(self.filename, self.m[:100])
+        np.testing.assert_array_equal(read_cl(self.filename), self.m[:100])
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+class TestHpxFormat(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 16
+        m = np.arange(healpy.nside2npix(self.nside), dtype=np.float32)
+        m[3] = UNSEEN
+        self.maps = [m, 2*m, 3*m]
+        self.files = ['testmap_hpx.fits', 'testmap_hpx.hpx',
+                      'testmap_hpx2.fits']
+
+    def test_fits_roundtrip(self):
+        write_map(self.files[0], self.maps, nest=True, coord='G', units='K')
+        maps = read_map(self.files[0], field=(0,1,2), dtype=np.float32,
+                        nest=None, h=True)
+        h = dict(maps[-1])
+        self.assertEqual((h['COORDSYS'], h['TUNIT2']), ('G', 'K'))
+        write_map(self.files[1], maps[:3], nest=True, dtype=np.float32,
+                  coord=h['COORDSYS'], units=h['TUNIT1'])
+        hmaps = read_map(self.files[1], field=(0,1,2), memmap=True,
+                         nest=None)
+        for mm, m in zip(hmaps, self.maps):
+            self.assertEqual(mm.dtype, np.float32)
+            np.testing.assert_array_equal(mm, m)
+        for nest in (False, True):
+            np.testing.assert_array_equal(
+                read_map(self.files[1], field=1, nest=nest),
+                read_map(self.files[0], field=1, nest=nest))
+        hmaps = read_map(self.files[1], field=(0,1,2), nest=None, h=True)
+        h = dict(hmaps[-1])
+        self.assertEqual((h['ORDERING'], h['COORDSYS'], h['TUNIT3']),
+                         ('NESTED', 'G', 'K'))
+        write_map(self.files[2], hmaps[:3], nest=True, dtype=np.float32,
+                  coord=h['COORDSYS'], units=h['TUNIT1'])
+        for f in (0, 1, 2):
+            np.testing.assert_array_equal(
+                read_map(self.files[2], field=f, nest=None),
+                read_map(self.files[0], field=f, nest=None))
+
+    def test_alm_cl(self):
+        alms = np.arange(Alm.getsize(32), dtype=np.complex64) * (1+1j)
+        write_alm(self.files[1], alms, lmax=20, mmax=10)
+        write_alm(self.files[0], alms, lmax=20, mmax=10)
+        a0, mmax = read_alm(self.files[1], return_mmax=True)
+        self.assertEqual((a0.dtype, mmax), (np.complex64, 10))
+        np.testing.assert_array_equal(a0, read_alm(self.files[0]))
+        np.testing.assert_array_equal(read_alm(self.files[1], lmax=15),
+                                      read_alm(self.files[0], lmax=15))
+        cl = np.arange(20.)
+        write_cl(self.files[1], cl, dtype=np.float64)
+        np.testing.assert_array_equal(read_cl(self.files[1]), cl)
+
+    def tearDown(self):
+        for f in self.files:
+            if os.path.exists(f):
+                os.remove(f)
+
 class TestReadWriteAlm(unittest.TestCase):
 
     def setUp(self):
@@ -68,5 +433,48 @@ class TestReadWriteAlm(unittest.TestCase):
 	idx = idx[idx_mmax]
 	np.testing.assert_array_almost_equal(self.alms[idx], a0)
 
+    def test_read_alm_lmax_mmax(self):
+        write_alm('testalm_256_128.fits',self.alms,lmax=256,mmax=128)
+        a0,mmax = read_alm('testalm_256_128.fits',lmax=100,mmax=50,
+                           return_mmax=True)
+        self.assertEqual(mmax, 50)
+        self.assertEqual(len(a0), Alm.getsize(100,50))
+        l0,m0 = Alm.getlm(100)
+        sel = m0 <= 50
+        np.testing.assert_array_equal(self.alms[Alm.getidx(256,l0[sel],
+                                                           m0[sel])], a0)
+
+    def test_read_alm_negative_m(self):
+        # all the m, negative ones included, for l <= 2
+        l0 = np.repeat(np.arange(3), [1, 3, 5])
+        m0 = np.concatenate([np.arange(-l, l+1) for l in range(3)])
+        cols = [pyfits.Column(name='index',format='J',array=l0*l0+l0+m0+1),
+                pyfits.Column(name='real',format='D',array=np.ones(9)),
+                pyfits.Column(name='imag',format='D',array=np.zeros(9))]
+        if os.path.exists('testalm_negm.fits'):
+            os.remove('testalm_negm.fits')
+        pyfits.new_table(cols).writeto('testalm_negm.fits')
+        try:
+            self.assertRaises(ValueError, read_alm, 'testalm_negm.fits')
+        finally:
+            os.remove('testalm_negm.fits')
+
+    def test_read_alm_lmax_any_order(self):
+        # rows ordered by l, then m, as written by Healpix F90
+        l0,m0 = Alm.getlm(256)
+        order = np.lexsort((m0,l0))
+        cols = [pyfits.Column(name='index',format='J',
+                          array=Alm.lm2fits(l0,m0)[order]),
+                pyfits.Column(name='real',format='D',array=self.alms.real[order]),
+                pyfits.Column(name='imag',format='D',array=self.alms.imag[order])]
+        if os.path.exists('testalm_lorder.fits'):
+            os.remove('testalm_lorder.fits')
+        pyfits.new_table(cols).writeto('testalm_lorder.fits')
+        np.testing.assert_array_equal(read_alm('testalm_lorder.fits'),
+                                      self.alms)
+        a0 = read_alm('testalm_lorder.fits',lmax=64)
+        l1,m1 = Alm.getlm(64)
+        np.testing.assert_array_equal(self.alms[Alm.getidx(256,l1,m1)], a0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,67 @@
+import os
+import unittest
+import numpy as np
+
+import healpy
+from healpy.hpxfunc import *
+from healpy.sphtfunc import Alm
+
+class TestHpxFunc(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 16
+        self.m = np.arange(healpy.nside2npix(self.nside), dtype=np.float32)
+        self.filename = 'testmap.hpx'
+
+    def test_map_stack(self):
+        maps = [self.m, 2*self.m, 3*self.m, 4*self.m]
+        write_hpx(self.filename, maps, nest=True, coord='G', units='K')
+        self.assertTrue(ishpxfile(self.filename))
+        info = read_hpx_info(self.filename)
+        self.assertEqual(info['kind'], 'map')
+        self.assertEqual(info['nside'], self.nside)
+        self.assertEqual(info['ordering'], 'NESTED')
+        self.assertEqual(info['coord'], 'G')
+        self.assertEqual(info['units'], 'K')
+        self.assertEqual(info['shape'], (4, self.m.size))
+        self.assertEqual(info['offset'] % 64, 0)
+        data = read_hpx(self.filename)
+        self.assertEqual(data.dtype, np.float32)
+        np.testing.assert_array_equal(data, maps)
+
+    def test_numpy_memmap(self):
+        write_hpx(self.filename, self.m, dtype=np.float64)
+        h = np.fromfile(self.filename, dtype=hpx_header_dtype, count=1)[0]
+        data = np.memmap(self.filename, dtype=h['dtype'], mode='r',
+                         offset=h['offset'], shape=(h['nrows'], h['ncols']))
+        self.assertEqual(data.dtype, np.dtype('<f8'))
+        np.testing.assert_array_equal(data[0], self.m)
+        mm = read_hpx(self.filename, memmap=True)
+        self.assertTrue(isinstance(mm, np.memmap))
+        self.assertFalse(mm.flags.writeable)
+        np.testing.assert_array_equal(mm, self.m)
+
+    def test_alm_cl(self):
+        alm = np.arange(Alm.getsize(20, 10)) * (1+2j)
+        write_hpx(self.filename, alm, kind='alm', mmax=10)
+        info = read_hpx_info(self.filename)
+        self.assertEqual((info['lmax'], info['mmax']), (20, 10))
+        np.testing.assert_array_equal(read_hpx(self.filename), alm)
+        self.assertRaises(TypeError, write_hpx, self.filename, alm.real,
+                          kind='alm')
+        cl = np.arange(11.)
+        write_hpx(self.filename, [cl, 2*cl], kind='cl')
+        self.assertEqual(read_hpx_info(self.filename)['lmax'], 10)
+        np.testing.assert_array_equal(read_hpx(self.filename), [cl, 2*cl])
+
+    def test_not_hpx(self):
+        open(self.filename, 'wb').write('SIMPLE  =' + ' '*300)
+        self.assertFalse(ishpxfile(self.filename))
+        self.assertRaises(IOError, read_hpx, self.filename)
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+if __name__ == '__main__':
+    unittest.main()
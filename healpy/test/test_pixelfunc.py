@@ -1,5 +1,7 @@
 from healpy.pixelfunc import *
 
+import numpy as np
+
 import unittest
 
 class TestPixelFunc(unittest.TestCase):
@@ -18,5 +20,15 @@ class TestPixelFunc(unittest.TestCase):
     def test_nside2pixarea(self):
         self.assertAlmostEqual(nside2pixarea(512), 3.9947416351188569e-06)
 
+    def test_ringinfo(self):
+        nside = 8
+        rings = np.arange(1,4*nside)
+        startpix,ringpix,theta,shifted = ringinfo(nside,rings)
+        self.assertEqual(ringpix.sum(),nside2npix(nside))
+        self.assertTrue(np.all(startpix[1:] == startpix[:-1]+ringpix[:-1]))
+        th,ph = pix2ang(nside,startpix)
+        np.testing.assert_array_almost_equal(th,theta)
+        np.testing.assert_array_almost_equal(ph,np.where(shifted,np.pi/ringpix,0.))
+
 if __name__ == '__main__':
     unittest.main()
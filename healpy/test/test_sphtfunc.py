@@ -0,0 +1,493 @@
+import unittest
+import tempfile
+import shutil
+import math
+import os
+import numpy as np
+
+import healpy
+from healpy.sphtfunc import *
+
+class TestSHTPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 16
+        self.lmax = 2*self.nside
+        np.random.seed(1234)
+        cl = 1./(np.arange(self.lmax+1)+1.)**2
+        self.alm = synalm(cl,lmax=self.lmax)
+        self.map = alm2map(self.alm.copy(),self.nside,lmax=self.lmax)
+
+    def test_alm2map(self):
+        plan = SHTPlan(self.nside,lmax=self.lmax)
+        m = plan.alm2map(self.alm)
+        np.testing.assert_array_almost_equal(m,self.map)
+
+    def test_map2alm(self):
+        plan = SHTPlan(self.nside,lmax=self.lmax)
+        alm = plan.map2alm(self.map,iter=1)
+        alm_ref = map2alm(self.map,lmax=self.lmax,iter=1)
+        np.testing.assert_array_almost_equal(alm,alm_ref)
+
+    def test_map2alm_tol(self):
+        alm,niter = map2alm(self.map,lmax=self.lmax,iter=20,tol=1e-8,
+                            return_iter=True)
+        self.assertTrue(0 < niter < 20)
+        np.testing.assert_array_almost_equal(alm,self.alm)
+        alm5 = map2alm(self.map,lmax=self.lmax,iter=niter)
+        np.testing.assert_array_almost_equal(alm,alm5,decimal=10)
+        plan = SHTPlan(self.nside,lmax=self.lmax)
+        alm = plan.map2alm(self.map,iter=20,tol=1e-8)
+        self.assertEqual(plan.niter,niter)
+        np.testing.assert_array_almost_equal(alm,alm5,decimal=10)
+
+    def test_anafast_tol_pol(self):
+        cl = 1./(np.arange(self.lmax+1)+1.)**2
+        cl[:2] = 0
+        alms = synalm((cl,cl,cl,cl),lmax=self.lmax)
+        maps = alm2map([a.copy() for a in alms],self.nside,lmax=self.lmax)
+        cl,alm,niter = anafast(maps,lmax=self.lmax,iter=20,tol=1e-8,
+                               alm=True,return_iter=True)
+        self.assertTrue(0 < niter < 20)
+        for a,aref in zip(alm,alms):
+            np.testing.assert_array_almost_equal(a,aref)
+
+    def test_stack_out(self):
+        plan = SHTPlan(self.nside,lmax=self.lmax)
+        out = np.empty((2,healpy.nside2npix(self.nside)))
+        m = plan.alm2map(np.array([self.alm,2*self.alm]),out=out)
+        self.assertTrue(m is out)
+        np.testing.assert_array_almost_equal(m[0],self.map)
+        np.testing.assert_array_almost_equal(m[1],2*self.map)
+
+    def test_cut_sky(self):
+        theta,phi = healpy.pix2ang(self.nside,np.arange(self.map.size))
+        m = np.where((theta > 0.5)&(theta < 1.),self.map,0.)
+        full = SHTPlan(self.nside,lmax=self.lmax)
+        cut = SHTPlan(self.nside,lmax=self.lmax,mask=m)
+        self.assertTrue(cut.rings.size < 4*self.nside-1)
+        np.testing.assert_array_almost_equal(
+            cut.map2alm(m,iter=0,regression=False),
+            full.map2alm(m,iter=0,regression=False))
+        mcut = cut.alm2map(self.alm)
+        np.testing.assert_array_almost_equal(mcut[m != 0],self.map[m != 0])
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 16
+        self.lmax = 2*self.nside
+        np.random.seed(5678)
+        cl = 1./(np.arange(self.lmax+1)+1.)**2
+        self.alms = synalm((cl,cl,cl,cl),lmax=self.lmax)
+        self.maps = np.array(alm2map([a.copy() for a in self.alms],
+                                     self.nside,lmax=self.lmax))
+        self.maps[0] += 1.
+
+    def test_memmap(self):
+        f = tempfile.NamedTemporaryFile()
+        m = np.memmap(f,dtype=np.float64,mode='w+',shape=self.maps[0].shape)
+        m[:] = self.maps[0]
+        for nrings in (1,3,2*self.nside):
+            alm = map2alm_stream(m,lmax=self.lmax,iter=2,nrings=nrings)
+            np.testing.assert_array_almost_equal(
+                alm,map2alm(self.maps[0],lmax=self.lmax,iter=2))
+
+    def test_pol(self):
+        alms = map2alm_stream(self.maps,lmax=self.lmax,iter=3,
+                              use_weights=True,nrings=5)
+        ref = map2alm(list(self.maps),lmax=self.lmax,iter=3,
+                      use_weights=True)
+        for a,aref in zip(alms,ref):
+            np.testing.assert_array_almost_equal(a,aref)
+
+class TestSHTPool(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 16
+        self.lmax = 2*self.nside
+        np.random.seed(8765)
+        cl = 1./(np.arange(self.lmax+1)+1.)**2
+        self.alms = np.array(synalm((cl,cl,cl,cl),lmax=self.lmax))
+        self.maps = np.array(alm2map([a.copy() for a in self.alms],
+                                     self.nside,lmax=self.lmax))
+
+    def test_pool(self):
+        pool = SHTPool(self.nside,lmax=self.lmax,nproc=3)
+        try:
+            m = pool.alm2map(self.alms[0])
+            np.testing.assert_array_almost_equal(m,self.maps[0])
+            alm = pool.map2alm(m+1.,iter=2)
+            np.testing.assert_array_almost_equal(
+                alm,map2alm(m+1.,lmax=self.lmax,iter=2))
+        finally:
+            pool.close()
+
+    def test_pool_pol(self):
+        pool = SHTPool(self.nside,lmax=self.lmax,pol=True,weights=True,
+                       nproc=2)
+        try:
+            maps = pool.alm2map(np.array([self.alms[:3],2*self.alms[:3]]))
+            np.testing.assert_array_almost_equal(maps[1],2*self.maps)
+            alms = pool.map2alm(maps[0],iter=1)
+            ref = map2alm(list(maps[0]),lmax=self.lmax,iter=1,
+                          use_weights=True)
+            for a,aref in zip(alms,ref):
+                np.testing.assert_array_almost_equal(a,aref)
+        finally:
+            pool.close()
+
+class TestSpin(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 16
+        self.lmax = 2*self.nside
+        np.random.seed(4321)
+        cl = 1./(np.arange(self.lmax+1)+1.)**2
+        cl[:2] = 0
+        self.almE,self.almB = synalm((cl,None,cl),lmax=self.lmax)
+
+    def test_spin2_vs_pol(self):
+        zero = np.zeros_like(self.almE)
+        t,q,u = alm2map((zero,self.almE.copy(),self.almB.copy()),self.nside,
+                        lmax=self.lmax)
+        maps = alm2map_spin((self.almE,self.almB),self.nside,2,lmax=self.lmax)
+        np.testing.assert_array_almost_equal(maps[0],q)
+        np.testing.assert_array_almost_equal(maps[1],u)
+
+    def test_round_trip_plan(self):
+        plan = SHTPlan(self.nside,lmax=self.lmax)
+        maps = alm2map_spin((self.almE,self.almB),self.nside,2,plan=plan)
+        alms = map2alm_spin(maps,2,iter=3,plan=plan)
+        np.testing.assert_array_almost_equal(alms[0],self.almE,decimal=3)
+        np.testing.assert_array_almost_equal(alms[1],self.almB,decimal=3)
+
+class TestSynalmSeed(unittest.TestCase):
+
+    def setUp(self):
+        self.lmax = 64
+        ell = np.arange(self.lmax+1)
+        self.cls = [1./(ell+1.),0.5/(ell+1.),1./(ell+1.),1./(ell+1.)]
+
+    def test_reproducible(self):
+        a1 = synalm(self.cls,lmax=self.lmax,seed=42,stream=3)
+        a2 = synalm(self.cls,lmax=self.lmax,seed=42,stream=3)
+        a3 = synalm(self.cls,lmax=self.lmax,seed=42,stream=4)
+        a4 = synalm(self.cls,lmax=self.lmax,seed=42,stream=3,
+                    dtype=np.complex64)
+        self.assertEqual(len(a1),3)
+        np.testing.assert_array_equal(a1,a2)
+        self.assertFalse(np.any(np.array(a1) == np.array(a3)))
+        self.assertEqual(a4[0].dtype,np.complex64)
+        np.testing.assert_array_equal(a4,np.array(a1).astype(np.complex64))
+
+    def test_statistics(self):
+        alms = [synalm(self.cls,lmax=self.lmax,mmax=40,seed=7,stream=i)
+                for i in xrange(20)]
+        self.assertEqual(alms[0][0].size,Alm.getsize(self.lmax,40))
+        alms = np.array(alms)
+        layout = Alm.layout(self.lmax,40)
+        self.assertTrue(np.all(alms[:,:,layout.m == 0].imag == 0))
+        w = np.where(layout.m == 0,1.,2.)
+        var = lambda a,b: ((w*(layout.l+1.)*(a*b.conj()).real).sum()
+                           /(w.sum()*len(a)))
+        self.assertTrue(abs(var(alms[:,0],alms[:,0])-1.) < 0.03)
+        self.assertTrue(abs(var(alms[:,0],alms[:,1])-0.5) < 0.03)
+        self.assertTrue(abs(var(alms[:,1],alms[:,2])) < 0.03)
+
+class TestSynfastEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 16
+        ell = np.arange(3*self.nside)
+        self.cls = [1./(ell+1.),0.5/(ell+1.),1./(ell+1.),0.5/(ell+1.)]
+
+    def test_vs_synfast(self):
+        engine = SynfastEngine(self.cls,self.nside,pixwin=True,fwhm=0.1,
+                               nsims=3,seed=11,first=2,alm=True)
+        self.assertEqual(len(engine),3)
+        for i,(maps,alms) in enumerate(engine):
+            ref,refalm = synfast(self.cls,self.nside,pixwin=True,fwhm=0.1,
+                                 seed=11,stream=i+2,alm=True)
+            np.testing.assert_array_almost_equal(maps,ref)
+            np.testing.assert_array_almost_equal(alms,refalm)
+        self.assertTrue(maps is engine._maps)
+
+    def test_threaded(self):
+        engine = SynfastEngine(self.cls[0],self.nside,nsims=4,seed=5)
+        maps = [m.copy() for m in engine]
+        engine = SynfastEngine(self.cls[0],self.nside,seed=5,threaded=True)
+        for i,m in enumerate(engine):
+            np.testing.assert_array_equal(m,maps[i])
+            if i == 2:
+                break
+        np.testing.assert_array_equal(engine.realization(3),maps[3])
+
+class TestRotateAlm(unittest.TestCase):
+
+    def setUp(self):
+        self.lmax = 16
+        np.random.seed(2468)
+        cl = 1./(np.arange(self.lmax+1)+1.)**2
+        self.alms = synalm((cl,cl,cl,cl),lmax=self.lmax)
+        self.rot = healpy.Rotator(rot=[20.,30.,40.])
+
+    def test_dipole_direction(self):
+        nside = 8
+        alm = np.zeros(Alm.getsize(1),dtype=np.complex128)
+        alm[1] = 1.
+        m = alm2map(rotate_alm(alm,self.rot),nside,lmax=1)
+        vec = np.array(healpy.pix2vec(nside,np.arange(12*nside**2)))
+        zrot = np.dot(np.asarray(self.rot.mat),[0.,0.,1.])
+        np.testing.assert_array_almost_equal(m/np.sqrt(3./(4*np.pi)),
+                                             np.dot(zrot,vec))
+
+    def test_round_trip_inplace(self):
+        alms = np.array(self.alms)
+        rotate_alm(alms,self.rot,inplace=True)
+        self.assertTrue(((self.lmax,) in
+                         [k[:1] for k in healpy.sphtfunc._wigner_cache]))
+        rotate_alm(alms,self.rot.get_inverse(),inplace=True)
+        np.testing.assert_array_almost_equal(alms,np.array(self.alms))
+
+    def test_stack_vs_single(self):
+        rotated = rotate_alm(self.alms,self.rot)
+        healpy.sphtfunc._wigner_cache.clear()
+        np.testing.assert_array_almost_equal(
+            rotated[2],rotate_alm(self.alms[2],self.rot.mat))
+
+class TestAlm2cl(unittest.TestCase):
+
+    def setUp(self):
+        self.lmax = 20
+        self.mmax = 12
+        np.random.seed(1357)
+        cl = 1./(np.arange(self.lmax+1)+1.)**2
+        self.alms = np.array(synalm((cl,cl,cl,cl),lmax=self.lmax,
+                                    mmax=self.mmax))
+
+    def cross(self,a,b):
+        l,m = Alm.getlm(self.lmax,np.arange(a.size))
+        w = np.where(m == 0,1.,2.)*(a*b.conj()).real
+        return np.bincount(l,w,self.lmax+1)/(2*np.arange(self.lmax+1)+1)
+
+    def test_pol(self):
+        cls = alm2cl(self.alms,mmax=self.mmax,nspec=6)
+        a = self.alms
+        ref = [self.cross(a[i],a[j]) for i,j in
+               ((0,0),(1,1),(2,2),(0,1),(0,2),(1,2))]
+        for c,r in zip(cls,ref):
+            np.testing.assert_array_almost_equal(c,r)
+        np.testing.assert_array_almost_equal(
+            alm2cl(a[0],mmax=self.mmax),ref[0])
+
+    def test_cross_stacks(self):
+        a = self.alms
+        b = np.array([a[::-1],2*a])
+        cl = alm2cl(a,mmax=self.mmax,alm2=b)
+        self.assertEqual(cl.shape,(3,2,3,self.lmax+1))
+        np.testing.assert_array_almost_equal(cl[1,0,0],self.cross(a[1],a[2]))
+        np.testing.assert_array_almost_equal(cl[2,1,0],
+                                             2*self.cross(a[2],a[0]))
+
+class TestAlmxfl(unittest.TestCase):
+
+    def setUp(self):
+        self.lmax = 20
+        self.mmax = 12
+        np.random.seed(9753)
+        cl = np.ones(self.lmax+1)
+        self.alm = synalm(cl,lmax=self.lmax,mmax=self.mmax)
+
+    def test_stack_and_filters(self):
+        fl1 = np.arange(self.lmax+1,dtype=float)
+        fl2 = np.linspace(1.,0.,self.lmax-4)
+        l,m = Alm.getlm(self.lmax,np.arange(self.alm.size))
+        l = l[m <= self.mmax]
+        f = np.where(l < fl2.size,fl1[l]*fl2[np.minimum(l,fl2.size-1)],0)
+        alms = np.array([self.alm,2*self.alm])
+        out = almxfl(alms,[fl1,fl2],mmax=self.mmax)
+        np.testing.assert_array_almost_equal(out[0],self.alm*f)
+        np.testing.assert_array_almost_equal(out[1],2*self.alm*f)
+        res = almxfl(alms,fl1,mmax=self.mmax,inplace=True)
+        self.assertTrue(res is alms)
+        np.testing.assert_array_almost_equal(alms[1],2*self.alm*fl1[l])
+
+    def test_complex_filter(self):
+        fl = 1j*np.ones(self.lmax+1)
+        out = almxfl(self.alm,[fl,np.ones(self.lmax+1)],mmax=self.mmax)
+        np.testing.assert_array_almost_equal(out,1j*self.alm)
+        alm = self.alm.copy()
+        almxfl(alm,fl,mmax=self.mmax,inplace=True)
+        np.testing.assert_array_almost_equal(alm,1j*self.alm)
+
+    def test_alm2map_mmax(self):
+        nside = 8
+        m1 = alm2map(self.alm.copy(),nside,lmax=self.lmax,mmax=self.mmax,
+                     fwhm=0.1,pixwin=True)
+        alm = self.alm.copy()
+        smoothalm(alm,fwhm=0.1,mmax=self.mmax)
+        almxfl(alm,pixwin(nside),mmax=self.mmax,inplace=True)
+        m2 = alm2map(alm,nside,lmax=self.lmax,mmax=self.mmax)
+        np.testing.assert_array_almost_equal(m1,m2)
+
+class TestAlm(unittest.TestCase):
+
+    def test_layout(self):
+        lmax,mmax = 10,4
+        layout = Alm.layout(lmax,mmax)
+        self.assertTrue(Alm.layout(lmax,mmax) is layout)
+        self.assertEqual(layout.size,Alm.getsize(lmax,mmax))
+        np.testing.assert_array_equal(layout.getidx(layout.l,layout.m),
+                                      np.arange(layout.size))
+        np.testing.assert_array_equal(Alm.getidx(lmax,layout.l,layout.m),
+                                      np.arange(layout.size))
+        index = layout.fits_index()
+        np.testing.assert_array_equal(index,layout.l**2+layout.l+layout.m+1)
+        np.testing.assert_array_equal(layout.fits2idx(index),
+                                      np.arange(layout.size))
+        self.assertRaises(ValueError,layout.fits2idx,[Alm.lm2fits(5,5)])
+
+    def test_getlm(self):
+        l,m = Alm.getlm(6)
+        i = np.arange(Alm.getsize(6))
+        mref = np.ceil(((2*6+1)-np.sqrt((2*6+1)**2-8*(i-6)))/2).astype(int)
+        np.testing.assert_array_equal(m,mref)
+        np.testing.assert_array_equal(l,i-mref*(2*6+1-mref)/2)
+        self.assertEqual(Alm.getlm(6,8),(2,1))
+        self.assertTrue(Alm.getlm(6)[0] is l)
+        self.assertEqual(l.dtype,np.dtype(int))
+
+    def test_getlmax(self):
+        self.assertEqual(Alm.getlmax(Alm.getsize(6000)),6000)
+        self.assertEqual(Alm.getlmax(Alm.getsize(6000)+1),-1)
+        self.assertEqual(Alm.getlmax(Alm.getsize(20,12),12),20)
+        self.assertEqual(Alm.getlmax(Alm.getsize(20,12)+1,12),-1)
+
+class TestWigner3j(unittest.TestCase):
+
+    def racah(self,j1,j2,j3,m1,m2):
+        f = math.factorial
+        m3 = -m1-m2
+        if (j3 < abs(j1-j2) or j3 > j1+j2 or abs(m1) > j1 or abs(m2) > j2
+            or abs(m3) > j3):
+            return 0.
+        t = math.sqrt(f(j1+j2-j3)*f(j1-j2+j3)*f(-j1+j2+j3)
+                      *f(j1+m1)*f(j1-m1)*f(j2+m2)*f(j2-m2)*f(j3+m3)*f(j3-m3)
+                      /float(f(j1+j2+j3+1)))
+        s = 0.
+        for k in xrange(j1+j2+j3+1):
+            a = [k,j1+j2-j3-k,j1-m1-k,j2+m2-k,j3-j2+m1+k,j3-j1-m2+k]
+            if min(a) >= 0:
+                s += (-1)**k/float(reduce(lambda x,y: x*y,map(f,a)))
+        return (-1)**(j1-j2-m3)*t*s
+
+    def test_values(self):
+        for l1,l2,m1,m2 in ((5,7,2,-3),(6,6,3,-3),(6,6,0,0),(9,2,-4,1),
+                            (0,4,0,4),(12,12,12,-12)):
+            ref = [self.racah(l1,l2,l3,m1,m2) for l3 in xrange(l1+l2+1)]
+            np.testing.assert_array_almost_equal(wigner3j(l1,l2,m1,m2),ref)
+
+    def test_batch(self):
+        l1 = np.array([[3,40],[25,1000]])
+        l2 = np.array([[10,40],[3,1200]])
+        w = wigner3j(l1,l2,2,-1)
+        self.assertEqual(w.shape,(2,2,2201))
+        np.testing.assert_array_almost_equal(w[1,0,:29],
+                                             wigner3j(25,3,2,-1))
+        l3 = np.arange(w.shape[-1])
+        np.testing.assert_array_almost_equal(((2*l3+1)*w**2).sum(axis=-1),
+                                             np.ones((2,2)))
+
+    def test_gaunt(self):
+        g = gaunt(4,0,3,0)
+        self.assertEqual(g.size,5)
+        np.testing.assert_array_almost_equal(g,[0,0,0,0,
+                                                -1./np.sqrt(4*np.pi)])
+
+class TestPseudoCl(unittest.TestCase):
+
+    def w3j_000(self,l1,l2,l3):
+        J = l1+l2+l3
+        if J % 2 or l3 < abs(l1-l2) or l3 > l1+l2:
+            return 0.
+        lf = lambda n: math.lgamma(n+1)
+        g = J/2
+        return (-1)**g*math.exp(0.5*(lf(J-2*l1)+lf(J-2*l2)+lf(J-2*l3)
+                                     -lf(J+1))
+                                +lf(g)-lf(g-l1)-lf(g-l2)-lf(g-l3))
+
+    def test_coupling_matrix(self):
+        lmax = 8
+        np.random.seed(1122)
+        wl = np.random.uniform(size=2*lmax+1)
+        ref = np.zeros((lmax+1,lmax+1))
+        for l1 in xrange(lmax+1):
+            for l2 in xrange(lmax+1):
+                ref[l1,l2] = (2*l2+1)/(4*np.pi)*sum(
+                    (2*l3+1)*wl[l3]*self.w3j_000(l1,l2,l3)**2
+                    for l3 in xrange(2*lmax+1))
+        np.testing.assert_array_almost_equal(coupling_matrix(wl,lmax),ref)
+        full = np.zeros(2*lmax+1)
+        full[0] = 4*np.pi
+        np.testing.assert_array_almost_equal(coupling_matrix(full,lmax),
+                                             np.identity(lmax+1))
+
+    def test_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            wl = 1./(np.arange(21)+1.)
+            mat = coupling_matrix(wl,10,cachedir=path)
+            self.assertEqual(len(os.listdir(path)),1)
+            np.testing.assert_array_equal(coupling_matrix(wl,10,path),mat)
+        finally:
+            shutil.rmtree(path)
+
+    def test_pseudo_cl(self):
+        nside = 32
+        lmax = 2*nside
+        np.random.seed(3344)
+        cl = 1./(np.arange(3*nside)+10.)**2
+        m = synfast(cl,nside,lmax=3*nside-1)
+        theta,phi = healpy.pix2ang(nside,np.arange(m.size))
+        mask = (np.abs(theta-np.pi/2) > np.radians(20)).astype(float)
+        bins = np.arange(2,lmax+1,8)
+        clb = pseudo_cl(m,mask,lmax=lmax,bins=bins,apodization=5.,
+                        degree=True)
+        ref = np.array([cl[b:b+8].mean() for b in bins])
+        self.assertTrue(np.all(np.abs(clb/ref-1) < 0.3))
+
+class TestPixwin(unittest.TestCase):
+
+    def test_pixwin_cached_copy(self):
+        pw1 = pixwin(64)
+        pw1[:] = 0
+        pw2,pwpol = pixwin(64,pol=True)
+        path = os.path.join(healpy.sphtfunc.DATAPATH,'pixel_window_n0064.fits')
+        self.assertFalse(healpy.sphtfunc._data_cache[path].flags.writeable)
+        self.assertTrue(np.all(pw2 != 0))
+        self.assertEqual(pw2.size,pwpol.size)
+
+    def test_pixwin_cachepath(self):
+        cachepath = tempfile.mkdtemp()
+        healpy.sphtfunc.CACHEPATH = cachepath
+        try:
+            healpy.sphtfunc._data_cache.clear()
+            pw = pixwin(16)
+            self.assertEqual(len(os.listdir(cachepath)),1)
+            healpy.sphtfunc._data_cache.clear()
+            np.testing.assert_array_equal(pixwin(16),pw)
+        finally:
+            healpy.sphtfunc.CACHEPATH = None
+            shutil.rmtree(cachepath)
+
+    def test_pixwin_file(self):
+        import pyfits
+        d = pyfits.getdata(os.path.join(healpy.sphtfunc.DATAPATH,
+                                        'pixel_window_n0032.fits'))
+        pw,pwpol = pixwin(32,pol=True)
+        np.testing.assert_array_equal(pw,d.field(0))
+        np.testing.assert_array_equal(pwpol,d.field(1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -35,6 +35,9 @@ cdef extern from "stdlib.h":
  void free(void*)
  ctypedef long size_t
 
+cdef extern from "stddef.h":
+ ctypedef long ptrdiff_t
+
 cdef extern from "string.h":
  void *memcpy(void *dst,  void *src, size_t l)
 
@@ -55,8 +58,8 @@ cdef extern from "psht.h":
  void 	pshtd_add_job_alm2map_spin (pshtd_joblist *joblist,  pshtd_cmplx *alm1,  pshtd_cmplx *alm2, double *map1, double *map2, int spin, int add_output)
  void 	pshtd_add_job_map2alm_spin (pshtd_joblist *joblist,  double *map1,  double *map2, pshtd_cmplx *alm1, pshtd_cmplx *alm2, int spin, int add_output)
  void 	pshtd_add_job_alm2map_deriv1 (pshtd_joblist *joblist,  pshtd_cmplx *alm, double *mapdtheta, double *mapdphi, int add_output)
- void 	pshtd_execute_jobs (pshtd_joblist *joblist,  psht_geom_info *geom_info,  psht_alm_info *alm_info)
- void 	psht_make_geom_info (int nrings,  int *nph,  int *ofs,  int *stride,  double *phi0,  double *theta,  double *weight, psht_geom_info **geom_info)
+ void 	pshtd_execute_jobs (pshtd_joblist *joblist,  psht_geom_info *geom_info,  psht_alm_info *alm_info) nogil
+ void 	psht_make_geom_info (int nrings,  int *nph,  ptrdiff_t *ofs,  int *stride,  double *phi0,  double *theta,  double *weight, psht_geom_info **geom_info)
  void 	psht_destroy_geom_info (psht_geom_info *info)
  void 	psht_make_healpix_geom_info (int nside, int stride, psht_geom_info **geom_info)
  void 	psht_make_weighted_healpix_geom_info (int nside, int stride,  double *weight, psht_geom_info **geom_info)
@@ -83,24 +86,50 @@ def _howManyMaps(rmap):
 cdef class job:
  """A wrapper for the PSHT job list.
 Beware, this one only works with healpix maps, and double precision maps and alms.
-job(int nside, int lmax=-1, int mmax=-1, int stridemap = 1, int stridealm = 1)
+job(int nside, int lmax=-1, int mmax=-1, int stridemap = 1, int stridealm = 1, weights = None, geom = None, mapsize = -1)
 Create a new job list. 
  nside : nside
  lmax : if ==-1, set to 3 * nside - 1
  mmax : if ==-1, set to lmax
+ weights : if != None, an array of 2*nside ring weights (as used by
+           map2alm in healpix_cxx, ie. 1 + the content of the weight_ring
+           files). Default: uniform weights.
+ geom : if != None, a tuple (nph, ofs, phi0, theta, weight) of arrays describing
+        the rings of the map to use (number of pixels, index of the first pixel,
+        azimuth of the first pixel, colatitude and quadrature weight of each
+        ring). Pixels outside these rings are ignored by map2alm and left
+        untouched by alm2map. Default: all the rings of the healpix map.
+ mapsize : the size of the maps given to the jobs, if ==-1, set to 12*nside**2.
+           With geom, the maps may hold only some rings of the healpix map.
 """
  cdef pshtd_joblist *jb
  cdef psht_geom_info *geom
  cdef psht_alm_info *almi
  cdef object storein, storeout
  cdef int lmax,nside,mmax
+ cdef long mapsize
 
- def __init__(self,int nside, int lmax=-1, int mmax=-1, int stridemap = 1, int stridealm = 1):
+ def __init__(self,int nside, int lmax=-1, int mmax=-1, int stridemap = 1, int stridealm = 1, weights = None, geom = None, long mapsize = -1):
+   cdef double *_weights
    if lmax == -1:
      lmax = 3*nside-1
    if mmax == -1:
      mmax = lmax 
-   psht_make_healpix_geom_info (nside, stridemap, &self.geom)
+   if mapsize == -1:
+     mapsize = 12*nside*nside
+   self.mapsize = mapsize
+   if geom is not None:
+     if weights is not None:
+       raise pshtError("Give either weights or geom, not both")
+     self._make_geom(geom,stridemap)
+   elif weights is None:
+     psht_make_healpix_geom_info (nside, stridemap, &self.geom)
+   else:
+     weights_proxy=c_numpy.PyArray_ContiguousFromAny(weights,c_numpy.NPY_DOUBLE,1,1)
+     if len(weights_proxy)<2*nside:
+       raise pshtError("Wrong size for weights (expected %d, got %d)"%(2*nside,len(weights_proxy)))
+     _weights = <double*> c_numpy.PyArray_DATA(weights_proxy)
+     psht_make_weighted_healpix_geom_info (nside, stridemap, _weights, &self.geom)
    psht_make_triangular_alm_info (lmax, mmax, stridealm, &self.almi)
    pshtd_make_joblist (&self.jb)
    self.storein = []
@@ -109,10 +138,32 @@ Create a new job list.
    self.mmax = mmax
    self.nside = nside
 
+ def _make_geom(self, geom, int stridemap):
+   nph_proxy=npy.ascontiguousarray(geom[0],dtype=npy.intc).ravel()
+   ofs_proxy=npy.ascontiguousarray(geom[1],dtype=npy.intp).ravel()
+   phi0_proxy=c_numpy.PyArray_ContiguousFromAny(geom[2],c_numpy.NPY_DOUBLE,1,1)
+   theta_proxy=c_numpy.PyArray_ContiguousFromAny(geom[3],c_numpy.NPY_DOUBLE,1,1)
+   weight_proxy=c_numpy.PyArray_ContiguousFromAny(geom[4],c_numpy.NPY_DOUBLE,1,1)
+   nrings = len(nph_proxy)
+   for p in (ofs_proxy,phi0_proxy,theta_proxy,weight_proxy):
+     if len(p)!=nrings:
+       raise pshtError("All geometry arrays must have the same size")
+   if nrings>0 and (ofs_proxy.min()<0 or (ofs_proxy+nph_proxy*stridemap).max()>self.mapsize):
+     raise pshtError("The rings of the geometry exceed the map size")
+   stride_proxy=npy.empty(nrings,dtype=npy.intc)
+   stride_proxy[:]=stridemap
+   psht_make_geom_info (nrings, <int*> c_numpy.PyArray_DATA(nph_proxy),
+                        <ptrdiff_t*> c_numpy.PyArray_DATA(ofs_proxy),
+                        <int*> c_numpy.PyArray_DATA(stride_proxy),
+                        <double*> c_numpy.PyArray_DATA(phi0_proxy),
+                        <double*> c_numpy.PyArray_DATA(theta_proxy),
+                        <double*> c_numpy.PyArray_DATA(weight_proxy),
+                        &self.geom)
+
  def _mapsize(self):
-   return 12*self.nside**2
+   return self.mapsize
  def _almsize(self):
-   return ((self.lmax+1)*(self.lmax+2))/2
+   return self.mmax*(2*self.lmax+1-self.mmax)/2+self.lmax+1
 
  def _newmap(self):
    return npy.zeros(self._mapsize())
@@ -156,7 +207,7 @@ Fail if the joblist is not empty.
    cdef pshtd_cmplx *_alm
 
    alm_proxy=c_numpy.PyArray_ContiguousFromAny(alm,c_numpy.NPY_COMPLEX128,1,1)
-   if rmap !=None:
+   if rmap is not None:
      rmap_proxy=c_numpy.PyArray_ContiguousFromAny(rmap,c_numpy.NPY_DOUBLE,1,1)
      addo = 1
    else:
@@ -178,7 +229,7 @@ Fail if the joblist is not empty.
    almT_proxy=c_numpy.PyArray_ContiguousFromAny(alm[0],c_numpy.NPY_COMPLEX128,1,1)
    almG_proxy=c_numpy.PyArray_ContiguousFromAny(alm[1],c_numpy.NPY_COMPLEX128,1,1)
    almC_proxy=c_numpy.PyArray_ContiguousFromAny(alm[2],c_numpy.NPY_COMPLEX128,1,1)
-   if rmap !=None:
+   if rmap is not None:
      if _howManyMaps(rmap)!=3:
        raise pshtError("not enough maps")
      rmapT_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[0],c_numpy.NPY_DOUBLE,1,1)
@@ -234,7 +285,7 @@ Fail if the joblist is not empty.
 
    rmap_proxy=c_numpy.PyArray_ContiguousFromAny(rmap,c_numpy.NPY_DOUBLE,1,1)
 
-   if alm !=None:
+   if alm is not None:
      alm_proxy=c_numpy.PyArray_ContiguousFromAny(alm,c_numpy.NPY_COMPLEX128,1,1)
      addo = 1
    else:
@@ -257,7 +308,7 @@ Fail if the joblist is not empty.
    rmapQ_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[1],c_numpy.NPY_DOUBLE,1,1)
    rmapU_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[2],c_numpy.NPY_DOUBLE,1,1)
 
-   if alm !=None:
+   if alm is not None:
      if _howManyMaps(alm)!=3:
        raise pshtError("not enough alm")
      almT_proxy=c_numpy.PyArray_ContiguousFromAny(alm[0],c_numpy.NPY_COMPLEX128,1,1)
@@ -301,11 +352,11 @@ Add a alm2map_spin transform to the job list.
    alm1_proxy=c_numpy.PyArray_ContiguousFromAny(alm[0],c_numpy.NPY_COMPLEX128,1,1)
    alm2_proxy=c_numpy.PyArray_ContiguousFromAny(alm[1],c_numpy.NPY_COMPLEX128,1,1)
 
-   if rmap !=None:
+   if rmap is not None:
      if _howManyMaps(rmap)!=2:
        raise pshtError("not enough map")
      rmap1_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[0],c_numpy.NPY_DOUBLE,1,1)
-     rmap2_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[0],c_numpy.NPY_DOUBLE,1,1)
+     rmap2_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[1],c_numpy.NPY_DOUBLE,1,1)
      addo = 1
    else:
      rmap1_proxy = self._newmap()
@@ -338,9 +389,9 @@ Add a map2alm_spin transform to the job list.
      raise pshtError("not enough map")
 
    rmap1_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[0],c_numpy.NPY_DOUBLE,1,1)
-   rmap2_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[0],c_numpy.NPY_DOUBLE,1,1)
+   rmap2_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[1],c_numpy.NPY_DOUBLE,1,1)
 
-   if alm !=None:
+   if alm is not None:
      if _howManyMaps(alm)!=2:
        raise pshtError("not enough alm")
      alm1_proxy=c_numpy.PyArray_ContiguousFromAny(alm[0],c_numpy.NPY_COMPLEX128,1,1)
@@ -374,11 +425,11 @@ Add a alm2map_der1 transform to the job list.
 
    alm_proxy=c_numpy.PyArray_ContiguousFromAny(alm,c_numpy.NPY_COMPLEX128,1,1)
 
-   if rmap !=None:
+   if rmap is not None:
      if _howManyMaps(rmap)!=2:
        raise pshtError("not enough map")
      rmap1_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[0],c_numpy.NPY_DOUBLE,1,1)
-     rmap2_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[0],c_numpy.NPY_DOUBLE,1,1)
+     rmap2_proxy=c_numpy.PyArray_ContiguousFromAny(rmap[1],c_numpy.NPY_DOUBLE,1,1)
      addo = 1
    else:
      rmap1_proxy = self._newmap()
@@ -399,8 +450,12 @@ Add a alm2map_der1 transform to the job list.
  def execute(self):
    """execute()
 Execute all the jobs in the joblist. Empty the joblist. 
-Returns a list of the results"""
-   pshtd_execute_jobs (self.jb, self.geom, self.almi)
+Returns a list of the results. The GIL is released during the transforms."""
+   cdef pshtd_joblist *jb = self.jb
+   cdef psht_geom_info *geom = self.geom
+   cdef psht_alm_info *almi = self.almi
+   with nogil:
+     pshtd_execute_jobs (jb, geom, almi)
    pshtd_clear_joblist(self.jb)
    self.storein = []
    res = self.storeout
@@ -410,9 +465,12 @@ Returns a list of the results"""
  def __dealloc__(self):
    self.storein = []
    self.storeout = []
-   pshtd_destroy_joblist(self.jb)
-   psht_destroy_geom_info(self.geom)
-   psht_destroy_alm_info (self.almi)
+   if self.jb!=NULL:
+     pshtd_destroy_joblist(self.jb)
+   if self.geom!=NULL:
+     psht_destroy_geom_info(self.geom)
+   if self.almi!=NULL:
+     psht_destroy_alm_info (self.almi)
 
 def __tlm(lmax,mmax):
  if lmax == None:
@@ -514,7 +572,7 @@ Computes two healpix maps from two spinned alms using PSHT.
    lmax = __getlmax(len(alm[0]),mmax)
 
  jb = job(nside,lmax,mmax)
- jb.add_alm2map_spin(alm)
+ jb.add_alm2map_spin(alm,spin)
  res = jb.execute()
  return res[0]
 
@@ -534,7 +592,7 @@ Computes the spinned alm of two Healpix maps using PSHT.
  lmax,mmax = __tlm(lmax,mmax)
  nside=int(npy.sqrt(len(rmap[0])/12.))
  jb = job(nside,lmax,mmax)
- jb.add_map2alm_spin(rmap)
+ jb.add_map2alm_spin(rmap,spin)
  res = jb.execute()
  return res[0]
 
@@ -212,7 +212,8 @@ setup(name='healpy',
       py_modules=['healpy.pixelfunc','healpy.sphtfunc',
                   'healpy.visufunc','healpy.fitsfunc',
                   'healpy.projector','healpy.rotator',
-                  'healpy.projaxes','healpy.version'],
+                  'healpy.projaxes','healpy.version',
+                  'healpy.hpxfunc','healpy._workers'],
       cmdclass = {'build_ext': build_ext},
       ext_modules=[pixel_lib,spht_lib,hfits_lib,
                    Extension("healpy.pshyt", ["pshyt/pshyt."+ext],